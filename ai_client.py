@@ -3,14 +3,36 @@ import threading
 import time
 
 from client import Client
-from lib.ai_utils import ai_call
+from lib.ai_utils import (
+    MODEL_MAX_INPUT_TOKENS,
+    ai_call,
+    ai_call_stream,
+    sentence_chunks,
+)
+from lib.config import get_env_var
+from lib.conversation import DEFAULT_MAX_MESSAGES, ConversationLog
+from lib.generation import DEFAULT_CONCURRENCY, GenerationPool
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_DIRECT,
+    MSG_PARTIAL,
+    MSG_PRESENCE,
+    MSG_SYSTEM,
+    encode_frame,
+    encode_hello,
+)
+from lib.rate_limit import (
+    GenerationStats,
+    GenerationThrottle,
+    bucket_from_env,
+    debounce_settings_from_env,
+    provider_rpm_from_env,
+)
+from lib.rooms import DEFAULT_ROOM
+from lib.scheduler import get_scheduler
 from lib.utils import (
-    deserialize_message,
-    encode_message,
     generate_random_string,
-    receive_message,
     sender_colored_message,
-    serialize_message,
 )
 
 SYSTEM_PROMPT_RESPOND = (
@@ -30,34 +52,67 @@ class AIClient(Client):
         retry_delay=1,
         mode=None,
         n=None,
+        max_history_messages=DEFAULT_MAX_MESSAGES,
+        max_history_tokens=MODEL_MAX_INPUT_TOKENS,
+        concurrency=DEFAULT_CONCURRENCY,
+        stream=None,
+        jitter=0,
+        room=None,
     ):
         self.server_host = server_host
         self.server_port = server_port
         self.max_retries = max_retries
         self.retry_delay = retry_delay
         self.connected = False
+        # Frames are sent from the generation workers and the send thread
+        self.send_lock = threading.Lock()
+        self.generation_pool = GenerationPool(concurrency)
+        if stream is None:
+            stream = get_env_var("AI_STREAM", "0") == "1"
+        self.stream = stream
 
-        self.conversation_log = []
         self.mode = mode or self.get_mode()
         self.n = n or self.get_n()
+        # Mode 2 only: seconds by which each period may randomly vary
+        self.jitter = jitter
 
         self.client_name = f"AI-{generate_random_string()}"
+        self.conversation_log = ConversationLog(
+            self.client_name, max_history_messages, max_history_tokens
+        )
+        bucket = bucket_from_env("AI")
+        self.throttle = GenerationThrottle(
+            self.start_generation,
+            get_scheduler(),
+            [bucket] if bucket else [],
+            stats=GenerationStats(provider_rpm_from_env()),
+            **debounce_settings_from_env(),
+        )
+        self.session_token = b""
+        self.last_seq = 0
+        # Bots keep to their own room, so their traffic only reaches its members
+        self.room = room or get_env_var("AI_ROOM") or DEFAULT_ROOM
 
         self.connect_and_register()
 
     def register(self):
-        self.client_socket.sendall(encode_message(self.client_name))
+        self.joined = False
+        self.client_socket.sendall(
+            encode_hello(self.client_name, self.session_token, self.last_seq, self.room)
+        )
 
         self.receive_thread = threading.Thread(target=self.receive_messages)
-        if self.mode == 2:
-            self.send_thread = threading.Thread(target=self.send_messages)
 
     def start(self):
         self.receive_thread.start()
+        speak_timer = None
         if self.mode == 2:
-            self.send_thread.start()
-            self.send_thread.join()
+            speak_timer = get_scheduler().call_every(
+                self.n, self.send_messages, jitter=self.jitter
+            )
         self.receive_thread.join()
+        if speak_timer is not None:
+            speak_timer.cancel()
         self.client_socket.close()
 
     def get_mode(self):
@@ -80,27 +135,38 @@ class AIClient(Client):
                 if not self.connect_and_register():
                     break
             try:
-                message = receive_message(self.client_socket)
-                if message is False:
+                frames = self.decoder.receive(self.client_socket)
+                if frames is False:
                     print("Connection closed by the server")
                     self.connected = False
                     self.client_socket.close()
                     time.sleep(self.retry_delay)
                     continue
 
-                self.conversation_log.append(message)
-                print(sender_colored_message(*deserialize_message(message)))
-                line_count += 1
+                for frame in frames:
+                    # The server replays recent messages before its welcome;
+                    # they are context, not new lines to respond to.
+                    if frame.type == MSG_SYSTEM:
+                        self.joined = True
+                    elif not self.joined and frame.seq <= self.last_seq:
+                        # Already seen before a reconnect
+                        continue
+                    # Partial output is followed by the complete MSG_CHAT
+                    if self.track_session(frame) or frame.type in (
+                        MSG_PARTIAL,
+                        MSG_PRESENCE,
+                        MSG_DIRECT,
+                    ):
+                        continue
+                    self.conversation_log.append(frame.sender_name, frame.text)
+                    print(sender_colored_message(frame.sender_name, frame.text))
+                    if self.joined:
+                        line_count += 1
 
                 if self.mode == 1 and line_count >= self.n:
-                    ai_response = ai_call(
-                        self.conversation_log, SYSTEM_PROMPT_RESPOND, self.client_name
-                    )
-                    print(ai_response)
-                    self.client_socket.sendall(encode_message(ai_response))
-                    self.conversation_log.append(
-                        serialize_message(self.client_name, ai_response)
-                    )
+                    # Bursts are coalesced into one generation, which runs on
+                    # the worker pool while this loop keeps draining the socket
+                    self.throttle.trigger()
                     line_count = 0
 
             except ConnectionResetError:
@@ -116,20 +182,49 @@ class AIClient(Client):
                 time.sleep(self.retry_delay)
 
     def send_messages(self):
-        last_response_time = time.time()
+        # Called every N seconds by the shared scheduler in mode 2; the
+        # receive thread takes care of reconnecting.
+        if not self.connected:
+            return
+        self.throttle.request()
+
+    def start_generation(self):
+        if self.mode == 1:
+            conversation, system_prompt = self.conversation_log, SYSTEM_PROMPT_RESPOND
+        else:
+            conversation, system_prompt = [], SYSTEM_PROMPT_DISRUPT
+        return self.generation_pool.submit(
+            self.client_name,
+            self.generate_response,
+            self.send_ai_response,
+            conversation,
+            system_prompt,
+        )
 
-        while True:
-            if not self.connected:
-                if not self.connect_and_register():
-                    break
-            if time.time() - last_response_time >= self.n:
-                ai_response = ai_call([], SYSTEM_PROMPT_DISRUPT, self.client_name)
-                self.client_socket.sendall(encode_message(ai_response))
-                print(ai_response)
-                self.conversation_log.append(
-                    serialize_message(self.client_name, ai_response)
-                )
-                last_response_time = time.time()
+    def generate_response(self, conversation, system_prompt):
+        if not self.stream:
+            return ai_call(conversation, system_prompt, self.client_name)
+
+        # Send each sentence to the room as soon as it is complete; the full
+        # response still goes out as a regular chat message at the end.
+        chunks = []
+        for chunk in sentence_chunks(
+            ai_call_stream(conversation, system_prompt, self.client_name)
+        ):
+            chunks.append(chunk)
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_PARTIAL, b"", chunk))
+        return " ".join(chunks)
+
+    def send_ai_response(self, ai_response):
+        print(ai_response)
+        try:
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_CHAT, b"", ai_response))
+        except OSError as e:
+            print(f"Error sending AI response: {e}")
+            return
+        self.conversation_log.append(self.client_name, ai_response)
 
 
 if __name__ == "__main__":
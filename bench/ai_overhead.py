@@ -0,0 +1,72 @@
+"""
+Measures our own overhead on the AI path (history bookkeeping, token trimming,
+prompt building) against the in-process fake model backend, with the
+provider's latency taken out.
+
+Usage: python -m bench.ai_overhead --history 5000 --calls 500
+"""
+
+import argparse
+import json
+import time
+
+from lib import ai_utils
+from lib.ai_utils import ai_call, set_ai_backend
+from lib.conversation import ConversationLog
+from lib.fake_openai import FakeOpenAI
+from bench.loadgen import percentile
+
+
+class WhitespaceEncoding:
+    """Stand-in tokenizer for machines without the tiktoken data files."""
+
+    def encode(self, text):
+        return text.split()
+
+
+def run(config):
+    if config.offline_tokenizer:
+        ai_utils.get_encoding = lambda model: WhitespaceEncoding()
+    fake = FakeOpenAI(latency=config.latency, tokens_per_sec=0, seed=0)
+    set_ai_backend(fake)
+
+    log = ConversationLog("AI-bench", max_messages=config.history)
+    for i in range(config.history):
+        log.append(f"user-{i % 50}", f"message number {i} with a few extra words")
+
+    timings = []
+    for i in range(config.calls):
+        # Every call sees one new message, like a bot responding to each line
+        log.append("user-new", f"fresh message {i}")
+        started = time.perf_counter()
+        ai_call(log, "You are a joyful chat participant.", "AI-bench")
+        timings.append((time.perf_counter() - started - config.latency) * 1000)
+
+    timings.sort()
+    return {
+        "config": vars(config),
+        "fake_backend": fake.stats,
+        "overhead_ms": {
+            "mean": round(sum(timings) / len(timings), 4),
+            "p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "p99": percentile(timings, 99),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AI path overhead benchmark")
+    parser.add_argument("--history", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument(
+        "--offline-tokenizer",
+        action="store_true",
+        help="count whitespace-separated words instead of loading tiktoken",
+    )
+    print(json.dumps(run(parser.parse_args(argv)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Federation check for the chat server.
+
+Starts several server processes on localhost, links them as a mesh, a chain or
+a star, connects clients to every node and reports whether each message
+reached every other client exactly once, with the delivery latency, as JSON.
+
+Usage: python -m bench.federation --nodes 4 --topology chain
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import secrets
+import sys
+import time
+from collections import Counter
+
+from bench.loadgen import latency_ms, make_body, percentile, wait_for_server
+from lib.protocol import MSG_CHAT, FrameDecoderV2, encode_frame, encode_hello
+
+
+def run_node(index, host, port, relay_peers, relay_secret, quiet):
+    from server import Server
+
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    Server(
+        host,
+        port,
+        relay_peers=relay_peers,
+        node_id=f"node-{index}",
+        relay_secret=relay_secret,
+    ).start()
+
+
+def relay_peers(topology, index, addresses):
+    """
+    Addresses node `index` dials; every link is dialed from one side only.
+    """
+    if topology == "mesh":
+        return addresses[:index]
+    if topology == "chain":
+        return addresses[index - 1 : index]
+    return addresses[:1] if index else []
+
+
+async def run_client(name, host, port, config, received, latencies, start_at):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode_hello(name))
+    decoder = FrameDecoderV2()
+
+    async def receive():
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                if frame.type == MSG_CHAT:
+                    received[(name, frame.body)] += 1
+                    latencies.append(latency_ms(frame.body))
+
+    receiving = asyncio.ensure_future(receive())
+    await asyncio.sleep(max(0, start_at - time.time()))
+    for _ in range(config.messages):
+        writer.write(encode_frame(MSG_CHAT, b"", make_body(config.size)))
+        await asyncio.sleep(config.interval)
+    await asyncio.sleep(config.drain)
+    receiving.cancel()
+    writer.close()
+
+
+async def run_clients(config, addresses):
+    received = Counter()
+    latencies = []
+    start_at = time.time() + 1
+    await asyncio.gather(
+        *(
+            run_client(
+                f"client-{node}-{i}",
+                host,
+                port,
+                config,
+                received,
+                latencies,
+                start_at,
+            )
+            for node, (host, port) in enumerate(addresses)
+            for i in range(config.clients)
+        )
+    )
+    return received, latencies
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server federation check")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8200, help="first node's port")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--topology", choices=("mesh", "chain", "star"), default="mesh")
+    parser.add_argument("--clients", type=int, default=5, help="clients per node")
+    parser.add_argument("--messages", type=int, default=20, help="per client")
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--size", type=int, default=64, help="body size in bytes")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait")
+    parser.add_argument("--verbose", action="store_true", help="show server logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    config = parse_args(argv)
+    addresses = [(config.host, config.port + i) for i in range(config.nodes)]
+    relay_secret = secrets.token_hex(16)
+    nodes = []
+    for index, (host, port) in enumerate(addresses):
+        node = multiprocessing.Process(
+            target=run_node,
+            args=(
+                index,
+                host,
+                port,
+                relay_peers(config.topology, index, addresses),
+                relay_secret,
+                not config.verbose,
+            ),
+            daemon=True,
+        )
+        node.start()
+        nodes.append(node)
+    for host, port in addresses:
+        wait_for_server(host, port)
+    # Give the relay links time to come up
+    time.sleep(1)
+
+    received, latencies = asyncio.run(run_clients(config, addresses))
+    for node in nodes:
+        node.terminate()
+
+    clients = config.nodes * config.clients
+    sent = clients * config.messages
+    expected = sent * (clients - 1)
+    counts = Counter(received.values())
+    latencies.sort()
+    report = {
+        "config": vars(config),
+        "sent": sent,
+        "expected_deliveries": expected,
+        "delivered": sum(received.values()),
+        "duplicates": sum(count - 1 for count in received.values() if count > 1),
+        "exactly_once": counts[1] == expected and len(counts) == 1,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""
+Load generator for the chat server.
+
+Starts a server (in a subprocess, a thread, or uses an external one), connects
+N simulated clients speaking the lib framing, drives a configurable message
+rate and size, and reports throughput and end-to-end delivery latency as JSON.
+
+Usage: python -m bench.loadgen --clients 200 --senders 20 --rate 5 --duration 10
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from lib.protocol import MSG_CHAT, MSG_HELLO, FrameDecoderV2, encode_frame
+from lib.utils import FrameDecoder, encode_message
+
+
+def run_server(engine, host, port, poller, quiet=False):
+    from server import AsyncServer, Server
+
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+
+    if engine == "asyncio":
+        asyncio.run(AsyncServer(host, port).start())
+    else:
+        Server(host, port, poller).start()
+
+
+def run_cluster_worker(quiet, host, port, poller, *worker_args):
+    from server import run_cluster_worker
+
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    run_cluster_worker(*worker_args, host=host, port=port, poller=poller)
+
+
+def start_server(config):
+    args = (config.engine, config.host, config.port, config.poller)
+    if not config.flood_limits:
+        # Otherwise any --rate over CLIENT_RATE measures the server pausing
+        # reads rather than its throughput. The server reads these at startup
+        # and does not override them from .env.
+        os.environ.update(CLIENT_RATE="0", CLIENT_BYTE_RATE="0")
+    if config.server_workers > 1:
+        # The cluster forks its workers itself, which a daemonic process can't
+        from lib.cluster import Cluster
+
+        target = functools.partial(
+            run_cluster_worker,
+            not config.verbose,
+            config.host,
+            config.port,
+            config.poller,
+        )
+        server = threading.Thread(
+            target=Cluster(config.server_workers, target).run, daemon=True
+        )
+    elif config.server == "process":
+        server = multiprocessing.Process(
+            target=run_server, args=(*args, not config.verbose), daemon=True
+        )
+    else:
+        server = threading.Thread(target=run_server, args=args, daemon=True)
+    server.start()
+    wait_for_server(config.host, config.port)
+    return server
+
+
+def wait_for_server(host, port, timeout=10):
+    import socket
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server at {host}:{port} did not come up")
+
+
+def make_body(size):
+    """
+    Builds a message body carrying its send time, padded to the given size.
+    """
+    stamp = f"{time.time_ns()}:"
+    return (stamp + "x" * max(0, size - len(stamp))).encode("utf-8")
+
+
+def latency_ms(body):
+    stamp, _, _ = body.partition(b":")
+    return (time.time_ns() - int(stamp)) / 1e6
+
+
+class BenchClient:
+    def __init__(self, name, config, stats):
+        self.name = name
+        self.config = config
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.config.host, self.config.port
+        )
+        if self.config.protocol == 1:
+            self.decoder = FrameDecoder()
+            self.writer.write(encode_message(self.name))
+        else:
+            self.decoder = FrameDecoderV2()
+            self.writer.write(encode_frame(MSG_HELLO, self.name, b""))
+        await self.writer.drain()
+
+    def encode(self, body):
+        if self.config.protocol == 1:
+            return encode_message(body.decode("utf-8"))
+        return encode_frame(MSG_CHAT, b"", body)
+
+    async def receive(self):
+        stats = self.stats
+        protocol = self.config.protocol
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            for frame in self.decoder.feed(data):
+                if protocol == 1:
+                    sender, _, body = frame.partition(": ")
+                    body = body.encode("utf-8")
+                elif frame.type == MSG_CHAT:
+                    body = frame.body
+                else:
+                    continue
+                if body[:1].isdigit():
+                    stats["received"] += 1
+                    stats["latencies"].append(latency_ms(body))
+
+    async def send(self, start_at, stop_at):
+        interval = 1 / self.config.rate
+        next_send = start_at
+        while next_send < stop_at:
+            await asyncio.sleep(max(0, next_send - time.time()))
+            self.writer.write(self.encode(make_body(self.config.size)))
+            self.stats["sent"] += 1
+            next_send += interval
+        await self.writer.drain()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run_clients(config, first_index, count, senders, start_at):
+    stats = {"sent": 0, "received": 0, "latencies": [], "connect_errors": 0}
+    clients = [
+        BenchClient(f"bench-{first_index + i}", config, stats) for i in range(count)
+    ]
+    connected = []
+    for client in clients:
+        try:
+            await client.connect()
+            connected.append(client)
+        except OSError:
+            stats["connect_errors"] += 1
+
+    receivers = [asyncio.create_task(client.receive()) for client in connected]
+    stop_at = start_at + config.duration
+    await asyncio.gather(
+        *(client.send(start_at, stop_at) for client in connected[:senders])
+    )
+    # Give in-flight deliveries time to arrive before tearing down
+    await asyncio.sleep(max(0, stop_at - time.time()) + config.drain)
+    for receiver in receivers:
+        receiver.cancel()
+    for client in connected:
+        client.close()
+    return stats
+
+
+def run_worker(args):
+    config, first_index, count, senders, start_at = args
+    return asyncio.run(run_clients(config, first_index, count, senders, start_at))
+
+
+def split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index], 3)
+
+
+def build_report(config, results):
+    sent = sum(r["sent"] for r in results)
+    received = sum(r["received"] for r in results)
+    latencies = sorted(l for r in results for l in r["latencies"])
+    expected = sent * (config.clients - 1)
+    return {
+        "config": {
+            key: getattr(config, key)
+            for key in (
+                "engine",
+                "poller",
+                "protocol",
+                "server",
+                "clients",
+                "senders",
+                "rate",
+                "size",
+                "duration",
+                "workers",
+                "server_workers",
+                "flood_limits",
+            )
+        },
+        "connect_errors": sum(r["connect_errors"] for r in results),
+        "sent": sent,
+        "delivered": received,
+        "expected_deliveries": expected,
+        "delivery_ratio": round(received / expected, 4) if expected else None,
+        "messages_per_sec": round(sent / config.duration, 2),
+        "deliveries_per_sec": round(received / config.duration, 2),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--server", choices=("process", "thread", "external"), default="process"
+    )
+    parser.add_argument("--engine", choices=("select", "asyncio"), default="select")
+    parser.add_argument("--poller", choices=("selectors", "select"), default=None)
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=5, help="msgs/sec per sender")
+    parser.add_argument("--size", type=int, default=64, help="body size in bytes")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait")
+    parser.add_argument("--workers", type=int, default=1, help="client processes")
+    parser.add_argument(
+        "--server-workers",
+        type=int,
+        default=1,
+        help="run the select engine as a cluster of this many processes",
+    )
+    parser.add_argument(
+        "--flood-limits",
+        action="store_true",
+        help="keep the started server's per-client send limits (CLIENT_RATE etc.)",
+    )
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show server logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    config = parse_args(argv)
+    config.senders = min(config.senders, config.clients)
+    server = None
+    if config.server != "external":
+        server = start_server(config)
+
+    start_at = time.time() + config.warmup
+    jobs = []
+    first_index = 0
+    for count, senders in zip(
+        split(config.clients, config.workers), split(config.senders, config.workers)
+    ):
+        jobs.append((config, first_index, count, senders, start_at))
+        first_index += count
+
+    if config.workers == 1:
+        results = [run_worker(jobs[0])]
+    else:
+        with multiprocessing.Pool(config.workers) as pool:
+            results = pool.map(run_worker, jobs)
+
+    report = build_report(config, results)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if config.output:
+        with open(config.output, "w") as f:
+            f.write(output + "\n")
+
+    if isinstance(server, multiprocessing.Process):
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
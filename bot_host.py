@@ -0,0 +1,277 @@
+import asyncio
+import json
+import sys
+import traceback
+
+from ai_client import SYSTEM_PROMPT_DISRUPT, SYSTEM_PROMPT_RESPOND
+from lib.ai_utils import ai_call, ai_call_stream, get_response_cache, sentence_chunks
+from lib.conversation import ConversationLog
+from lib.generation import DEFAULT_CONCURRENCY, GenerationPool
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_DIRECT,
+    MSG_PARTIAL,
+    MSG_PRESENCE,
+    MSG_SESSION,
+    MSG_SYSTEM,
+    FrameDecoderV2,
+    encode_frame,
+    encode_hello,
+)
+from lib.rate_limit import (
+    GenerationStats,
+    GenerationThrottle,
+    TokenBucket,
+    bucket_from_env,
+    debounce_settings_from_env,
+    provider_rpm_from_env,
+)
+from lib.rooms import DEFAULT_ROOM
+from lib.scheduler import get_scheduler
+from lib.utils import RECV_BUFFER_SIZE, generate_random_string
+
+
+class Persona:
+    """
+    One AI participant of a BotHost. Has its own connection, name and
+    conversation log, but generates through the host's shared worker pool.
+    """
+
+    def __init__(
+        self,
+        host,
+        name,
+        mode,
+        n,
+        prompt=None,
+        stream=False,
+        jitter=0,
+        rate_per_min=None,
+        burst=1,
+        room=DEFAULT_ROOM,
+    ):
+        self.host = host
+        self.name = name
+        self.mode = mode
+        self.n = n
+        self.prompt = prompt or (
+            SYSTEM_PROMPT_RESPOND if mode == 1 else SYSTEM_PROMPT_DISRUPT
+        )
+        self.stream = stream
+        self.jitter = jitter
+        self.room = room
+        self.conversation_log = ConversationLog(name)
+        self.writer = None
+        self.line_count = 0
+        # Resumes the server session after a reconnect
+        self.session_token = b""
+        self.last_seq = 0
+
+        if rate_per_min:
+            bucket = TokenBucket(rate_per_min / 60, burst)
+        else:
+            bucket = bucket_from_env("AI")
+        buckets = [b for b in (bucket, host.bucket) if b]
+        self.throttle = GenerationThrottle(
+            self.start_generation,
+            get_scheduler(),
+            buckets,
+            stats=host.stats,
+            **debounce_settings_from_env(),
+        )
+
+    async def run(self):
+        while not self.host.finished:
+            try:
+                reader, self.writer = await asyncio.open_connection(
+                    self.host.server_host, self.host.server_port
+                )
+                self.writer.write(
+                    encode_hello(
+                        self.name, self.session_token, self.last_seq, self.room
+                    )
+                )
+                await self.receive_messages(reader)
+                print(f"[BOTS] {self.name} - Connection closed by the server")
+            except OSError as e:
+                print(f"[BOTS] {self.name} - Connection failed: {e}")
+            except Exception as e:
+                # Reconnect rather than take the other personas down with it
+                print(f"[BOTS] {self.name} - Error: {e}")
+                traceback.print_exc()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            await asyncio.sleep(self.host.retry_delay)
+
+    async def receive_messages(self, reader):
+        decoder = FrameDecoderV2()
+        # Frames before the welcome message are replayed scrollback
+        joined = False
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                if frame.type == MSG_SYSTEM:
+                    joined = True
+                elif frame.type in (MSG_PARTIAL, MSG_PRESENCE, MSG_DIRECT) or (
+                    not joined and frame.seq <= self.last_seq
+                ):
+                    continue
+                self.last_seq = max(self.last_seq, frame.seq)
+                if frame.type == MSG_SESSION:
+                    self.session_token = frame.body
+                    continue
+                self.conversation_log.append(frame.sender_name, frame.text)
+                # Its own lines (replayed after a reconnect) are context, not
+                # something to respond to
+                if joined and frame.sender_name != self.name:
+                    self.line_count += 1
+            if self.mode == 1 and self.line_count >= self.n:
+                self.line_count = 0
+                self.throttle.trigger()
+
+    def speak(self):
+        """Mode 2: start a new conversation thread, without any context."""
+        if self.writer is not None:
+            self.throttle.request()
+
+    def start_generation(self):
+        conversation = self.conversation_log if self.mode == 1 else []
+        return self.host.generate(self, conversation)
+
+    def generate_response(self, conversation):
+        # Runs on a worker thread
+        if not self.stream:
+            return ai_call(conversation, self.prompt, self.name)
+        chunks = []
+        for chunk in sentence_chunks(
+            ai_call_stream(conversation, self.prompt, self.name)
+        ):
+            chunks.append(chunk)
+            self.host.call_soon(self.send_frame, MSG_PARTIAL, chunk)
+        return " ".join(chunks)
+
+    def send_response(self, ai_response):
+        if self.send_frame(MSG_CHAT, ai_response):
+            self.conversation_log.append(self.name, ai_response)
+
+    def send_frame(self, msg_type, text):
+        if self.writer is None or self.writer.is_closing():
+            return False
+        self.writer.write(encode_frame(msg_type, b"", text))
+        return True
+
+
+class BotHost:
+    """
+    Runs many AI personas in one process and one event loop. The personas
+    share the model client (and its HTTP connection pool), the tokenizer, and
+    a bounded pool of generation workers, while each appears to the server as
+    a separate chat participant.
+    """
+
+    def __init__(
+        self,
+        personas,
+        server_host="localhost",
+        server_port=8000,
+        concurrency=DEFAULT_CONCURRENCY,
+        retry_delay=1,
+        rate_per_min=None,
+        burst=1,
+    ):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.retry_delay = retry_delay
+        self.generation_pool = GenerationPool(concurrency)
+        # Host-wide generation limit, shared by every persona
+        if rate_per_min:
+            self.bucket = TokenBucket(rate_per_min / 60, burst)
+        else:
+            self.bucket = bucket_from_env("AI_HOST")
+        self.stats = GenerationStats(provider_rpm_from_env())
+        self.finished = False
+        self.loop = None
+        self.timers = []
+        self.personas = [Persona(self, **persona) for persona in personas]
+
+    @classmethod
+    def from_config(cls, path):
+        """
+        Loads a JSON config: {"server": {"host", "port"}, "concurrency",
+        "rate_per_min", "burst", "personas": [{"name", "mode", "n", "prompt",
+        "stream", "jitter", "rate_per_min", "burst", "room", "count"}]}.
+        A persona with a count is repeated with numbered names.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        personas = []
+        for persona in config["personas"]:
+            persona = dict(persona)
+            count = persona.pop("count", 1)
+            name = persona.pop("name", None) or f"AI-{generate_random_string()}"
+            for i in range(count):
+                personas.append(
+                    {"name": f"{name}-{i + 1}" if count > 1 else name, **persona}
+                )
+        server = config.get("server", {})
+        return cls(
+            personas,
+            server.get("host", "localhost"),
+            server.get("port", 8000),
+            config.get("concurrency", DEFAULT_CONCURRENCY),
+            rate_per_min=config.get("rate_per_min"),
+            burst=config.get("burst", 1),
+        )
+
+    def call_soon(self, callback, *args):
+        """Schedules a callback on the host's loop from any thread."""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def generate(self, persona, conversation):
+        return self.generation_pool.submit(
+            persona.name,
+            persona.generate_response,
+            lambda ai_response: self.call_soon(persona.send_response, ai_response),
+            conversation,
+        )
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        print(f"[BOTS] Starting {len(self.personas)} personas")
+        # All periodic speakers share the scheduler's single timer thread
+        scheduler = get_scheduler()
+        self.timers = [
+            scheduler.call_every(
+                persona.n, self.call_soon, persona.speak, jitter=persona.jitter
+            )
+            for persona in self.personas
+            if persona.mode == 2
+        ]
+        try:
+            await asyncio.gather(*(persona.run() for persona in self.personas))
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.finished = True
+        report = self.stats.report()
+        cache = get_response_cache()
+        if cache is not None:
+            report["cache"] = cache.report()
+        print(f"[BOTS] Generation stats: {report}")
+        for timer in self.timers:
+            timer.cancel()
+        self.generation_pool.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python bot_host.py <personas.json>")
+        sys.exit(1)
+    try:
+        asyncio.run(BotHost.from_config(sys.argv[1]).start())
+    except KeyboardInterrupt:
+        pass
@@ -3,12 +3,26 @@ import threading
 import sys
 import time
 
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_DIRECT,
+    MSG_JOIN,
+    MSG_LEAVE,
+    MSG_PARTIAL,
+    MSG_PRESENCE,
+    MSG_ROOMS,
+    MSG_SESSION,
+    FrameDecoderV2,
+    encode_frame,
+    encode_hello,
+)
+from lib.presence import JOINED, LEFT, RESET, apply_presence
+from lib.rooms import DEFAULT_ROOM, parse_room_list
 from lib.utils import (
-    deserialize_message,
+    color_message,
+    get_color_from_name,
     sender_colored_message,
-    encode_message,
     generate_random_string,
-    receive_message,
 )
 
 
@@ -20,6 +34,7 @@ class Client:
         max_retries=5,
         retry_delay=1,
         name=None,
+        room=None,
     ):
         self.server_host = server_host
         self.server_port = server_port
@@ -28,10 +43,22 @@ class Client:
         self.client_socket = None
         self.connected = False
         self.finished = False
+        # Senders whose message is currently arriving as partial frames
+        self.streaming_senders = set()
+        # Sent back on reconnect, so the server only replays what was missed
+        self.session_token = b""
+        self.last_seq = 0
         if len(sys.argv) > 1:
             self.client_name = sys.argv[1]
         else:
             self.client_name = name or f"user-{generate_random_string()}"
+        # Who else is in the room, kept up to date by presence frames
+        self.present = set()
+        # The room to (re)join on connect; updated by the server's MSG_JOIN
+        if len(sys.argv) > 2:
+            self.room = sys.argv[2]
+        else:
+            self.room = room or DEFAULT_ROOM
 
     def connect(self):
         retries = 0
@@ -40,6 +67,7 @@ class Client:
                 self.connected = True
                 self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.client_socket.connect((self.server_host, self.server_port))
+                self.decoder = FrameDecoderV2()
                 print(f"[CLIENT] Connected to {self.server_host}:{self.server_port}")
                 break
             except Exception as e:
@@ -55,7 +83,9 @@ class Client:
                     return
 
     def register(self):
-        self.client_socket.sendall(encode_message(self.client_name))
+        self.client_socket.sendall(
+            encode_hello(self.client_name, self.session_token, self.last_seq, self.room)
+        )
         time.sleep(0.1)
         self.receive_thread = threading.Thread(target=self.receive_messages)
         time.sleep(0.1)
@@ -83,17 +113,90 @@ class Client:
         self.finished = True
 
     def receive_message(self):
-        message = receive_message(self.client_socket)
-        if message is False:
+        frames = self.decoder.receive(self.client_socket)
+        if frames is False:
             print("[CLIENT] Connection closed by the server")
             self.reset_connection()
+            return
+        for frame in frames:
+            if not self.track_session(frame):
+                self.print_frame(frame)
+
+    def track_session(self, frame):
+        """
+        Remembers the session token, the current room and the last sequence
+        number received. Returns True for session frames, which are not shown.
+        """
+        if frame.type == MSG_SESSION:
+            self.session_token = frame.body
+        elif frame.type == MSG_JOIN:
+            self.room = frame.text
+        self.last_seq = max(self.last_seq, frame.seq)
+        return frame.type == MSG_SESSION
+
+    def print_frame(self, frame):
+        sender_name = frame.sender_name
+        if frame.type == MSG_JOIN:
+            print(sender_colored_message(sender_name, f"You joined #{frame.text}"))
+        elif frame.type == MSG_PRESENCE:
+            self.print_presence(frame.text)
+        elif frame.type == MSG_DIRECT:
+            print(sender_colored_message(f"{sender_name} (direct)", frame.text))
+        elif frame.type == MSG_ROOMS:
+            rooms = ", ".join(
+                f"#{name} ({members})" for name, members in parse_room_list(frame.text)
+            )
+            print(sender_colored_message(sender_name, f"Rooms: {rooms}"))
+        elif frame.type == MSG_PARTIAL:
+            if sender_name in self.streaming_senders:
+                # Continuation lines are indented under the sender's name
+                indent = " " * (len(sender_name) + 2)
+                color = get_color_from_name(sender_name)
+                print(color_message(indent + frame.text, color))
+            else:
+                self.streaming_senders.add(sender_name)
+                print(sender_colored_message(sender_name, frame.text))
+        elif sender_name in self.streaming_senders:
+            # The complete message was already shown chunk by chunk
+            self.streaming_senders.discard(sender_name)
         else:
-            print(sender_colored_message(*deserialize_message(message)))
+            print(sender_colored_message(sender_name, frame.text))
+
+    def print_presence(self, text):
+        # A snapshot replaces the list silently; changes are shown
+        if not text.startswith(RESET):
+            for line in text.splitlines():
+                name = line[1:]
+                if line.startswith(JOINED) and name not in self.present:
+                    print(color_message(f"* {name} joined", get_color_from_name(name)))
+                elif line.startswith(LEFT) and name in self.present:
+                    print(color_message(f"* {name} left", get_color_from_name(name)))
+        apply_presence(self.present, text)
 
     def send_message(self):
         message = input()
-        if message:
-            self.client_socket.sendall(encode_message(message))
+        if message == "/who":
+            print(f"In #{self.room}: {', '.join(sorted(self.present))}")
+        elif message:
+            self.client_socket.sendall(self.encode_message(message))
+
+    def encode_message(self, message):
+        """
+        Encodes a line typed by the user: a chat message, or one of the room
+        commands /join <room>, /leave and /rooms, or a direct message with
+        /msg <name> <text>.
+        """
+        command, _, argument = message.partition(" ")
+        if command == "/join" and argument.strip():
+            return encode_frame(MSG_JOIN, b"", argument.strip())
+        if command == "/leave":
+            return encode_frame(MSG_LEAVE, b"", b"")
+        if command == "/rooms":
+            return encode_frame(MSG_ROOMS, b"", b"")
+        recipient, _, text = argument.partition(" ")
+        if command == "/msg" and recipient and text:
+            return encode_frame(MSG_DIRECT, recipient, text)
+        return encode_frame(MSG_CHAT, b"", message)
 
     def send_messages(self):
         self.retriable_loop(self.send_message, "send_messages")
@@ -1,6 +1,9 @@
+import re
+from functools import lru_cache
 from openai import OpenAI
 import tiktoken
 from lib.config import get_env_var
+from lib.response_cache import cache_key, get_response_cache_from_env
 from lib.utils import deserialize_message
 
 OPENAI_API_KEY = get_env_var("OPENAI_API_KEY")
@@ -9,19 +12,63 @@ MODEL_NAME = "gpt-3.5-turbo-0613"
 MODEL_MAX_INPUT_TOKENS = 4096
 MAX_TOKENS_TO_GENERATE = 100
 MODEL_TEMPERATURE = 0.7
+TOKEN_CACHE_SIZE = 8192
+AI_ERROR_RESPONSE = "I had something to say but encountered a technical issue."
+# End of a sentence: terminal punctuation followed by whitespace, or a newline
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+|\n+")
 
 client = None
+response_cache = get_response_cache_from_env()
+
+
+def create_openai_backend():
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+    )
+
+
+def create_fake_backend():
+    from lib.fake_openai import FakeOpenAI
+
+    return FakeOpenAI.from_env()
+
+
+# Model backends: factories for objects exposing `chat.completions.create`
+AI_BACKENDS = {
+    "openai": create_openai_backend,
+    "fake": create_fake_backend,
+}
 
 
 def get_openai_client():
     global client
     if client is None:
-        client = OpenAI(
-            api_key=OPENAI_API_KEY,
-        )
+        backend = get_env_var("AI_BACKEND", "openai")
+        if backend not in AI_BACKENDS:
+            raise ValueError(
+                f"Unknown AI backend: {backend} (expected one of {', '.join(AI_BACKENDS)})"
+            )
+        client = AI_BACKENDS[backend]()
     return client
 
 
+def set_ai_backend(backend):
+    """Replaces the model backend used by ai_call, e.g. with a FakeOpenAI."""
+    global client
+    client = backend
+
+
+def set_response_cache(cache):
+    """Sets the ResponseCache used by ai_call (None disables caching)."""
+    global response_cache
+    response_cache = cache
+
+
+def get_response_cache():
+    """Returns the ResponseCache used by ai_call, or None."""
+    return response_cache
+
+
 def wrap_system_message(text):
     return {
         "role": "system",
@@ -39,34 +86,75 @@ def to_openai_message(msg, self_name):
     return m
 
 
-# NOTE: Calculation based on "gpt-3.5-turbo-0613"- future models may deviate from this
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
-    """Returns the number of tokens used by a list of messages."""
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Loads the tokenizer for a model once and keeps it for later calls."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
 
-    num_tokens = 0
-    for message in messages:
-        num_tokens += (
-            4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-        )
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":  # if there's a name, the role is omitted
-                num_tokens += -1  # role is always required and always 1 token
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _num_tokens_from_items(items, model):
+    encoding = get_encoding(model)
+    num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+    for key, value in items:
+        num_tokens += len(encoding.encode(value))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
+
+
+def num_tokens_from_message(message, model="gpt-3.5-turbo-0613"):
+    """Returns the number of tokens used by a single message, cached per content."""
+    return _num_tokens_from_items(tuple(message.items()), model)
+
+
+# NOTE: Calculation based on "gpt-3.5-turbo-0613"- future models may deviate from this
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
+    """Returns the number of tokens used by a list of messages."""
+    num_tokens = sum(num_tokens_from_message(message, model) for message in messages)
     num_tokens += 2  # every reply is primed with <im_start>assistant
     return num_tokens
 
 
 def limit_tokens(messages, system_message, max_tokens):
-    """Limits the number of tokens used by a list of messages."""
-    full_prompt = [system_message, *messages]
-    if num_tokens_from_messages(full_prompt) <= max_tokens:
-        return messages
+    """
+    Limits the number of tokens used by a list of messages, dropping the oldest
+    ones first. Walks back from the newest message and stops at the first one
+    that no longer fits, so only the kept tail is counted.
+    """
+    budget = max_tokens - num_tokens_from_messages([system_message])
+    start = len(messages)
+    while start > 0:
+        cost = num_tokens_from_message(messages[start - 1])
+        if cost > budget:
+            break
+        budget -= cost
+        start -= 1
+    return messages[start:]
+
+
+def build_prompt(conversation, system_prompt, bot_name="AI"):
+    """
+    Returns the system message followed by the most recent conversation
+    messages that fit in the model's input window.
+    """
+    system_message = wrap_system_message(system_prompt)
+
+    if hasattr(conversation, "tail"):
+        # A ConversationLog already holds converted messages and their counts
+        capped_messages = conversation.tail(
+            MODEL_MAX_INPUT_TOKENS - num_tokens_from_messages([system_message])
+        )
     else:
-        return limit_tokens(messages[1:], system_message, max_tokens)
+        capped_messages = limit_tokens(
+            list(map(lambda msg: to_openai_message(msg, bot_name), conversation)),
+            system_message,
+            MODEL_MAX_INPUT_TOKENS,
+        )
+    return [system_message, *capped_messages]
 
 
 def ai_call(conversation, system_prompt, bot_name="AI"):
@@ -74,7 +162,7 @@ def ai_call(conversation, system_prompt, bot_name="AI"):
     This function makes a call to the AI model to generate a response based on the provided conversation.
 
     Parameters:
-    conversation (list): A list of conversation messages to be processed by the AI. Each message is a string in the format "sender: message".
+    conversation (list | ConversationLog): A list of conversation messages to be processed by the AI. Each message is a string in the format "sender: message".
     system_prompt (str): The system prompt to be used for the AI model.
 
 
@@ -87,22 +175,82 @@ def ai_call(conversation, system_prompt, bot_name="AI"):
     #     conversation,
     #     system_prompt,
     # )
-    system_message = wrap_system_message(system_prompt)
+    messages = build_prompt(conversation, system_prompt, bot_name)
 
-    capped_messages = limit_tokens(
-        list(map(lambda msg: to_openai_message(msg, bot_name), conversation)),
-        system_message,
-        MODEL_MAX_INPUT_TOKENS,
-    )
+    cache = response_cache
+    if cache is not None:
+        key = cache_key(MODEL_NAME, messages, MODEL_TEMPERATURE)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
 
     try:
         response = get_openai_client().chat.completions.create(
             model=MODEL_NAME,
-            messages=[system_message, *capped_messages],
+            messages=messages,
             temperature=MODEL_TEMPERATURE,
             max_tokens=MAX_TOKENS_TO_GENERATE,
         )
     except Exception as e:
         print("ai_call: Error calling OpenAI: ", e)
-        return "I had something to say but encountered a technical issue."
-    return response.choices[0].message.content
+        return AI_ERROR_RESPONSE
+    content = response.choices[0].message.content
+    if cache is not None:
+        cache.put(key, content)
+    return content
+
+
+def ai_call_stream(conversation, system_prompt, bot_name="AI"):
+    """
+    Streaming variant of ai_call. Yields the response text in the pieces the
+    model streams them, as soon as each one arrives.
+    """
+    messages = build_prompt(conversation, system_prompt, bot_name)
+
+    cache = response_cache
+    if cache is not None:
+        key = cache_key(MODEL_NAME, messages, MODEL_TEMPERATURE)
+        cached = cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    pieces = []
+    try:
+        stream = get_openai_client().chat.completions.create(
+            model=MODEL_NAME,
+            messages=messages,
+            temperature=MODEL_TEMPERATURE,
+            max_tokens=MAX_TOKENS_TO_GENERATE,
+            stream=True,
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                pieces.append(content)
+                yield content
+    except Exception as e:
+        print("ai_call_stream: Error calling OpenAI: ", e)
+        yield AI_ERROR_RESPONSE
+        return
+    if cache is not None:
+        cache.put(key, "".join(pieces))
+
+
+def sentence_chunks(pieces):
+    """
+    Regroups streamed text pieces into sentence-sized chunks, so partial
+    output is sent to the room a sentence at a time rather than per token.
+    """
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        match = SENTENCE_END.search(buffer)
+        while match:
+            yield buffer[: match.end()].strip()
+            buffer = buffer[match.end() :]
+            match = SENTENCE_END.search(buffer)
+    if buffer.strip():
+        yield buffer.strip()
@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+import signal
+import socket
+
+from lib.config import get_env_var
+
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
+
+
+class SharedSequence:
+    """
+    Sequence counter in shared memory, so frames get one global order no
+    matter which worker process stamps them.
+    """
+
+    def __init__(self, start=0, context=None):
+        context = context or multiprocessing
+        self.value = context.Value("Q", start)
+
+    def next(self):
+        with self.value.get_lock():
+            self.value.value += 1
+            return self.value.value
+
+    def advance(self, seq):
+        """Makes sure the next sequence number is past seq."""
+        with self.value.get_lock():
+            if self.value.value < seq:
+                self.value.value = seq
+
+
+def bus_sockets(workers):
+    """
+    Connects every pair of workers with a Unix socket pair. Returns, for each
+    worker, its ends of the pairs.
+    """
+    ends = [[] for _ in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            ends[i].append(left)
+            ends[j].append(right)
+    return ends
+
+
+class Cluster:
+    """
+    Forks `workers` processes that each run target(index, peers, sequence).
+    The workers share the listening port through SO_REUSEPORT, so the kernel
+    spreads connections across them; `peers` are the worker's bus sockets to
+    every other worker.
+    """
+
+    def __init__(self, workers, target):
+        if not HAS_REUSEPORT:
+            raise RuntimeError("Cluster mode needs SO_REUSEPORT")
+        self.workers = workers
+        self.target = target
+        self.context = multiprocessing.get_context("fork")
+        self.processes = []
+
+    def run(self, start_seq=0):
+        sequence = SharedSequence(start_seq, self.context)
+        ends = bus_sockets(self.workers)
+        for index in range(self.workers):
+            process = self.context.Process(
+                target=self.run_worker, args=(index, ends, sequence), daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+        # Only the workers use the bus
+        for peers in ends:
+            for peer in peers:
+                peer.close()
+        print(f"[CLUSTER] Started {self.workers} workers")
+        try:
+            for process in self.processes:
+                process.join()
+        finally:
+            self.stop()
+
+    def run_worker(self, index, ends, sequence):
+        for other, peers in enumerate(ends):
+            if other != index:
+                for peer in peers:
+                    peer.close()
+        self.target(index, ends[index], sequence)
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+
+
+def get_cluster_workers():
+    return int(get_env_var("SERVER_WORKERS", 1))
@@ -3,6 +3,10 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Default for settings that are read from the environment unless given, where
+# None is a meaningful value of its own (such as "no message log")
+FROM_ENV = object()
+
 
 def get_env_var(var_name, default_val=None):
     return os.getenv(var_name, default_val)
@@ -0,0 +1,306 @@
+import os
+import socket
+import time
+from collections import deque
+from itertools import islice
+
+from lib.config import get_env_var
+from lib.protocol import MSG_SYSTEM, Frame, NegotiatingDecoder, now_ms
+from lib.utils import SYSTEM_SENDER_NAME
+
+# Handshake states: a connection is ACCEPTED, then AWAITING_NAME once it is
+# watched by the poller, and REGISTERED after its name frame was parsed.
+ACCEPTED = "accepted"
+AWAITING_NAME = "awaiting_name"
+REGISTERED = "registered"
+# Bus connections to the other workers of a cluster
+PEER = "peer"
+# Relay links to other nodes of a federation
+NODE = "node"
+
+# Slow-consumer policies, applied when a send queue is full
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, DISCONNECT)
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+HAS_SENDFILE = hasattr(os, "sendfile")
+
+
+class FileRange:
+    """
+    A byte range of an open file, queued for sending like an encoded frame.
+    It is sent with os.sendfile, so the bytes never pass through user space.
+    """
+
+    __slots__ = ("fd", "offset", "count")
+
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def send(self, sock):
+        if HAS_SENDFILE:
+            sent = os.sendfile(sock.fileno(), self.fd, self.offset, self.count)
+        else:
+            sent = sock.send(os.pread(self.fd, min(self.count, 1 << 16), self.offset))
+        if not sent:
+            raise OSError("File range is past the end of the file")
+        return sent
+
+    def advance(self, sent):
+        self.offset += sent
+        self.count -= sent
+
+    def close(self):
+        os.close(self.fd)
+
+
+class QueueLimits:
+    """
+    Caps on a connection's pending outbound data, shared by all connections
+    of a server.
+    """
+
+    __slots__ = ("max_bytes", "max_messages", "policy", "grace")
+
+    def __init__(
+        self, max_bytes=1 << 20, max_messages=1000, policy=DROP_OLDEST, grace=5
+    ):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(
+                f"Unknown slow consumer policy: {policy} "
+                f"(expected one of {', '.join(SLOW_CONSUMER_POLICIES)})"
+            )
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+        self.grace = grace
+
+
+def get_queue_limits():
+    defaults = QueueLimits()
+    return QueueLimits(
+        int(get_env_var("SEND_QUEUE_MAX_BYTES", defaults.max_bytes)),
+        int(get_env_var("SEND_QUEUE_MAX_MESSAGES", defaults.max_messages)),
+        get_env_var("SLOW_CONSUMER_POLICY", defaults.policy),
+        float(get_env_var("SLOW_CONSUMER_GRACE", defaults.grace)),
+    )
+
+
+class Connection:
+    """
+    Server-side state of a single client socket, including its outbound
+    buffer. Broadcasts only append to the buffer; the server's loop flushes it
+    once per tick, writing every queued frame with a single sendmsg.
+    """
+
+    __slots__ = (
+        "sock",
+        "address",
+        "name",
+        "sender",
+        "state",
+        "accepted_at",
+        "decoder",
+        "outbound",
+        "pending_bytes",
+        "head_sent",
+        "limits",
+        "over_limit_since",
+        "dropped_messages",
+        "file_ranges",
+        "session",
+        "room",
+        "flood",
+    )
+
+    def __init__(self, sock, address, name=None, accepted_at=0, limits=None):
+        self.sock = sock
+        self.address = address
+        self.name = name
+        self.sender = b""
+        self.state = ACCEPTED
+        self.accepted_at = accepted_at
+        self.decoder = NegotiatingDecoder()
+        self.outbound = deque()
+        self.pending_bytes = 0
+        # Whether the first queued frame was partially sent (and so can't be
+        # dropped without corrupting the stream)
+        self.head_sent = False
+        self.limits = limits
+        self.over_limit_since = None
+        self.dropped_messages = 0
+        # Number of FileRanges in the outbound buffer
+        self.file_ranges = 0
+        # Session token of a v2 client
+        self.session = None
+        # The Room a registered client is in
+        self.room = None
+        # FloodGuard limiting how fast a client can send, if any
+        self.flood = None
+
+    @property
+    def version(self):
+        """
+        Protocol version negotiated from the first bytes the client sent.
+        """
+        return self.decoder.version
+
+    def fits(self, size):
+        limits = self.limits
+        return limits is None or (
+            self.pending_bytes + size <= limits.max_bytes
+            and len(self.outbound) < limits.max_messages
+        )
+
+    def enqueue(self, data):
+        """
+        Queues an encoded frame for sending. The same bytes object can be
+        shared by every recipient of a broadcast. When the queue is full the
+        slow-consumer policy decides what gets dropped. Returns False if the
+        frame itself was dropped.
+        """
+        if self.fits(len(data)):
+            self.append(data)
+            return True
+
+        policy = self.limits.policy
+        if policy == DROP_OLDEST:
+            while not self.fits(len(data)) and self.drop_queued():
+                self.dropped_messages += 1
+        elif policy == COALESCE:
+            skipped = 0
+            while self.drop_queued():
+                skipped += 1
+            self.dropped_messages += skipped
+            if skipped:
+                # Replace the skipped backlog with a single notice
+                self.append(self.skipped_notice(skipped))
+        elif policy == DISCONNECT and self.over_limit_since is None:
+            self.over_limit_since = time.monotonic()
+
+        if policy in (DROP_OLDEST, COALESCE) and self.fits(len(data)):
+            self.append(data)
+            return True
+        self.dropped_messages += 1
+        return False
+
+    def append(self, data):
+        self.outbound.append(data)
+        self.pending_bytes += len(data)
+
+    def append_file(self, file_range):
+        """
+        Queues a FileRange, bypassing the queue limits: it is sent in order
+        with the frames around it. The queued range reads from a duplicate of
+        the file descriptor, closed once it is sent or dropped, so the file
+        can be closed meanwhile.
+        """
+        if file_range.count:
+            fd = os.dup(file_range.fd)
+            self.append(FileRange(fd, file_range.offset, file_range.count))
+            self.file_ranges += 1
+
+    def drop_queued(self):
+        """
+        Drops the oldest frame that was not partially sent yet. Returns False
+        if there is none.
+        """
+        index = 1 if self.head_sent else 0
+        if len(self.outbound) <= index:
+            return False
+        chunk = self.outbound[index]
+        del self.outbound[index]
+        self.pending_bytes -= len(chunk)
+        if isinstance(chunk, FileRange):
+            self.file_ranges -= 1
+            chunk.close()
+        return True
+
+    def close_files(self):
+        """
+        Closes the file descriptors of the queued FileRanges, when the
+        connection is closed with them unsent.
+        """
+        if self.file_ranges:
+            for chunk in self.outbound:
+                if isinstance(chunk, FileRange):
+                    chunk.close()
+            self.file_ranges = 0
+
+    def skipped_notice(self, skipped):
+        notice = Frame(
+            MSG_SYSTEM,
+            SYSTEM_SENDER_NAME,
+            f"{skipped} messages were skipped because you are reading too slowly",
+            timestamp=now_ms(),
+        )
+        return notice.encode(self.version)
+
+    def has_pending(self):
+        return bool(self.outbound)
+
+    def flush(self):
+        """
+        Sends as much of the outbound buffer as the socket accepts without
+        blocking, gathering up to IOV_MAX queued frames per syscall (and
+        sending queued FileRanges with sendfile). Returns True when the buffer
+        has been fully drained.
+        """
+        outbound = self.outbound
+        try:
+            while outbound:
+                try:
+                    sent = self.send_some()
+                except (BlockingIOError, InterruptedError):
+                    return False
+                self.pending_bytes -= sent
+                while sent:
+                    chunk = outbound[0]
+                    if sent < len(chunk):
+                        # Keep the unsent tail without copying the remaining bytes
+                        if isinstance(chunk, FileRange):
+                            chunk.advance(sent)
+                        else:
+                            outbound[0] = memoryview(chunk)[sent:]
+                        self.head_sent = True
+                        return False
+                    sent -= len(chunk)
+                    outbound.popleft()
+                    self.head_sent = False
+                    if self.file_ranges and isinstance(chunk, FileRange):
+                        self.file_ranges -= 1
+                        chunk.close()
+            return True
+        finally:
+            if self.over_limit_since is not None and self.fits(0):
+                self.over_limit_since = None
+
+    def send_some(self):
+        outbound = self.outbound
+        if self.file_ranges:
+            if isinstance(outbound[0], FileRange):
+                return outbound[0].send(self.sock)
+            buffers = []
+            for chunk in islice(outbound, IOV_MAX):
+                if isinstance(chunk, FileRange):
+                    break
+                buffers.append(chunk)
+        elif HAS_SENDMSG:
+            buffers = list(islice(outbound, IOV_MAX))
+        else:
+            return self.sock.send(outbound[0])
+        if HAS_SENDMSG:
+            return self.sock.sendmsg(buffers)
+        return self.sock.send(buffers[0])
@@ -0,0 +1,78 @@
+import threading
+from collections import deque
+
+from lib.ai_utils import MODEL_MAX_INPUT_TOKENS, num_tokens_from_message
+
+DEFAULT_MAX_MESSAGES = 1000
+
+
+class ConversationRecord:
+    __slots__ = ("sender", "content", "message", "tokens")
+
+    def __init__(self, sender, content, message, tokens):
+        self.sender = sender
+        self.content = content
+        self.message = message
+        self.tokens = tokens
+
+
+class ConversationLog:
+    """
+    Bounded conversation history of an AI participant. Each message is parsed
+    and converted to the OpenAI format once, with its token count, and the
+    oldest messages are evicted past the message or token cap.
+    """
+
+    def __init__(
+        self,
+        self_name,
+        max_messages=DEFAULT_MAX_MESSAGES,
+        max_tokens=MODEL_MAX_INPUT_TOKENS,
+    ):
+        self.self_name = self_name
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.records = deque()
+        self.total_tokens = 0
+        # The receive and send threads of an AIClient both append
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def append(self, sender, content):
+        message = {
+            "role": "assistant" if sender == self.self_name else "user",
+            "content": content,
+            "name": sender,
+        }
+        record = ConversationRecord(
+            sender, content, message, num_tokens_from_message(message)
+        )
+        with self.lock:
+            records = self.records
+            records.append(record)
+            self.total_tokens += record.tokens
+            while len(records) > 1 and (
+                len(records) > self.max_messages or self.total_tokens > self.max_tokens
+            ):
+                self.total_tokens -= records.popleft().tokens
+        return record
+
+    def tail(self, max_tokens):
+        """
+        Returns the OpenAI messages of the longest recent tail that fits in
+        max_tokens, oldest first.
+        """
+        messages = []
+        with self.lock:
+            for record in reversed(self.records):
+                if record.tokens > max_tokens:
+                    break
+                max_tokens -= record.tokens
+                messages.append(record.message)
+        messages.reverse()
+        return messages
@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from lib.config import get_env_var
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+WORDS = (
+    "the chat is lively today and everyone has something to say about it "
+    "what a joyful room full of friendly people sharing random thoughts"
+).split()
+
+
+class FakeAIError(Exception):
+    pass
+
+
+class FakeOpenAI:
+    """
+    In-process stand-in for the OpenAI client, exposing the same
+    `chat.completions.create` call. Latency, token rate and errors are
+    simulated locally, so the AI path can be exercised and benchmarked without
+    network access.
+
+    latency: mean time to the first token, in seconds
+    distribution: how the time to first token varies around the mean
+    tokens_per_sec: generation speed after the first token (0 for instant)
+    error_rate: probability that a call raises FakeAIError
+    """
+
+    def __init__(
+        self,
+        latency=0.5,
+        distribution="fixed",
+        tokens_per_sec=50,
+        error_rate=0,
+        seed=None,
+    ):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Unknown latency distribution: {distribution} "
+                f"(expected one of {', '.join(LATENCY_DISTRIBUTIONS)})"
+            )
+        self.latency = latency
+        self.distribution = distribution
+        self.tokens_per_sec = tokens_per_sec
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "errors": 0, "tokens": 0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @classmethod
+    def from_env(cls):
+        seed = get_env_var("FAKE_AI_SEED")
+        return cls(
+            latency=float(get_env_var("FAKE_AI_LATENCY", 0.5)),
+            distribution=get_env_var("FAKE_AI_LATENCY_DISTRIBUTION", "fixed"),
+            tokens_per_sec=float(get_env_var("FAKE_AI_TOKENS_PER_SEC", 50)),
+            error_rate=float(get_env_var("FAKE_AI_ERROR_RATE", 0)),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def sample_latency(self):
+        with self.lock:
+            if self.distribution == "uniform":
+                return self.random.uniform(0, 2 * self.latency)
+            if self.distribution == "exponential":
+                return self.random.expovariate(1 / self.latency) if self.latency else 0
+            if self.distribution == "lognormal":
+                return self.random.lognormvariate(0, 0.5) * self.latency
+            return self.latency
+
+    def make_tokens(self, messages, max_tokens):
+        """
+        Builds a response of max_tokens words, seeded by the last message so
+        the same prompt gets the same answer.
+        """
+        seed = messages[-1]["content"] if messages else ""
+        rng = random.Random(seed)
+        words = [rng.choice(WORDS) for _ in range(max_tokens)]
+        words[-1] += "."
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def create(self, model, messages, max_tokens=16, stream=False, **kwargs):
+        with self.lock:
+            self.stats["calls"] += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.stats["errors"] += 1
+        time.sleep(self.sample_latency())
+        if failed:
+            raise FakeAIError("Injected fake AI error")
+
+        tokens = self.make_tokens(messages, max_tokens)
+        with self.lock:
+            self.stats["tokens"] += len(tokens)
+        if stream:
+            return self.stream_tokens(model, tokens)
+
+        if self.tokens_per_sec:
+            time.sleep(len(tokens) / self.tokens_per_sec)
+        message = SimpleNamespace(role="assistant", content="".join(tokens))
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+            usage=SimpleNamespace(completion_tokens=len(tokens)),
+        )
+
+    def stream_tokens(self, model, tokens):
+        for token in tokens:
+            if self.tokens_per_sec:
+                time.sleep(1 / self.tokens_per_sec)
+            delta = SimpleNamespace(role="assistant", content=token)
+            yield SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)],
+            )
@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.config import get_env_var
+
+DEFAULT_CONCURRENCY = int(get_env_var("AI_CONCURRENCY", 2))
+
+
+class GenerationPool:
+    """
+    Runs AI generations on a bounded pool of worker threads, so the caller
+    (usually a socket receive loop) never waits for the model. Jobs are keyed,
+    typically by bot name: a job that hasn't started yet is superseded by a
+    newer job for the same key, since the newer one will see fresher context.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="ai-worker"
+        )
+        self.lock = threading.Lock()
+        self.generation = 0
+        # key -> (generation, future) of the job waiting for a worker
+        self.pending = {}
+        self.stats = {"submitted": 0, "superseded": 0, "completed": 0, "failed": 0}
+
+    def submit(self, key, func, on_result, *args):
+        """
+        Schedules func(*args) and calls on_result with its return value, from
+        the worker thread. Returns the future of the job.
+        """
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            previous = self.pending.pop(key, None)
+            if previous is not None and previous[1].cancel():
+                self.stats["superseded"] += 1
+            future = self.executor.submit(
+                self.run, key, generation, func, on_result, args
+            )
+            self.pending[key] = (generation, future)
+            self.stats["submitted"] += 1
+        return future
+
+    def run(self, key, generation, func, on_result, args):
+        with self.lock:
+            if self.pending.get(key, (None,))[0] == generation:
+                del self.pending[key]
+        try:
+            result = func(*args)
+            on_result(result)
+        except Exception as e:
+            print(f"[AI] Generation failed: {e}")
+            with self.lock:
+                self.stats["failed"] += 1
+            return
+        with self.lock:
+            self.stats["completed"] += 1
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,314 @@
+import mmap
+import os
+import struct
+from bisect import bisect_right
+from collections import deque
+
+from lib.config import get_env_var
+from lib.connection import FileRange
+from lib.protocol import HEADER, PROTOCOL_VERSION, FrameDecoderV2, now_ms
+
+# Sparse index entries: sequence number, timestamp (ms), position in the segment
+INDEX_ENTRY = struct.Struct("!QQQ")
+
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".index"
+
+
+class Segment:
+    """
+    One file of the log, named after the sequence number of its first frame,
+    plus its sparse index. Frames are stored in their v2 encoding, so they can
+    be sent to v2 clients straight from the file.
+    """
+
+    def __init__(self, directory, base_seq):
+        name = f"{base_seq:020d}"
+        self.base_seq = base_seq
+        self.path = os.path.join(directory, name + SEGMENT_SUFFIX)
+        self.index_path = os.path.join(directory, name + INDEX_SUFFIX)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(
+            self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        self.size = os.fstat(self.fd).st_size
+        self.mmap = None
+        self.mapped_size = 0
+        # The index, as parallel lists for bisecting
+        self.seqs = []
+        self.timestamps = []
+        self.positions = []
+        self.indexed_at = -1
+        self.last_seq = base_seq - 1
+        self.last_timestamp = 0
+        self.load_index()
+        self.recover()
+
+    def load_index(self):
+        data = os.pread(self.index_fd, os.fstat(self.index_fd).st_size, 0)
+        # Drop a torn trailing entry, and entries past the end of the segment
+        whole = len(data) - len(data) % INDEX_ENTRY.size
+        for seq, timestamp, position in INDEX_ENTRY.iter_unpack(data[:whole]):
+            if position >= self.size:
+                break
+            self.seqs.append(seq)
+            self.timestamps.append(timestamp)
+            self.positions.append(position)
+        self.indexed_at = self.positions[-1] if self.positions else -1
+        if len(self.positions) * INDEX_ENTRY.size != len(data):
+            os.ftruncate(self.index_fd, len(self.positions) * INDEX_ENTRY.size)
+
+    def recover(self):
+        """
+        Finds the last complete frame by scanning from the last index entry,
+        and truncates a frame torn by a crash.
+        """
+        end = self.positions[-1] if self.positions else 0
+        for seq, timestamp, _, frame_end in self.scan(end):
+            self.last_seq = seq
+            self.last_timestamp = timestamp
+            end = frame_end
+        if end != self.size:
+            os.ftruncate(self.fd, end)
+            self.size = end
+
+    def view(self):
+        if self.mapped_size != self.size:
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+            self.mapped_size = self.size
+        return self.mmap
+
+    def scan(self, position, end=None):
+        """
+        Yields (seq, timestamp, position, end) of the frames from position on.
+        """
+        if not self.size:
+            return
+        view = self.view()
+        end = self.mapped_size if end is None else end
+        while position + HEADER.size <= end:
+            _, _, sender_length, body_length, seq, timestamp = HEADER.unpack_from(
+                view, position
+            )
+            frame_end = position + HEADER.size + sender_length + body_length
+            if frame_end > end:
+                return
+            yield seq, timestamp, position, frame_end
+            position = frame_end
+
+    def index(self, seq, timestamp, position):
+        self.seqs.append(seq)
+        self.timestamps.append(timestamp)
+        self.positions.append(position)
+        self.indexed_at = position
+        return INDEX_ENTRY.pack(seq, timestamp, position)
+
+    def find(self, min_seq, min_timestamp):
+        """
+        Position of the first frame with seq >= min_seq and timestamp >=
+        min_timestamp, or None if there is none in this segment.
+        """
+        i = max(
+            bisect_right(self.seqs, min_seq - 1),
+            bisect_right(self.timestamps, min_timestamp - 1),
+        )
+        start = self.positions[i - 1] if i else 0
+        for seq, timestamp, position, _ in self.scan(start):
+            if seq >= min_seq and timestamp >= min_timestamp:
+                return position
+        return None
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        os.close(self.fd)
+        os.close(self.index_fd)
+        # Closing twice must not close whatever reused the fd numbers
+        self.fd = self.index_fd = None
+
+
+class MessageLog:
+    """
+    Append-only on-disk log of broadcast frames, split into segments of about
+    segment_bytes. Every index_interval bytes a frame's sequence number,
+    timestamp and position go to the segment's sparse index, so replaying the
+    tail of the log only scans a few frames.
+
+    Appends are buffered until flush, which the server calls once per tick.
+    Joining clients get the last replay_messages frames, limited to those of
+    the last replay_seconds seconds when that is set.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_bytes=64 << 20,
+        index_interval=4096,
+        replay_messages=50,
+        replay_seconds=None,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.replay_messages = replay_messages
+        self.replay_seconds = replay_seconds
+        os.makedirs(directory, exist_ok=True)
+        base_seqs = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self.segments = [Segment(directory, base_seq) for base_seq in base_seqs]
+        if not self.segments:
+            self.segments.append(Segment(directory, 1))
+        self.pending = []
+        self.pending_index = []
+        self.pending_bytes = 0
+        # Sequence numbers of the newest frames, which need not be contiguous
+        # (a room's log skips the frames of other rooms)
+        self.recent_seqs = deque(maxlen=max(1, replay_messages or 0))
+        self.recent_seqs.extend(self.tail_seqs(self.recent_seqs.maxlen))
+
+    def tail_seqs(self, count):
+        """
+        Sequence numbers of the last `count` frames on disk, found by scanning
+        back one index entry at a time.
+        """
+        seqs = []
+        for segment in reversed(self.segments):
+            end = segment.size
+            starts = segment.positions
+            if not starts or starts[0]:
+                starts = [0] + starts
+            for start in reversed(starts):
+                seqs[:0] = [seq for seq, _, _, _ in segment.scan(start, end)]
+                if len(seqs) >= count:
+                    return seqs[-count:]
+                end = start
+        return seqs
+
+    @property
+    def last_seq(self):
+        return self.segments[-1].last_seq
+
+    def append(self, frame):
+        """
+        Appends a sequenced frame. Its v2 encoding is cached on the frame, so
+        it is shared with the v2 recipients of the broadcast.
+        """
+        data = frame.encode(PROTOCOL_VERSION)
+        segment = self.segments[-1]
+        position = segment.size + self.pending_bytes
+        if position and position + len(data) > self.segment_bytes:
+            self.flush()
+            segment = Segment(self.directory, frame.seq)
+            self.segments.append(segment)
+            position = 0
+        if segment.indexed_at < 0 or position - segment.indexed_at >= (
+            self.index_interval
+        ):
+            self.pending_index.append(
+                segment.index(frame.seq, frame.timestamp, position)
+            )
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        segment.last_seq = frame.seq
+        segment.last_timestamp = frame.timestamp
+        self.recent_seqs.append(frame.seq)
+
+    def flush(self):
+        if not self.pending:
+            return
+        segment = self.segments[-1]
+        write_all(segment.fd, self.pending)
+        segment.size += self.pending_bytes
+        if self.pending_index:
+            write_all(segment.index_fd, self.pending_index)
+        self.pending = []
+        self.pending_index = []
+        self.pending_bytes = 0
+
+    def replay_ranges(self):
+        return self.ranges(self.replay_messages, self.replay_seconds)
+
+    def ranges(self, last_messages=None, seconds=None):
+        """
+        Returns FileRanges covering the last `last_messages` frames, limited
+        to those of the last `seconds` seconds.
+        """
+        self.flush()
+        min_seq = 0
+        if last_messages is not None:
+            if last_messages <= 0:
+                return []
+            recent = self.recent_seqs
+            if last_messages <= len(recent):
+                min_seq = recent[-last_messages]
+            elif len(recent) < recent.maxlen:
+                # The whole log is shorter than that
+                min_seq = 0
+            else:
+                min_seq = self.last_seq - last_messages + 1
+        min_timestamp = 0
+        if seconds is not None:
+            min_timestamp = now_ms() - int(seconds * 1000)
+
+        ranges = []
+        for segment in reversed(self.segments):
+            if segment.last_seq < min_seq or segment.last_timestamp < min_timestamp:
+                break
+            position = segment.find(min_seq, min_timestamp)
+            if position is None:
+                break
+            ranges.append(FileRange(segment.fd, position, segment.size - position))
+            if position:
+                # Earlier segments are older than the replay window
+                break
+        ranges.reverse()
+        return ranges
+
+    def read_frames(self, ranges):
+        """
+        Decodes the frames in the given ranges, for clients that cannot take
+        them as they are stored.
+        """
+        frames = []
+        for file_range in ranges:
+            decoder = FrameDecoderV2(buffer_size=0)
+            frames += decoder.feed(
+                os.pread(file_range.fd, file_range.count, file_range.offset)
+            )
+        return frames
+
+    def close(self):
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+
+
+def write_all(fd, buffers):
+    data = memoryview(b"".join(buffers))
+    while data:
+        data = data[os.write(fd, data) :]
+
+
+def get_message_log_from_env(subdirectory=None):
+    """
+    Opens the log in MESSAGE_LOG_DIR (or the given subdirectory of it), or
+    returns None if it is not set.
+    """
+    directory = get_env_var("MESSAGE_LOG_DIR")
+    if not directory:
+        return None
+    return MessageLog(
+        os.path.join(directory, subdirectory) if subdirectory else directory,
+        int(get_env_var("MESSAGE_LOG_SEGMENT_BYTES", 64 << 20)),
+        int(get_env_var("MESSAGE_LOG_INDEX_INTERVAL", 4096)),
+        int(get_env_var("REPLAY_MESSAGES", 50)),
+        float(get_env_var("REPLAY_SECONDS") or 0) or None,
+    )
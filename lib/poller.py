@@ -0,0 +1,106 @@
+import select
+import selectors
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+class SelectPoller:
+    """
+    Poller backed by select.select. Limited to FD_SETSIZE descriptors and
+    O(n) per call; kept for comparison with the selectors backend.
+    """
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, sock, events=EVENT_READ):
+        self.modify(sock, events)
+
+    def modify(self, sock, events):
+        if events & EVENT_READ:
+            self.readers.add(sock)
+        else:
+            self.readers.discard(sock)
+        if events & EVENT_WRITE:
+            self.writers.add(sock)
+        else:
+            self.writers.discard(sock)
+
+    def unregister(self, sock):
+        self.readers.discard(sock)
+        self.writers.discard(sock)
+
+    def poll(self, timeout=None):
+        """
+        Returns a list of (socket, events) pairs. Sockets in an exceptional
+        condition are reported as readable, so the following recv surfaces the
+        error.
+        """
+        read_sockets, write_sockets, exception_sockets = select.select(
+            self.readers, self.writers, self.readers, timeout
+        )
+        ready = {}
+        for sock in read_sockets:
+            ready[sock] = EVENT_READ
+        for sock in exception_sockets:
+            ready[sock] = EVENT_READ
+        for sock in write_sockets:
+            ready[sock] = ready.get(sock, 0) | EVENT_WRITE
+        return list(ready.items())
+
+    def close(self):
+        self.readers.clear()
+        self.writers.clear()
+
+
+class SelectorsPoller:
+    """
+    Poller backed by the best selector for the platform (epoll on Linux,
+    kqueue on BSD/macOS). Sockets are registered once and cost nothing per
+    call until they become ready.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, sock, events=EVENT_READ):
+        self.selector.register(sock, events)
+
+    def modify(self, sock, events):
+        # A selector can't watch a socket for no events, so a socket that
+        # isn't watched for anything is unregistered until it is again
+        registered = sock in self.selector.get_map()
+        if not events:
+            if registered:
+                self.selector.unregister(sock)
+        elif registered:
+            self.selector.modify(sock, events)
+        else:
+            self.selector.register(sock, events)
+
+    def unregister(self, sock):
+        if sock in self.selector.get_map():
+            self.selector.unregister(sock)
+
+    def poll(self, timeout=None):
+        return [(key.fileobj, events) for key, events in self.selector.select(timeout)]
+
+    def close(self):
+        self.selector.close()
+
+
+POLLERS = {
+    "select": SelectPoller,
+    "selectors": SelectorsPoller,
+}
+
+
+def get_poller(name="selectors"):
+    try:
+        return POLLERS[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown poller backend: {name} (expected one of {', '.join(POLLERS)})"
+        )
@@ -0,0 +1,57 @@
+# Lines of a MSG_PRESENCE body: a name that joined or left the room, and a
+# reset marker that starts a snapshot of the room's members
+JOINED = "+"
+LEFT = "-"
+RESET = "*"
+
+
+class Presence:
+    """
+    The registered clients of a server, by name. Names are unique: a client
+    asking for a name that is taken is given a numbered one instead.
+    """
+
+    def __init__(self):
+        self.by_name = {}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def add(self, connection, name):
+        """
+        Registers a connection and returns the name it was given.
+        """
+        if name in self.by_name:
+            number = 2
+            while f"{name}-{number}" in self.by_name:
+                number += 1
+            name = f"{name}-{number}"
+        self.by_name[name] = connection
+        return name
+
+    def remove(self, connection):
+        if self.by_name.get(connection.name) is connection:
+            del self.by_name[connection.name]
+
+
+def presence_snapshot(names):
+    """
+    The body of a MSG_PRESENCE listing every member of a room.
+    """
+    return "\n".join([RESET] + [JOINED + name for name in names])
+
+
+def apply_presence(names, text):
+    """
+    Applies the body of a MSG_PRESENCE to a set of names.
+    """
+    for line in text.splitlines():
+        if line == RESET:
+            names.clear()
+        elif line.startswith(JOINED):
+            names.add(line[1:])
+        elif line.startswith(LEFT):
+            names.discard(line[1:])
@@ -0,0 +1,229 @@
+import struct
+import time
+
+from lib.utils import MAX_FRAME_SIZE, FrameDecoder, encode_payload
+
+PROTOCOL_VERSION = 2
+
+# version, type, sender length, body length, sequence number, timestamp (ms)
+HEADER = struct.Struct("!BBHIQQ")
+
+# Frame types
+MSG_HELLO = 1  # client handshake, the sender field holds the client name
+MSG_CHAT = 2
+MSG_SYSTEM = 3
+MSG_PARTIAL = 4  # a chunk of a message still being written, followed by a MSG_CHAT
+# Sent after the welcome message, with the session token as body and the
+# newest sequence number as seq. A MSG_HELLO carrying both resumes the session.
+MSG_SESSION = 5
+# Node-to-node relay links: a MSG_NODE handshake (sender holds the node id,
+# body the relay secret), then MSG_RELAY envelopes whose sender is the origin
+# node, seq its relay sequence number and body the encoded frame.
+MSG_NODE = 6
+MSG_RELAY = 7
+# Rooms: MSG_JOIN moves the client to the room named in the body (the server
+# answers with a MSG_JOIN naming the room joined), MSG_LEAVE goes back to the
+# default room, and an empty MSG_ROOMS asks for the room list, which comes back
+# as a MSG_ROOMS with one "name members" line per room.
+MSG_JOIN = 8
+MSG_LEAVE = 9
+MSG_ROOMS = 10
+# A frame of a room other than the default one, between workers and nodes:
+# the sender holds the room name, the body the encoded frame.
+MSG_ROOM_FRAME = 11
+# Who is in the client's room: one "+name" or "-name" line per change, batched
+# per server tick; a "*" line first resets the list, for the snapshot sent on
+# joining a room.
+MSG_PRESENCE = 12
+# A message to one client. From a client the sender holds the recipient's
+# name, and the server delivers it with the sender's name instead; between
+# workers and nodes the sender holds the recipient and the body the encoded
+# frame to deliver.
+MSG_DIRECT = 13
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return value
+
+
+def valid_utf8(data):
+    """
+    Returns data unchanged if it is valid UTF-8, or with the invalid bytes
+    replaced. Servers apply it to what clients send before relaying it, so
+    receivers never have to deal with undecodable text.
+    """
+    if data.isascii():
+        return data
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("utf-8", "replace").encode("utf-8")
+    return data
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def encode_frame(msg_type, sender, body, seq=0, timestamp=0):
+    """
+    Encodes a v2 frame. Sender and body may be str or bytes-like objects.
+    """
+    sender = to_bytes(sender)
+    body = to_bytes(body)
+    header = HEADER.pack(
+        PROTOCOL_VERSION, msg_type, len(sender), len(body), seq, timestamp
+    )
+    return b"".join((header, sender, body))
+
+
+def encode_hello(name, session_token=b"", last_seq=0, room=""):
+    """
+    Encodes a v2 handshake, resuming the given session if there is one. The
+    client starts in the given room, if it is not the default one.
+    """
+    body = to_bytes(session_token)
+    if room:
+        body += b"\n" + to_bytes(room)
+    return encode_frame(MSG_HELLO, name, body, last_seq)
+
+
+def parse_hello(frame):
+    """
+    Returns the session token and the room name carried by a MSG_HELLO.
+    """
+    token, _, room = frame.body.partition(b"\n")
+    return token, room.decode("utf-8", "replace")
+
+
+class Frame:
+    """
+    A single chat frame. Sender and body are kept as bytes, so the server can
+    relay a frame without decoding its text. Encodings are built once per
+    protocol version and cached.
+    """
+
+    __slots__ = ("type", "sender", "body", "seq", "timestamp", "encoded")
+
+    def __init__(self, msg_type, sender, body, seq=0, timestamp=0):
+        self.type = msg_type
+        self.sender = to_bytes(sender)
+        self.body = to_bytes(body)
+        self.seq = seq
+        self.timestamp = timestamp
+        self.encoded = {}
+
+    @property
+    def sender_name(self):
+        return self.sender.decode("utf-8", "replace")
+
+    @property
+    def text(self):
+        return self.body.decode("utf-8", "replace")
+
+    def encode(self, version=PROTOCOL_VERSION):
+        encoded = self.encoded.get(version)
+        if encoded is None:
+            if version == 1:
+                encoded = encode_payload(b"".join((self.sender, b": ", self.body)))
+            else:
+                encoded = encode_frame(
+                    self.type, self.sender, self.body, self.seq, self.timestamp
+                )
+            self.encoded[version] = encoded
+        return encoded
+
+    def __repr__(self):
+        return (
+            f"Frame(type={self.type}, sender={self.sender!r}, body={self.body!r}, "
+            f"seq={self.seq}, timestamp={self.timestamp})"
+        )
+
+
+class FrameDecoderV2(FrameDecoder):
+    """
+    Incremental decoder for v2 frames. Returns Frame objects.
+    """
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            version, msg_type, sender_length, body_length, seq, timestamp = (
+                HEADER.unpack_from(buffer, offset)
+            )
+            if version != PROTOCOL_VERSION:
+                raise ValueError(f"Unsupported protocol version: {version}")
+            if sender_length + body_length > MAX_FRAME_SIZE:
+                raise ValueError("Frame exceeds the maximum frame size")
+            sender_start = offset + HEADER.size
+            body_start = sender_start + sender_length
+            frame_end = body_start + body_length
+            if len(buffer) < frame_end:
+                break
+            frames.append(
+                Frame(
+                    msg_type,
+                    bytes(buffer[sender_start:body_start]),
+                    bytes(buffer[body_start:frame_end]),
+                    seq,
+                    timestamp,
+                )
+            )
+            offset = frame_end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+
+def decode_frame(data):
+    """
+    Decodes a single complete v2 frame.
+    """
+    frames = FrameDecoderV2(buffer_size=0).feed(data)
+    if len(frames) != 1:
+        raise ValueError("Expected exactly one frame")
+    return frames[0]
+
+
+class NegotiatingDecoder(FrameDecoder):
+    """
+    Server-side decoder that picks the protocol from the first byte a client
+    sends: v1 headers start with an ASCII digit, v2 headers with the version
+    byte. v1 messages are returned as MSG_CHAT frames with an empty sender.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.version = None
+        self.decoder = None
+
+    def feed(self, data):
+        if self.decoder is None:
+            if not data:
+                return []
+            if data[0] == PROTOCOL_VERSION:
+                self.version = PROTOCOL_VERSION
+                self.decoder = FrameDecoderV2(buffer_size=0)
+            else:
+                self.version = 1
+                self.decoder = FrameDecoder(buffer_size=0)
+        frames = self.decoder.feed(data)
+        if self.version == 1:
+            return [Frame(MSG_CHAT, b"", message) for message in frames]
+        return frames
+
+
+def handshake_name(frame):
+    """
+    Returns the client name carried by the first frame of a connection: the
+    sender of a v2 MSG_HELLO, or the text of a v1 name message. Bytes that
+    are not valid UTF-8 are replaced.
+    """
+    if frame.type == MSG_HELLO:
+        return frame.sender.decode("utf-8", "replace")
+    return frame.body.decode("utf-8", "replace")
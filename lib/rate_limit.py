@@ -0,0 +1,322 @@
+import threading
+import time
+from collections import deque
+
+from lib.config import get_env_var
+
+
+class TokenBucket:
+    """
+    Classic token bucket: refills at `rate` tokens per second up to `burst`.
+    Not thread-safe on its own; callers sharing a bucket across threads hold
+    a lock around it.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def available(self, amount=1, now=None):
+        self.refill(time.monotonic() if now is None else now)
+        return self.tokens >= amount
+
+    def consume(self, amount=1, now=None):
+        """Takes amount tokens if available. Returns whether it did."""
+        if not self.available(amount, now):
+            return False
+        self.tokens -= amount
+        return True
+
+    def wait_time(self, amount=1, now=None):
+        """Seconds until amount tokens will be available."""
+        self.refill(time.monotonic() if now is None else now)
+        missing = amount - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate if self.rate else float("inf")
+
+
+class GenerationStats:
+    """
+    Tracks generation throughput and latency, compared against the provider's
+    requests-per-minute limit.
+    """
+
+    def __init__(self, provider_rpm=None):
+        self.provider_rpm = provider_rpm
+        self.lock = threading.Lock()
+        self.started = deque()
+        self.counts = {"triggers": 0, "calls": 0, "coalesced": 0, "rate_limited": 0}
+        self.total_latency = 0
+        self.max_latency = 0
+        self.completed = 0
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def record_call(self, now):
+        with self.lock:
+            self.counts["calls"] += 1
+            self.started.append(now)
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def calls_last_minute(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.started and self.started[0] <= now - 60:
+                self.started.popleft()
+            return len(self.started)
+
+    def report(self):
+        rpm = self.calls_last_minute()
+        with self.lock:
+            return {
+                **self.counts,
+                "calls_last_minute": rpm,
+                "provider_rpm": self.provider_rpm,
+                "provider_utilization": (
+                    round(rpm / self.provider_rpm, 3) if self.provider_rpm else None
+                ),
+                "avg_latency": (
+                    round(self.total_latency / self.completed, 3)
+                    if self.completed
+                    else None
+                ),
+                "max_latency": round(self.max_latency, 3),
+            }
+
+
+class GenerationThrottle:
+    """
+    Gates a bot's AI generations. `trigger` debounces: it waits for a quiet
+    gap in the room (adapted to the recent message rate, and never longer
+    than max_wait after the first trigger of a burst) and then starts a single
+    generation that sees the latest context. `request` skips the debounce.
+    Either way a generation only starts when every token bucket (e.g. the
+    bot's own and its host's) has a token; otherwise it is retried once they
+    refill.
+    """
+
+    # Buckets can be shared by the throttles of several bots
+    bucket_lock = threading.Lock()
+
+    def __init__(
+        self,
+        submit,
+        scheduler,
+        buckets=(),
+        min_quiet=0.5,
+        max_quiet=3,
+        max_wait=10,
+        stats=None,
+    ):
+        self.submit = submit
+        self.scheduler = scheduler
+        self.buckets = list(buckets)
+        self.min_quiet = min_quiet
+        self.max_quiet = max_quiet
+        self.max_wait = max_wait
+        self.stats = stats or GenerationStats()
+        self.lock = threading.Lock()
+        self.timer = None
+        self.burst_started = None
+        self.last_trigger = None
+        # Exponentially weighted mean gap between triggers
+        self.mean_gap = min_quiet
+
+    def quiet_gap(self):
+        return min(self.max_quiet, max(self.min_quiet, 2 * self.mean_gap))
+
+    def trigger(self):
+        now = time.monotonic()
+        self.stats.count("triggers")
+        with self.lock:
+            if self.last_trigger is not None:
+                self.mean_gap = 0.8 * self.mean_gap + 0.2 * (now - self.last_trigger)
+            self.last_trigger = now
+            if self.timer is not None:
+                self.timer.cancel()
+                self.stats.count("coalesced")
+            if self.burst_started is None:
+                self.burst_started = now
+            delay = min(self.quiet_gap(), self.burst_started + self.max_wait - now)
+            self.timer = self.scheduler.call_later(max(0, delay), self.fire)
+
+    def request(self):
+        with self.lock:
+            if self.timer is not None:
+                # A generation is already on its way
+                self.stats.count("coalesced")
+                return
+            self.burst_started = time.monotonic()
+        self.fire()
+
+    def fire(self):
+        now = time.monotonic()
+        with self.bucket_lock:
+            wait = max(
+                (bucket.wait_time(now=now) for bucket in self.buckets), default=0
+            )
+            if not wait:
+                for bucket in self.buckets:
+                    bucket.consume(now=now)
+        with self.lock:
+            if wait:
+                self.stats.count("rate_limited")
+                self.timer = self.scheduler.call_later(wait, self.fire)
+                return
+            self.timer = None
+            self.burst_started = None
+
+        self.stats.record_call(now)
+        future = self.submit()
+        if future is not None:
+            future.add_done_callback(
+                lambda _: self.stats.record_latency(time.monotonic() - now)
+            )
+
+
+class FloodLimits:
+    """
+    Server-side caps on how fast one client can send: messages and payload
+    bytes per second, each with a burst. A rate of 0 means no limit. With
+    `notify`, throttled clients are told so, at most every notice_interval
+    seconds.
+    """
+
+    __slots__ = (
+        "message_rate",
+        "message_burst",
+        "byte_rate",
+        "byte_burst",
+        "notify",
+        "notice_interval",
+    )
+
+    def __init__(
+        self,
+        message_rate=20,
+        message_burst=50,
+        byte_rate=64 << 10,
+        byte_burst=256 << 10,
+        notify=True,
+        notice_interval=10,
+    ):
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.notify = notify
+        self.notice_interval = notice_interval
+
+    @property
+    def enabled(self):
+        return bool(self.message_rate or self.byte_rate)
+
+
+class FloodGuard:
+    """
+    A connection's message and byte buckets. While the connection is over
+    its limits the server stops reading from it; the frames that had already
+    been read wait in `held`.
+    """
+
+    __slots__ = ("limits", "messages", "bytes", "held", "throttled", "noticed_at")
+
+    def __init__(self, limits, now=None):
+        self.limits = limits
+        self.messages = (
+            TokenBucket(limits.message_rate, limits.message_burst, now)
+            if limits.message_rate
+            else None
+        )
+        self.bytes = (
+            TokenBucket(limits.byte_rate, limits.byte_burst, now)
+            if limits.byte_rate
+            else None
+        )
+        self.held = []
+        # Number of times the connection was throttled
+        self.throttled = 0
+        self.noticed_at = None
+
+    def admit(self, size, now):
+        """
+        Takes a message and its size in bytes from the buckets. Returns 0 if
+        they had enough tokens, otherwise the seconds until they will.
+        """
+        messages, byte_bucket = self.messages, self.bytes
+        # A payload bigger than the burst waits for a full bucket
+        size = min(size, self.limits.byte_burst)
+        wait = max(
+            messages.wait_time(now=now) if messages else 0,
+            byte_bucket.wait_time(size, now) if byte_bucket else 0,
+        )
+        if wait:
+            return wait
+        if messages:
+            messages.consume(now=now)
+        if byte_bucket:
+            byte_bucket.consume(size, now)
+        return 0
+
+    def should_notify(self, now):
+        limits = self.limits
+        if not limits.notify or (
+            self.noticed_at is not None
+            and now - self.noticed_at < limits.notice_interval
+        ):
+            return False
+        self.noticed_at = now
+        return True
+
+
+def flood_limits_from_env():
+    defaults = FloodLimits()
+    return FloodLimits(
+        float(get_env_var("CLIENT_RATE", defaults.message_rate)),
+        float(get_env_var("CLIENT_BURST", defaults.message_burst)),
+        float(get_env_var("CLIENT_BYTE_RATE", defaults.byte_rate)),
+        float(get_env_var("CLIENT_BYTE_BURST", defaults.byte_burst)),
+        get_env_var("CLIENT_THROTTLE_NOTICE", "1") == "1",
+    )
+
+
+def bucket_from_env(prefix):
+    """
+    Builds a bucket from <prefix>_RATE_PER_MIN and <prefix>_BURST, or None if
+    no rate is configured.
+    """
+    rate = get_env_var(f"{prefix}_RATE_PER_MIN")
+    if not rate:
+        return None
+    return TokenBucket(float(rate) / 60, float(get_env_var(f"{prefix}_BURST", 1)))
+
+
+def debounce_settings_from_env():
+    return {
+        "min_quiet": float(get_env_var("AI_DEBOUNCE_MIN", 0.5)),
+        "max_quiet": float(get_env_var("AI_DEBOUNCE_MAX", 3)),
+        "max_wait": float(get_env_var("AI_DEBOUNCE_MAX_WAIT", 10)),
+    }
+
+
+def provider_rpm_from_env():
+    rpm = get_env_var("AI_PROVIDER_RPM")
+    return float(rpm) if rpm else None
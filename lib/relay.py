@@ -0,0 +1,83 @@
+import secrets
+import socket
+from collections import deque
+
+from lib.config import get_env_var
+from lib.protocol import MSG_NODE, encode_frame
+
+# Seconds between attempts to redial a relay peer, doubling up to RELAY_RETRY
+RELAY_RETRY_MIN = 0.1
+RELAY_RETRY = 5
+
+
+class DedupWindow:
+    """
+    Remembers the (origin node, relay sequence number) pairs seen recently,
+    so a frame that reaches a node over several paths is only delivered once.
+    Pairs older than the window are treated as seen.
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.seen = set()
+        self.order = deque()
+        # Per origin, the highest sequence number evicted from the window
+        self.floor = {}
+
+    def check(self, origin, seq):
+        """
+        Returns True if the pair is new, and records it.
+        """
+        key = (origin, seq)
+        if key in self.seen or seq <= self.floor.get(origin, 0):
+            return False
+        self.seen.add(key)
+        self.order.append(key)
+        if len(self.order) > self.size:
+            old_origin, old_seq = self.order.popleft()
+            self.seen.discard((old_origin, old_seq))
+            if old_seq > self.floor.get(old_origin, 0):
+                self.floor[old_origin] = old_seq
+        return True
+
+
+def parse_address(address):
+    host, _, port = address.strip().rpartition(":")
+    return host or "localhost", int(port)
+
+
+def connect_link(address, node_id, secret=b""):
+    """
+    Starts a non-blocking connection to another node. Returns the socket and
+    the handshake frame to send once it is connected.
+    """
+    link_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    link_socket.setblocking(False)
+    link_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    link_socket.connect_ex(address)
+    return link_socket, encode_frame(MSG_NODE, node_id, secret)
+
+
+def get_node_id():
+    return (get_env_var("NODE_ID") or secrets.token_hex(4)).encode("utf-8")
+
+
+def get_relay_peers():
+    """
+    Addresses from RELAY_PEERS, a comma separated list of host:port.
+    """
+    peers = get_env_var("RELAY_PEERS", "")
+    return [parse_address(address) for address in peers.split(",") if address.strip()]
+
+
+def get_relay_port():
+    """
+    Port for accepting relay links from other nodes, from RELAY_PORT. When
+    unset, links are accepted on the client port.
+    """
+    port = get_env_var("RELAY_PORT")
+    return int(port) if port else None
+
+
+def get_relay_secret():
+    return get_env_var("RELAY_SECRET", "").encode("utf-8")
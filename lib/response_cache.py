@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from lib.config import get_env_var
+
+
+def cache_key(model, messages, temperature):
+    """
+    Hashes everything that determines a completion: the model, the prompt
+    (system message included) and the temperature.
+    """
+    payload = json.dumps(
+        [model, messages, temperature], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    SQLite-backed cache file, shared by every bot process that points at it.
+    """
+
+    def __init__(self, path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, key, now):
+        row = self.db.execute(
+            "SELECT value, created FROM responses WHERE key = ? AND created > ?",
+            (key, now - self.ttl),
+        ).fetchone()
+        return row
+
+    def put(self, key, value, now):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            self.db.execute(
+                "DELETE FROM responses WHERE created <= ? OR key IN "
+                "(SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (now - self.ttl, self.max_entries),
+            )
+
+    def close(self):
+        self.db.close()
+
+
+class ResponseCache:
+    """
+    LRU cache of AI responses with a time-to-live, optionally backed by a
+    DiskCache shared across processes.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = DiskCache(path, max_entries * 10, ttl) if path else None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created < self.ttl:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                del self.entries[key]
+
+            if self.disk is not None:
+                row = self.disk.get(key, now)
+                if row is not None:
+                    self.store(key, *row)
+                    self.stats["disk_hits"] += 1
+                    return row[0]
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.store(key, value, now)
+            if self.disk is not None:
+                self.disk.put(key, value, now)
+
+    def store(self, key, value, created):
+        self.entries[key] = (value, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def hit_rate(self):
+        hits = self.stats["hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0
+
+    def report(self):
+        with self.lock:
+            return {**self.stats, "hit_rate": round(self.hit_rate(), 3)}
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+
+def get_response_cache_from_env():
+    """
+    Builds the cache configured by AI_CACHE* variables, or None if disabled.
+    """
+    if get_env_var("AI_CACHE", "0") != "1":
+        return None
+    return ResponseCache(
+        int(get_env_var("AI_CACHE_SIZE", 1024)),
+        float(get_env_var("AI_CACHE_TTL", 300)),
+        get_env_var("AI_CACHE_PATH"),
+    )
@@ -0,0 +1,238 @@
+import os
+import re
+
+from lib.config import get_env_var
+from lib.message_log import MessageLog
+from lib.protocol import MSG_ROOM_FRAME, Frame, decode_frame
+
+# Where clients start, and go back to when they leave a room
+DEFAULT_ROOM = "lobby"
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+# Subdirectory of the message log directory holding the other rooms' logs
+ROOMS_DIRECTORY = "rooms"
+
+
+def valid_room_name(name):
+    return ROOM_NAME.fullmatch(name) is not None
+
+
+class Room:
+    """
+    A named room: its members, by socket, and its scrollback log.
+    """
+
+    __slots__ = ("name", "members", "message_log")
+
+    def __init__(self, name, message_log=None):
+        self.name = name
+        self.members = {}
+        self.message_log = message_log
+
+
+class Rooms:
+    """
+    The rooms of a server, indexed by name. A connection is a member of one
+    room at a time, so a broadcast only touches the members of its room.
+
+    Rooms are opened on first use. At most max_rooms are kept open; empty
+    rooms are closed to make space for new ones, and reopened with their
+    history when someone joins again. Rooms other than the default one hold
+    at most max_members connections.
+
+    A room's log is only created when something is logged to it, and the
+    logs of rooms nobody is in are closed at the next flush after their last
+    append, so idle rooms hold no files open.
+    """
+
+    def __init__(self, message_log=None, max_rooms=256, max_members=1000):
+        self.message_log = message_log
+        self.max_rooms = max_rooms
+        self.max_members = max_members
+        self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM, message_log)}
+        # Logs appended to since the last flush
+        self.dirty_logs = set()
+        # Rooms that were left empty, or logged to while empty, since the
+        # last flush
+        self.emptied = set()
+        # The newest sequence number in any room's log, so the server's
+        # sequence carries on past all of them after a restart
+        self.last_seq = message_log.last_seq if message_log else 0
+        for name in self.logged_rooms():
+            room_log = self.open_log(name)
+            self.last_seq = max(self.last_seq, room_log.last_seq)
+            room_log.close()
+
+    @property
+    def default(self):
+        return self.rooms[DEFAULT_ROOM]
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def logged_rooms(self):
+        if self.message_log is None:
+            return []
+        directory = os.path.join(self.message_log.directory, ROOMS_DIRECTORY)
+        if not os.path.isdir(directory):
+            return []
+        return [name for name in os.listdir(directory) if valid_room_name(name)]
+
+    def log_directory(self, name):
+        return os.path.join(self.message_log.directory, ROOMS_DIRECTORY, name)
+
+    def open_log(self, name):
+        if self.message_log is None:
+            return None
+        base = self.message_log
+        return MessageLog(
+            self.log_directory(name),
+            base.segment_bytes,
+            base.index_interval,
+            base.replay_messages,
+            base.replay_seconds,
+        )
+
+    def open(self, name):
+        """
+        Returns the named room, opening it if there is space. Returns None if
+        every open room is in use.
+        """
+        room = self.rooms.get(name)
+        if room is not None:
+            return room
+        if len(self.rooms) >= self.max_rooms and not self.close_empty_room():
+            return None
+        room = Room(name)
+        self.rooms[name] = room
+        return room
+
+    def room_log(self, room, create=False):
+        """
+        Returns the room's log, opening it if the room has one on disk (or,
+        with create, in any case). Returns None for a room with no history.
+        Raises OSError if the log cannot be opened.
+        """
+        if room.message_log is None and self.message_log is not None:
+            if create or os.path.isdir(self.log_directory(room.name)):
+                room.message_log = self.open_log(room.name)
+        return room.message_log
+
+    def close_log(self, room):
+        if room.name != DEFAULT_ROOM and room.message_log is not None:
+            self.dirty_logs.discard(room.message_log)
+            room.message_log.close()
+            room.message_log = None
+
+    def close_empty_room(self):
+        for name, room in self.rooms.items():
+            if name != DEFAULT_ROOM and not room.members:
+                del self.rooms[name]
+                self.emptied.discard(room)
+                self.close_log(room)
+                return True
+        return False
+
+    def join(self, connection, name):
+        """
+        Moves a connection to the named room. Returns the room, or None if it
+        is full or cannot be opened. Raises OSError, leaving the connection
+        where it was, if the room's log cannot be opened.
+        """
+        room = self.open(name)
+        if room is None:
+            return None
+        if room is connection.room:
+            return room
+        if name != DEFAULT_ROOM and len(room.members) >= self.max_members:
+            return None
+        # Opened before leaving, for the history sent to the joining member
+        self.room_log(room)
+        self.leave(connection)
+        room.members[connection.sock] = connection
+        connection.room = room
+        return room
+
+    def leave(self, connection):
+        room = connection.room
+        if room is not None:
+            room.members.pop(connection.sock, None)
+            connection.room = None
+            if not room.members:
+                self.emptied.add(room)
+
+    def log(self, room, frame):
+        try:
+            message_log = self.room_log(room, create=True)
+        except OSError as e:
+            print(f"[SERVER] Could not open the log of #{room.name}: {e}")
+            return
+        if message_log is not None:
+            message_log.append(frame)
+            self.dirty_logs.add(message_log)
+            if not room.members:
+                self.emptied.add(room)
+
+    def flush(self):
+        for message_log in self.dirty_logs:
+            message_log.flush()
+        # Logs of rooms left empty are closed once a flush finds them idle
+        for room in list(self.emptied):
+            if room.members:
+                self.emptied.discard(room)
+            elif room.message_log not in self.dirty_logs:
+                self.emptied.discard(room)
+                self.close_log(room)
+        self.dirty_logs.clear()
+
+    def list(self):
+        """
+        The open rooms and their member counts on this server, as the body
+        of a MSG_ROOMS reply.
+        """
+        return "\n".join(
+            f"{name} {len(room.members)}" for name, room in sorted(self.rooms.items())
+        )
+
+    def close(self):
+        self.flush()
+        for name, room in self.rooms.items():
+            if name != DEFAULT_ROOM and room.message_log is not None:
+                room.message_log.close()
+
+
+def wrap(frame, room_name):
+    """
+    Frames of rooms other than the default one travel between workers and
+    nodes inside a MSG_ROOM_FRAME naming their room.
+    """
+    if room_name == DEFAULT_ROOM:
+        return frame
+    return Frame(MSG_ROOM_FRAME, room_name, frame.encode())
+
+
+def unwrap(frame):
+    """
+    Returns the room name and the frame carried by a relayed frame.
+    """
+    if frame.type != MSG_ROOM_FRAME:
+        return DEFAULT_ROOM, frame
+    return frame.sender_name, decode_frame(frame.body)
+
+
+def parse_room_list(text):
+    """
+    Returns (name, members) pairs from the body of a MSG_ROOMS reply.
+    """
+    rooms = []
+    for line in text.splitlines():
+        name, _, members = line.rpartition(" ")
+        rooms.append((name, int(members)))
+    return rooms
+
+
+def get_rooms(message_log=None):
+    return Rooms(
+        message_log,
+        int(get_env_var("MAX_ROOMS", 256)),
+        int(get_env_var("ROOM_MAX_MEMBERS", 1000)),
+    )
@@ -0,0 +1,167 @@
+import math
+import random
+import threading
+import time
+
+DEFAULT_TICK = 0.05
+DEFAULT_SLOTS = 512
+
+
+class Timer:
+    __slots__ = (
+        "callback",
+        "args",
+        "interval",
+        "jitter",
+        "slot",
+        "rounds",
+        "cancelled",
+    )
+
+    def __init__(self, callback, args, interval=None, jitter=0):
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.slot = 0
+        self.rounds = 0
+        self.cancelled = False
+
+    def cancel(self):
+        # Cancelled timers are dropped lazily when the wheel reaches their slot
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Scheduling and cancelling are O(1), and each tick
+    only looks at the timers hashed to the current slot. Timers further away
+    than one revolution wait there for the number of rounds left.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, rng=None):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.count = 0
+        self.random = rng or random.Random()
+
+    def schedule(self, delay, timer):
+        if timer.jitter:
+            delay += self.random.uniform(-timer.jitter, timer.jitter)
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer.slot = (self.current + ticks) % len(self.slots)
+        timer.rounds = (ticks - 1) // len(self.slots)
+        self.slots[timer.slot].append(timer)
+        self.count += 1
+        return timer
+
+    def advance(self):
+        """
+        Moves the wheel one tick forward and returns the timers that are due.
+        """
+        self.current = (self.current + 1) % len(self.slots)
+        bucket = self.slots[self.current]
+        if not bucket:
+            return []
+        due = []
+        waiting = []
+        for timer in bucket:
+            if timer.cancelled:
+                self.count -= 1
+            elif timer.rounds:
+                timer.rounds -= 1
+                waiting.append(timer)
+            else:
+                self.count -= 1
+                due.append(timer)
+        self.slots[self.current] = waiting
+        return due
+
+
+class Scheduler:
+    """
+    Runs timers from a TimerWheel on a single background thread. The thread
+    sleeps without ticking while no timers are scheduled, so idle bots cost
+    no CPU. Callbacks run on the scheduler thread and should be quick (e.g.
+    hand work off to a GenerationPool).
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.wheel = TimerWheel(tick, slots)
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def call_later(self, delay, callback, *args, jitter=0):
+        return self.add(delay, Timer(callback, args, None, jitter))
+
+    def call_every(self, interval, callback, *args, jitter=0, delay=None):
+        """
+        Calls callback every interval seconds (each run shifted by up to
+        +/- jitter seconds), starting after delay (defaults to interval).
+        """
+        timer = Timer(callback, args, interval, jitter)
+        return self.add(interval if delay is None else delay, timer)
+
+    def add(self, delay, timer):
+        with self.condition:
+            self.wheel.schedule(delay, timer)
+            self.condition.notify()
+        return timer
+
+    def run(self):
+        tick = self.wheel.tick
+        next_tick = time.monotonic() + tick
+        while True:
+            with self.condition:
+                while self.running and not self.wheel.count:
+                    self.condition.wait()
+                    next_tick = time.monotonic() + tick
+                if not self.running:
+                    return
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                due = self.wheel.advance()
+                next_tick += tick
+
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    print(f"[SCHEDULER] Timer callback failed: {e}")
+                if timer.interval is not None and not timer.cancelled:
+                    self.add(timer.interval, timer)
+
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the process-wide scheduler, starting it on first use."""
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = Scheduler()
+            scheduler.start()
+        return scheduler
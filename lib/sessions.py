@@ -0,0 +1,113 @@
+import secrets
+import time
+from collections import OrderedDict, deque
+
+from lib.config import get_env_var
+from lib.protocol import MSG_SYSTEM, Frame, now_ms
+from lib.rooms import DEFAULT_ROOM
+from lib.utils import SYSTEM_SENDER_NAME
+
+
+class ReplayBuffer:
+    """
+    The most recent sequenced frames of every room, for catching up clients
+    that resume their session after a short disconnect.
+    """
+
+    def __init__(self, capacity=1000):
+        # (room name, frame) pairs
+        self.frames = deque(maxlen=capacity)
+
+    def append(self, frame, room=DEFAULT_ROOM):
+        self.frames.append((room, frame))
+
+    def since(self, seq, room=DEFAULT_ROOM):
+        """
+        Returns the room's buffered frames after seq, and how many frames
+        (of any room) after seq are no longer buffered. In cluster mode frames
+        relayed from other workers can arrive slightly out of order, so the
+        whole buffer is scanned.
+        """
+        frames = self.frames
+        if not frames:
+            return [], 0
+        oldest = min(frame.seq for _, frame in frames)
+        newer = [
+            frame
+            for frame_room, frame in frames
+            if frame.seq > seq and frame_room == room
+        ]
+        if not newer and oldest <= seq + 1:
+            return [], 0
+        return newer, max(0, oldest - seq - 1)
+
+
+class SessionStore:
+    """
+    Session tokens handed out to v2 clients. A token can be resumed until
+    `ttl` seconds after its connection was last seen; only the newest
+    `max_sessions` are kept.
+    """
+
+    def __init__(self, ttl=300, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # token -> last seen, oldest first
+        self.sessions = OrderedDict()
+
+    def create(self):
+        token = secrets.token_hex(16).encode("ascii")
+        self.touch(token)
+        return token
+
+    def resume(self, token):
+        """
+        Returns whether token belongs to a live session, refreshing it if so.
+        """
+        self.expire()
+        if token not in self.sessions:
+            return False
+        self.touch(token)
+        return True
+
+    def touch(self, token):
+        self.sessions[token] = time.monotonic()
+        self.sessions.move_to_end(token)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        sessions = self.sessions
+        while sessions:
+            token, last_seen = next(iter(sessions.items()))
+            if last_seen > deadline:
+                break
+            del sessions[token]
+
+
+def missed_frames(replay_buffer, last_seq, sender, room=DEFAULT_ROOM):
+    """
+    Frames of the room a resuming client missed after last_seq, leaving out
+    its own. If the buffer has rolled past some of them, a notice reports the
+    gap; the count is across all rooms, so it is an upper bound.
+    """
+    frames, missed = replay_buffer.since(last_seq, room)
+    frames = [frame for frame in frames if frame.sender != sender]
+    if missed:
+        notice = Frame(
+            MSG_SYSTEM,
+            SYSTEM_SENDER_NAME,
+            f"Up to {missed} messages were missed while you were away",
+            timestamp=now_ms(),
+        )
+        frames.insert(0, notice)
+    return frames
+
+
+def get_replay_buffer():
+    return ReplayBuffer(int(get_env_var("REPLAY_BUFFER_SIZE", 1000)))
+
+
+def get_session_store():
+    return SessionStore(float(get_env_var("SESSION_TTL", 300)))
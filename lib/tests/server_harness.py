@@ -0,0 +1,93 @@
+import socket
+import unittest
+
+from lib.connection import AWAITING_NAME, Connection, QueueLimits
+from lib.poller import EVENT_READ
+from lib.protocol import MSG_CHAT, FrameDecoderV2, encode_hello
+from lib.rate_limit import FloodGuard, FloodLimits
+from lib.sessions import ReplayBuffer, SessionStore
+from server import Server
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Drives a select-engine Server without a listening socket. Each client is
+    a socketpair: the server reads the local end, and the test talks through
+    the remote end. A client is the (local, remote) pair.
+    """
+
+    def setUp(self):
+        self.server = self.make_server()
+
+    def make_server(self, **options):
+        """
+        Builds a Server whose log, limits and federation settings do not
+        come from the environment: no message log, default queue limits and
+        no flood limits unless given.
+        """
+        settings = {
+            "message_log": None,
+            "queue_limits": QueueLimits(),
+            "flood_limits": FloodLimits(message_rate=0, byte_rate=0),
+            "replay_buffer": ReplayBuffer(),
+            "sessions": SessionStore(),
+            "relay_peers": [],
+            "relay_secret": "",
+            "relay_port": 0,
+            "node_id": b"local",
+        }
+        settings.update(options)
+        server = Server(**settings)
+        self.addCleanup(server.stop)
+        return server
+
+    def socket_pair(self):
+        local, remote = socket.socketpair()
+        self.addCleanup(remote.close)
+        local.setblocking(False)
+        return local, remote
+
+    def accept(self, address="client", server=None):
+        """
+        Hands a new connection to the server (self.server unless given), as
+        accept_new_connection does.
+        """
+        server = server or self.server
+        local, remote = self.socket_pair()
+        connection = Connection(local, address)
+        connection.state = AWAITING_NAME
+        if server.flood_limits.enabled:
+            connection.flood = FloodGuard(server.flood_limits)
+        server.connections[local] = connection
+        server.poller.register(local, EVENT_READ)
+        return local, remote
+
+    def connect(self, name, *frames, token=b"", room="", server=None):
+        """
+        Accepts a client and sends its handshake, followed by any frames.
+        """
+        client = self.accept(name, server)
+        data = encode_hello(name, token, room=room) + b"".join(frames)
+        self.send(client, data, server)
+        return client
+
+    def send(self, client, data, server=None):
+        server = server or self.server
+        local, remote = client
+        remote.sendall(data)
+        server.receive_and_broadcast_message(local)
+        server.flush_dirty()
+
+    def received(self, client):
+        remote = client[1]
+        remote.settimeout(0.1)
+        try:
+            return FrameDecoderV2().feed(remote.recv(65536))
+        except socket.timeout:
+            return []
+
+    def of_type(self, frames, msg_type):
+        return [frame for frame in frames if frame.type == msg_type]
+
+    def texts(self, frames, msg_type=MSG_CHAT):
+        return [frame.text for frame in self.of_type(frames, msg_type)]
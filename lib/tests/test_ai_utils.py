@@ -4,9 +4,15 @@ from lib.ai_utils import (
     MODEL_MAX_INPUT_TOKENS,
     MODEL_NAME,
     MODEL_TEMPERATURE,
+    _num_tokens_from_items,
+    AI_ERROR_RESPONSE,
     ai_call,
+    ai_call_stream,
+    get_encoding,
     limit_tokens,
+    num_tokens_from_message,
     num_tokens_from_messages,
+    sentence_chunks,
     wrap_system_message,
     to_openai_message,
 )
@@ -102,6 +108,42 @@ class TestAIUtils(unittest.TestCase):
         result = limit_tokens(messages, system_message, max_tokens)
         self.assertEqual(result, expected_result)
 
+    @mock.patch("lib.ai_utils.tiktoken")
+    def test_get_encoding_is_loaded_once(self, mock_tiktoken):
+        get_encoding.cache_clear()
+        try:
+            get_encoding("test-model")
+            get_encoding("test-model")
+            mock_tiktoken.encoding_for_model.assert_called_once_with("test-model")
+        finally:
+            get_encoding.cache_clear()
+
+    @mock.patch("lib.ai_utils.get_encoding")
+    def test_num_tokens_from_message_is_cached(self, mock_get_encoding):
+        self.addCleanup(_num_tokens_from_items.cache_clear)
+        mock_get_encoding.return_value.encode.side_effect = str.split
+        message = {"role": "user", "content": "cached words here", "name": "cache"}
+        self.assertEqual(num_tokens_from_message(message, "test-model"), 8)
+        self.assertEqual(num_tokens_from_message(message, "test-model"), 8)
+        self.assertEqual(mock_get_encoding.return_value.encode.call_count, 3)
+
+    @mock.patch("lib.ai_utils.get_encoding")
+    def test_limit_tokens_keeps_longest_fitting_tail(self, mock_get_encoding):
+        self.addCleanup(_num_tokens_from_items.cache_clear)
+        mock_get_encoding.return_value.encode.side_effect = str.split
+        messages = [
+            {"role": "user", "content": " ".join(["word"] * i)} for i in range(1, 2000)
+        ]
+        system_message = {"role": "system", "content": "tail test"}
+        # 9 tokens for the system prompt (4 per message, 1 for the role, 2 for
+        # the content) and reply priming, then 5 + i for message i
+        max_tokens = 9 + (5 + 1999) + (5 + 1998)
+        result = limit_tokens(messages, system_message, max_tokens)
+        self.assertEqual(result, messages[-2:])
+        result = limit_tokens(messages, system_message, max_tokens - 1)
+        self.assertEqual(result, messages[-1:])
+        self.assertEqual(limit_tokens(messages, system_message, 10), [])
+
     @mock.patch("lib.ai_utils.wrap_system_message")
     @mock.patch("lib.ai_utils.limit_tokens")
     @mock.patch("lib.ai_utils.get_openai_client")
@@ -157,6 +199,61 @@ class TestAIUtils(unittest.TestCase):
             max_tokens=MAX_TOKENS_TO_GENERATE,
         )
 
+    @mock.patch("lib.ai_utils.num_tokens_from_messages")
+    @mock.patch("lib.ai_utils.limit_tokens")
+    @mock.patch("lib.ai_utils.get_openai_client")
+    def test_ai_call_with_conversation_log(
+        self, mock_get_openai_client, mock_limit_tokens, mock_num_tokens
+    ):
+        mock_num_tokens.return_value = 10
+        conversation = mock.Mock()
+        conversation.tail.return_value = [
+            {"role": "user", "content": "Hello", "name": "user"}
+        ]
+        ai_call(conversation, "System prompt", "AI")
+
+        conversation.tail.assert_called_once_with(MODEL_MAX_INPUT_TOKENS - 10)
+        mock_limit_tokens.assert_not_called()
+        _, kwargs = (
+            mock_get_openai_client.return_value.chat.completions.create.call_args
+        )
+        self.assertEqual(
+            kwargs["messages"][1:],
+            [{"role": "user", "content": "Hello", "name": "user"}],
+        )
+
+    @mock.patch("lib.ai_utils.build_prompt")
+    @mock.patch("lib.ai_utils.get_openai_client")
+    def test_ai_call_stream(self, mock_get_openai_client, mock_build_prompt):
+        def fake_chunk(content):
+            return mock.Mock(choices=[mock.Mock(delta=mock.Mock(content=content))])
+
+        mock_build_prompt.return_value = [{"role": "system", "content": "prompt"}]
+        mock_get_openai_client.return_value.chat.completions.create.return_value = iter(
+            [fake_chunk("Hel"), fake_chunk(None), fake_chunk("lo!")]
+        )
+
+        self.assertEqual(list(ai_call_stream([], "prompt")), ["Hel", "lo!"])
+        _, kwargs = (
+            mock_get_openai_client.return_value.chat.completions.create.call_args
+        )
+        self.assertTrue(kwargs["stream"])
+
+    @mock.patch("lib.ai_utils.build_prompt")
+    @mock.patch("lib.ai_utils.get_openai_client")
+    def test_ai_call_stream_error(self, mock_get_openai_client, mock_build_prompt):
+        mock_get_openai_client.return_value.chat.completions.create.side_effect = (
+            RuntimeError("offline")
+        )
+        self.assertEqual(list(ai_call_stream([], "prompt")), [AI_ERROR_RESPONSE])
+
+    def test_sentence_chunks(self):
+        pieces = ["Hel", "lo there. How a", "re you? I am", "\nfine", ". bye"]
+        self.assertEqual(
+            list(sentence_chunks(pieces)),
+            ["Hello there.", "How are you?", "I am", "fine.", "bye"],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,190 @@
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+from lib.connection import DISCONNECT, QueueLimits
+from lib.message_log import MessageLog
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_PARTIAL,
+    MSG_SESSION,
+    MSG_SYSTEM,
+    Frame,
+    FrameDecoderV2,
+    encode_frame,
+    encode_hello,
+)
+from lib.sessions import ReplayBuffer, SessionStore
+from lib.utils import FrameDecoder, encode_message
+from server import AsyncServer
+
+
+class GatedServer(AsyncServer):
+    """Holds every client in its scrollback replay until the gate opens."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def replay_history(self, writer, version):
+        await super().replay_history(writer, version)
+        await self.gate.wait()
+
+
+class TestAsyncServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        message_log = MessageLog(tmp.name)
+        for seq in (1, 2):
+            message_log.append(Frame(MSG_CHAT, "old", f"history {seq}", seq))
+        self.server = GatedServer(
+            port=0,
+            message_log=message_log,
+            replay_buffer=ReplayBuffer(),
+            sessions=SessionStore(),
+        )
+        await self.server.listen()
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.gate.set()
+        self.server.stop()
+        # Let the connection handlers see their writers closed
+        await asyncio.sleep(0.01)
+
+    async def connect(self, hello, decoder):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        self.addCleanup(writer.close)
+        writer.write(hello)
+        return reader, writer, decoder
+
+    async def received(self, client, count):
+        reader, _, decoder = client
+        items = []
+        while len(items) < count:
+            data = await asyncio.wait_for(reader.read(65536), 1)
+            self.assertTrue(data, "connection closed")
+            items += decoder.feed(data)
+        return items
+
+    async def wait_for_clients(self, count):
+        while len(self.server.clients) < count:
+            await asyncio.sleep(0.001)
+
+    async def test_handshake_replays_history_then_welcomes(self):
+        alice = await self.connect(encode_hello("alice"), FrameDecoderV2())
+        frames = await self.received(alice, 4)
+        self.assertEqual(
+            [frame.type for frame in frames],
+            [MSG_CHAT, MSG_CHAT, MSG_SYSTEM, MSG_SESSION],
+        )
+        self.assertEqual(
+            [frame.text for frame in frames[:3]],
+            ["history 1", "history 2", "Welcome to the chatroom, alice!"],
+        )
+        self.assertEqual(frames[3].seq, 2)
+
+    async def test_v1_handshake(self):
+        bob = await self.connect(encode_message("bob"), FrameDecoder())
+        messages = await self.received(bob, 3)
+        self.assertEqual(
+            messages,
+            [
+                "old: history 1",
+                "old: history 2",
+                "System: Welcome to the chatroom, bob!",
+            ],
+        )
+
+    async def test_broadcast_reaches_v1_and_v2_clients(self):
+        alice = await self.connect(encode_hello("alice"), FrameDecoderV2())
+        bob = await self.connect(encode_message("bob"), FrameDecoder())
+        carol = await self.connect(encode_hello("carol"), FrameDecoderV2())
+        await self.received(alice, 4)
+        await self.received(bob, 3)
+        await self.received(carol, 4)
+        await self.wait_for_clients(3)
+        alice[1].write(encode_frame(MSG_PARTIAL, b"", "h"))
+        alice[1].write(encode_frame(MSG_CHAT, b"", "hi"))
+        # Partial output only reaches v2 clients
+        self.assertEqual(await self.received(bob, 1), ["alice: hi"])
+        partial, chat = await self.received(carol, 2)
+        self.assertEqual((partial.type, partial.text), (MSG_PARTIAL, "h"))
+        self.assertEqual((chat.sender_name, chat.text, chat.seq), ("alice", "hi", 3))
+
+    async def test_text_that_is_not_utf8_is_replaced(self):
+        alice = await self.connect(encode_hello("alice"), FrameDecoderV2())
+        bob = await self.connect(encode_hello("bob"), FrameDecoderV2())
+        await self.received(alice, 4)
+        await self.received(bob, 4)
+        await self.wait_for_clients(2)
+        alice[1].write(encode_frame(MSG_CHAT, b"", b"hi \xff"))
+        (chat,) = await self.received(bob, 1)
+        self.assertEqual(chat.body, "hi \ufffd".encode("utf-8"))
+
+    async def test_frames_are_held_during_the_replay(self):
+        alice = await self.connect(encode_hello("alice"), FrameDecoderV2())
+        await self.received(alice, 4)
+        await self.wait_for_clients(1)
+        self.server.gate.clear()
+        bob = await self.connect(encode_hello("bob"), FrameDecoderV2())
+        while not self.server.replaying:
+            await asyncio.sleep(0.001)
+        alice[1].write(encode_frame(MSG_CHAT, b"", "live"))
+        while not any(self.server.replaying.values()):
+            await asyncio.sleep(0.001)
+        self.server.gate.set()
+        frames = await self.received(bob, 5)
+        # The live frame follows the history and the welcome
+        self.assertEqual(
+            [frame.text for frame in frames[:4]],
+            ["history 1", "history 2", "Welcome to the chatroom, bob!", "live"],
+        )
+        self.assertEqual(frames[4].type, MSG_SESSION)
+
+
+class TestAsyncServerSlowConsumers(unittest.TestCase):
+    def setUp(self):
+        self.server = AsyncServer(
+            queue_limits=QueueLimits(max_bytes=100, policy=DISCONNECT, grace=5),
+            message_log=None,
+            replay_buffer=ReplayBuffer(),
+            sessions=SessionStore(),
+        )
+        self.addCleanup(self.server.stop)
+
+    def add_writer(self, buffered):
+        writer = mock.Mock()
+        writer.is_closing.return_value = False
+        writer.transport.get_write_buffer_size.return_value = buffered
+        self.server.clients[writer] = (("127.0.0.1", 1), "deddy", 2)
+        return writer
+
+    def flush_at(self, now, writer):
+        self.server.outbound[writer] = [b"frame"]
+        with mock.patch("server.time.monotonic", return_value=now):
+            self.server.flush_outbound()
+
+    def test_full_writer_is_kept_for_the_grace_period(self):
+        writer = self.add_writer(buffered=1000)
+        self.flush_at(100, writer)
+        self.flush_at(104, writer)
+        self.assertIn(writer, self.server.clients)
+        self.assertEqual(self.server.dropped_messages[writer], 2)
+        writer.writelines.assert_not_called()
+        self.flush_at(105, writer)
+        self.assertNotIn(writer, self.server.clients)
+        writer.close.assert_called_once()
+
+    def test_grace_period_restarts_once_the_writer_drains(self):
+        writer = self.add_writer(buffered=1000)
+        self.flush_at(100, writer)
+        writer.transport.get_write_buffer_size.return_value = 0
+        self.flush_at(101, writer)
+        writer.transport.get_write_buffer_size.return_value = 1000
+        self.flush_at(105, writer)
+        self.assertIn(writer, self.server.clients)
+        writer.writelines.assert_called_once_with([b"frame"])
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from bot_host import BotHost
+from lib.ai_utils import _num_tokens_from_items, set_response_cache
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_PARTIAL,
+    MSG_SESSION,
+    MSG_SYSTEM,
+    FrameDecoderV2,
+    encode_frame,
+    parse_hello,
+)
+from lib.response_cache import ResponseCache
+
+
+class TestFromConfig(unittest.TestCase):
+    def test_counts_are_expanded_with_numbered_names(self):
+        config = {
+            "server": {"host": "chat.example", "port": 9000},
+            "personas": [
+                {"name": "critic", "mode": 1, "n": 2, "count": 3},
+                {"name": "poet", "mode": 2, "n": 60, "room": "games"},
+            ],
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "personas.json")
+            with open(path, "w") as f:
+                json.dump(config, f)
+            host = BotHost.from_config(path)
+        self.addCleanup(host.stop)
+        self.assertEqual(
+            [persona.name for persona in host.personas],
+            ["critic-1", "critic-2", "critic-3", "poet"],
+        )
+        self.assertEqual((host.server_host, host.server_port), ("chat.example", 9000))
+        self.assertEqual(host.personas[3].room, "games")
+        self.assertEqual(host.personas[0].n, 2)
+
+    def test_stats_include_the_response_cache(self):
+        cache = ResponseCache()
+        cache.get("key")
+        set_response_cache(cache)
+        self.addCleanup(set_response_cache, None)
+        host = BotHost([])
+        with mock.patch("builtins.print") as print_mock:
+            host.stop()
+        (line,) = [call.args[0] for call in print_mock.call_args_list]
+        self.assertIn("'cache': {'hits': 0, 'disk_hits': 0, 'misses': 1", line)
+        self.assertIn("'hit_rate': 0", line)
+
+
+class FakeServer:
+    """
+    Accepts bot connections, records each handshake and answers it with the
+    frames scripted for that persona's connection, in connection order.
+    """
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.hellos = {}
+        self.server = None
+        self.writers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "localhost", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        decoder = FrameDecoderV2()
+        frames = []
+        while not frames:
+            frames = decoder.feed(await reader.read(65536))
+        hello = frames[0]
+        hellos = self.hellos.setdefault(hello.sender_name, [])
+        hellos.append(hello)
+        script = self.scripts[hello.sender_name]
+        writer.write(script[min(len(hellos), len(script)) - 1])
+        await writer.drain()
+        # Each scripted connection is closed once sent; the last one stays open
+        if len(hellos) < len(script):
+            writer.close()
+        else:
+            await reader.read()
+
+
+class TestPersona(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Count words instead of loading the tokenizer
+        patcher = mock.patch("lib.ai_utils.get_encoding")
+        patcher.start().return_value.encode.side_effect = str.split
+        self.addCleanup(patcher.stop)
+        self.addCleanup(_num_tokens_from_items.cache_clear)
+
+    async def run_host(self, personas, scripts):
+        fake = FakeServer(scripts)
+        port = await fake.start()
+        self.addAsyncCleanup(self.stop_server, fake)
+        host = BotHost(personas, server_port=port, retry_delay=0)
+        self.addCleanup(host.stop)
+        tasks = [asyncio.ensure_future(persona.run()) for persona in host.personas]
+        self.addAsyncCleanup(self.cancel, tasks)
+        return host, fake, tasks
+
+    async def stop_server(self, fake):
+        fake.server.close()
+        for writer in fake.writers:
+            writer.close()
+        await fake.server.wait_closed()
+
+    async def cancel(self, tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("timed out")
+
+    async def test_scrollback_and_session_across_reconnects(self):
+        first = b"".join(
+            [
+                # Scrollback: context, but not counted as new lines
+                encode_frame(MSG_CHAT, "alice", "old", 1),
+                encode_frame(MSG_SYSTEM, "System", "Welcome to the chatroom, bot!"),
+                encode_frame(MSG_SESSION, b"", b"token", 1),
+                encode_frame(MSG_PARTIAL, "alice", "ne"),
+                encode_frame(MSG_CHAT, "alice", "new", 2),
+                encode_frame(MSG_CHAT, "bot", "mine", 3),
+            ]
+        )
+        second = b"".join(
+            [
+                # Replayed again after the reconnect, and already seen
+                encode_frame(MSG_CHAT, "alice", "new", 2),
+                encode_frame(MSG_SYSTEM, "System", "Welcome back, bot!"),
+                encode_frame(MSG_CHAT, "alice", "later", 4),
+            ]
+        )
+        persona = {"name": "bot", "mode": 1, "n": 100}
+        host, fake, _ = await self.run_host([persona], {"bot": [first, second]})
+        bot = host.personas[0]
+        await self.wait_for(lambda: bot.last_seq == 4)
+
+        resumed = fake.hellos["bot"][1]
+        self.assertEqual(parse_hello(resumed), (b"token", "lobby"))
+        self.assertEqual(resumed.seq, 3)
+        self.assertEqual(
+            [record.content for record in bot.conversation_log],
+            ["old", "Welcome to the chatroom, bot!", "new", "mine"]
+            + ["Welcome back, bot!", "later"],
+        )
+        # Lines from the welcome on count, except the persona's own
+        self.assertEqual(bot.line_count, 4)
+
+    async def test_a_failing_persona_does_not_stop_the_others(self):
+        welcome = encode_frame(MSG_SYSTEM, "System", "Welcome to the chatroom!")
+        # Not a v2 stream, so the decoder raises
+        garbage = b"\x09" * 64
+        personas = [
+            {"name": "broken", "mode": 1, "n": 100},
+            {"name": "healthy", "mode": 1, "n": 100},
+        ]
+        scripts = {"broken": [garbage, garbage, welcome], "healthy": [welcome]}
+        with mock.patch("bot_host.traceback.print_exc"):
+            host, fake, tasks = await self.run_host(personas, scripts)
+            await self.wait_for(lambda: len(fake.hellos.get("broken", [])) == 3)
+        self.assertFalse(any(task.done() for task in tasks))
+        self.assertEqual(len(fake.hellos["healthy"]), 1)
@@ -0,0 +1,104 @@
+import unittest
+
+from lib.cluster import SharedSequence, bus_sockets
+from lib.protocol import MSG_CHAT, MSG_PARTIAL, Frame, encode_frame
+from lib.sessions import ReplayBuffer
+from lib.tests.server_harness import ServerTestCase
+
+
+class TestCluster(unittest.TestCase):
+    def test_shared_sequence(self):
+        sequence = SharedSequence(5)
+        self.assertEqual(sequence.next(), 6)
+        sequence.advance(10)
+        self.assertEqual(sequence.next(), 11)
+        sequence.advance(3)
+        self.assertEqual(sequence.next(), 12)
+
+    def test_bus_connects_every_pair_of_workers(self):
+        ends = bus_sockets(3)
+        self.addCleanup(lambda: [sock.close() for peers in ends for sock in peers])
+        self.assertEqual([len(peers) for peers in ends], [2, 2, 2])
+        # Worker 0's first socket leads to worker 1, its second to worker 2
+        ends[0][1].sendall(b"hello")
+        self.assertEqual(ends[2][0].recv(5), b"hello")
+
+    def test_replay_buffer_with_relayed_frames_out_of_order(self):
+        buffer = ReplayBuffer()
+        for seq in (5, 7, 6, 8):
+            buffer.append(Frame(MSG_CHAT, "deddy", "hi", seq))
+        frames, missed = buffer.since(6)
+        self.assertEqual([frame.seq for frame in frames], [7, 8])
+        self.assertEqual(missed, 0)
+
+
+class TestClusterBus(ServerTestCase):
+    """
+    Two workers joined by a bus, as run_cluster_worker sets them up. The bus
+    is read by hand: relay() hands what one worker sent to the other.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.other = self.make_server()
+        (left,), (right,) = bus_sockets(2)
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        self.sequence = SharedSequence()
+        self.server.join_cluster([left], self.sequence)
+        self.other.join_cluster([right], self.sequence)
+        self.bus = {self.server: left, self.other: right}
+
+    def relay(self, worker):
+        worker.receive_and_broadcast_message(self.bus[worker])
+        worker.flush_dirty()
+
+    def join(self, name, worker, room=""):
+        client = self.connect(name, room=room, server=worker)
+        self.received(client)
+        return client
+
+    def test_chat_reaches_the_other_worker_once(self):
+        alice = self.join("alice", self.server, room="games")
+        bob = self.join("bob", self.other, room="games")
+        carol = self.join("carol", self.other)
+        self.send(alice, encode_frame(MSG_PARTIAL, b"", "h"))
+        self.send(alice, encode_frame(MSG_CHAT, b"", "hi"))
+        self.relay(self.other)
+
+        frames = self.received(bob)
+        self.assertEqual([frame.type for frame in frames], [MSG_PARTIAL, MSG_CHAT])
+        chat = frames[1]
+        self.assertEqual((chat.sender_name, chat.text, chat.seq), ("alice", "hi", 1))
+        # Only the room's members get it, and the frame is not sent back
+        self.assertEqual(self.received(carol), [])
+        buffered, _ = self.other.replay_buffer.since(0, "games")
+        self.assertEqual([frame.seq for frame in buffered], [1])
+        self.assertEqual(self.other.replay_buffer.since(0)[0], [])
+        self.assertEqual(self.other.sequence, 1)
+
+        self.send(bob, encode_frame(MSG_CHAT, b"", "hello"), self.other)
+        self.relay(self.server)
+        (reply,) = self.received(alice)
+        self.assertEqual(
+            (reply.sender_name, reply.text, reply.seq), ("bob", "hello", 2)
+        )
+        self.assertEqual(self.received(bob), [])
+
+    def test_sequence_is_shared_by_the_workers(self):
+        alice = self.join("alice", self.server)
+        bob = self.join("bob", self.other)
+        self.send(alice, encode_frame(MSG_CHAT, b"", "one"))
+        self.send(bob, encode_frame(MSG_CHAT, b"", "two"), self.other)
+        self.send(alice, encode_frame(MSG_CHAT, b"", "three"))
+        self.relay(self.server)
+        self.relay(self.other)
+        # Each worker has every frame once, in the order they were stamped
+        for worker in (self.server, self.other):
+            frames, _ = worker.replay_buffer.since(0)
+            self.assertEqual(
+                sorted((frame.seq, frame.text) for frame in frames),
+                [(1, "one"), (2, "two"), (3, "three")],
+            )
+        self.assertEqual(self.texts(self.received(alice)), ["two"])
+        self.assertEqual(self.texts(self.received(bob)), ["one", "three"])
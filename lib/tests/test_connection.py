@@ -0,0 +1,120 @@
+import unittest
+from unittest import mock
+
+from lib.connection import (
+    COALESCE,
+    DISCONNECT,
+    DROP_NEWEST,
+    DROP_OLDEST,
+    Connection,
+    QueueLimits,
+)
+from lib.protocol import FrameDecoderV2, encode_frame, MSG_HELLO
+
+
+class TestConnection(unittest.TestCase):
+    def setUp(self):
+        self.sock = mock.Mock()
+        self.connection = Connection(self.sock, ("127.0.0.1", 1234), "deddy")
+
+    def test_enqueue_tracks_pending_bytes(self):
+        self.connection.enqueue(b"hello")
+        self.connection.enqueue(b"world!")
+        self.assertTrue(self.connection.has_pending())
+        self.assertEqual(self.connection.pending_bytes, 11)
+
+    def test_enqueue_shares_the_same_object(self):
+        data = b"broadcast"
+        self.connection.enqueue(data)
+        self.assertIs(self.connection.outbound[0], data)
+
+    def test_flush_drains_buffer_with_one_sendmsg(self):
+        self.sock.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+        self.connection.enqueue(b"hello")
+        self.connection.enqueue(b"world")
+        self.assertTrue(self.connection.flush())
+        self.sock.sendmsg.assert_called_once_with([b"hello", b"world"])
+        self.assertFalse(self.connection.has_pending())
+        self.assertEqual(self.connection.pending_bytes, 0)
+
+    def test_flush_keeps_unsent_tail_on_partial_send(self):
+        self.sock.sendmsg.return_value = 7
+        self.connection.enqueue(b"hello")
+        self.connection.enqueue(b"world")
+        self.assertFalse(self.connection.flush())
+        self.assertEqual(len(self.connection.outbound), 1)
+        self.assertEqual(bytes(self.connection.outbound[0]), b"rld")
+        self.assertEqual(self.connection.pending_bytes, 3)
+
+    @mock.patch("lib.connection.IOV_MAX", 2)
+    def test_flush_batches_by_iov_max(self):
+        self.sock.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+        for chunk in (b"a", b"b", b"c"):
+            self.connection.enqueue(chunk)
+        self.assertTrue(self.connection.flush())
+        self.assertEqual(self.sock.sendmsg.call_count, 2)
+
+    def test_flush_stops_on_blocking_error(self):
+        self.sock.sendmsg.side_effect = BlockingIOError
+        self.connection.enqueue(b"hello")
+        self.assertFalse(self.connection.flush())
+        self.assertEqual(self.connection.pending_bytes, 5)
+
+
+class TestConnectionLimits(unittest.TestCase):
+    def make_connection(self, policy, max_messages=2):
+        connection = Connection(
+            mock.Mock(), None, limits=QueueLimits(1 << 20, max_messages, policy)
+        )
+        connection.decoder.feed(encode_frame(MSG_HELLO, "deddy", b""))
+        return connection
+
+    def test_drop_oldest(self):
+        connection = self.make_connection(DROP_OLDEST)
+        for chunk in (b"a", b"b", b"c"):
+            self.assertTrue(connection.enqueue(chunk))
+        self.assertEqual(list(connection.outbound), [b"b", b"c"])
+        self.assertEqual(connection.dropped_messages, 1)
+
+    def test_drop_oldest_keeps_partially_sent_head(self):
+        connection = self.make_connection(DROP_OLDEST)
+        connection.sock.sendmsg.return_value = 1
+        connection.enqueue(b"ab")
+        connection.enqueue(b"cd")
+        connection.flush()
+        connection.enqueue(b"ef")
+        self.assertEqual([bytes(c) for c in connection.outbound], [b"b", b"ef"])
+
+    def test_drop_newest(self):
+        connection = self.make_connection(DROP_NEWEST)
+        connection.enqueue(b"a")
+        connection.enqueue(b"b")
+        self.assertFalse(connection.enqueue(b"c"))
+        self.assertEqual(list(connection.outbound), [b"a", b"b"])
+        self.assertEqual(connection.dropped_messages, 1)
+
+    def test_coalesce_replaces_backlog_with_notice(self):
+        connection = self.make_connection(COALESCE, max_messages=3)
+        for chunk in (b"a", b"b", b"c", b"d"):
+            connection.enqueue(chunk)
+        self.assertEqual(len(connection.outbound), 2)
+        notice = FrameDecoderV2().feed(connection.outbound[0])[0]
+        self.assertIn("3 messages were skipped", notice.text)
+        self.assertEqual(connection.outbound[1], b"d")
+
+    def test_disconnect_marks_over_limit_until_drained(self):
+        connection = self.make_connection(DISCONNECT, max_messages=1)
+        connection.enqueue(b"a")
+        self.assertFalse(connection.enqueue(b"b"))
+        self.assertIsNotNone(connection.over_limit_since)
+        connection.sock.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+        connection.flush()
+        self.assertIsNone(connection.over_limit_since)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            QueueLimits(policy="ignore")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from unittest import mock
+
+from lib.ai_utils import _num_tokens_from_items
+from lib.conversation import ConversationLog
+
+
+@mock.patch("lib.ai_utils.get_encoding")
+class TestConversationLog(unittest.TestCase):
+    def setUp(self):
+        _num_tokens_from_items.cache_clear()
+        self.addCleanup(_num_tokens_from_items.cache_clear)
+
+    def make_encoding(self, mock_get_encoding):
+        mock_get_encoding.return_value.encode.side_effect = str.split
+
+    def test_append_converts_once(self, mock_get_encoding):
+        self.make_encoding(mock_get_encoding)
+        log = ConversationLog("AI-12345")
+        log.append("deddy", "Hello there")
+        record = log.append("AI-12345", "Hi")
+        self.assertEqual(
+            record.message, {"role": "assistant", "content": "Hi", "name": "AI-12345"}
+        )
+        # 4 + "assistant" + "Hi" + "AI-12345" - 1
+        self.assertEqual(record.tokens, 6)
+        self.assertEqual(log.total_tokens, 13)
+
+    def test_evicts_by_message_count(self, mock_get_encoding):
+        self.make_encoding(mock_get_encoding)
+        log = ConversationLog("AI", max_messages=2)
+        for text in ("one", "two", "three"):
+            log.append("deddy", text)
+        self.assertEqual([record.content for record in log], ["two", "three"])
+        self.assertEqual(log.total_tokens, 12)
+
+    def test_evicts_by_tokens(self, mock_get_encoding):
+        self.make_encoding(mock_get_encoding)
+        log = ConversationLog("AI", max_tokens=10)
+        log.append("deddy", "one")
+        log.append("deddy", "two words")
+        self.assertEqual([record.content for record in log], ["two words"])
+
+    def test_tail_returns_fitting_messages(self, mock_get_encoding):
+        self.make_encoding(mock_get_encoding)
+        log = ConversationLog("AI")
+        for text in ("one", "two", "three"):
+            log.append("deddy", text)
+        self.assertEqual(
+            [message["content"] for message in log.tail(12)], ["two", "three"]
+        )
+        self.assertEqual(log.tail(5), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
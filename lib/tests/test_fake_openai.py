@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+
+from lib import ai_utils
+from lib.ai_utils import AI_ERROR_RESPONSE, ai_call, ai_call_stream, set_ai_backend
+from lib.fake_openai import FakeAIError, FakeOpenAI
+
+MESSAGES = [{"role": "user", "content": "Hello", "name": "deddy"}]
+
+
+class TestFakeOpenAI(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOpenAI(latency=0, tokens_per_sec=0, seed=1)
+
+    def test_create(self):
+        response = self.fake.chat.completions.create(
+            model="fake", messages=MESSAGES, max_tokens=5
+        )
+        content = response.choices[0].message.content
+        self.assertEqual(len(content.split()), 5)
+        self.assertTrue(content.endswith("."))
+        self.assertEqual(self.fake.stats, {"calls": 1, "errors": 0, "tokens": 5})
+
+    def test_create_is_deterministic_per_prompt(self):
+        first = self.fake.create("fake", MESSAGES, max_tokens=8)
+        second = self.fake.create("fake", MESSAGES, max_tokens=8)
+        self.assertEqual(
+            first.choices[0].message.content, second.choices[0].message.content
+        )
+
+    def test_stream(self):
+        chunks = list(self.fake.create("fake", MESSAGES, max_tokens=4, stream=True))
+        self.assertEqual(len(chunks), 4)
+        text = "".join(chunk.choices[0].delta.content for chunk in chunks)
+        self.assertEqual(len(text.split()), 4)
+
+    def test_error_injection(self):
+        fake = FakeOpenAI(latency=0, error_rate=1)
+        with self.assertRaises(FakeAIError):
+            fake.create("fake", MESSAGES)
+        self.assertEqual(fake.stats["errors"], 1)
+
+    def test_latency_distributions(self):
+        for distribution in ("fixed", "uniform", "exponential", "lognormal"):
+            fake = FakeOpenAI(latency=0.1, distribution=distribution, seed=1)
+            self.assertGreaterEqual(fake.sample_latency(), 0)
+
+    def test_unknown_distribution(self):
+        with self.assertRaises(ValueError):
+            FakeOpenAI(distribution="gaussian-ish")
+
+
+class TestFakeBackend(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(set_ai_backend, None)
+
+    @mock.patch("lib.ai_utils.build_prompt", return_value=MESSAGES)
+    def test_ai_call_uses_backend(self, mock_build_prompt):
+        set_ai_backend(FakeOpenAI(latency=0, tokens_per_sec=0))
+        self.assertEqual(len(ai_call([], "prompt").split()), 100)
+
+    @mock.patch("lib.ai_utils.build_prompt", return_value=MESSAGES)
+    def test_ai_call_stream_uses_backend(self, mock_build_prompt):
+        set_ai_backend(FakeOpenAI(latency=0, tokens_per_sec=0))
+        self.assertEqual(len(list(ai_call_stream([], "prompt"))), 100)
+
+    @mock.patch("lib.ai_utils.build_prompt", return_value=MESSAGES)
+    def test_ai_call_handles_injected_errors(self, mock_build_prompt):
+        set_ai_backend(FakeOpenAI(latency=0, error_rate=1))
+        self.assertEqual(ai_call([], "prompt"), AI_ERROR_RESPONSE)
+
+    @mock.patch.dict("os.environ", {"AI_BACKEND": "fake"})
+    def test_get_openai_client_from_env(self):
+        self.assertIsInstance(ai_utils.get_openai_client(), FakeOpenAI)
+
+    @mock.patch.dict("os.environ", {"AI_BACKEND": "nope"})
+    def test_get_openai_client_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            ai_utils.get_openai_client()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import threading
+import unittest
+
+from lib.generation import GenerationPool
+
+
+class TestGenerationPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = GenerationPool(concurrency=1)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_result_is_delivered(self):
+        results = []
+        self.pool.submit("bot", lambda x: x * 2, results.append, 21).result(1)
+        self.assertEqual(results, [42])
+        self.assertEqual(self.pool.stats["completed"], 1)
+
+    def test_pending_job_is_superseded(self):
+        release = threading.Event()
+        started = threading.Event()
+        results = []
+
+        def blocking():
+            started.set()
+            release.wait(1)
+            return "running"
+
+        first = self.pool.submit("bot", blocking, results.append)
+        started.wait(1)
+        stale = self.pool.submit("bot", lambda: "stale", results.append)
+        latest = self.pool.submit("bot", lambda: "latest", results.append)
+        release.set()
+        first.result(1)
+        latest.result(1)
+
+        self.assertTrue(stale.cancelled())
+        self.assertEqual(results, ["running", "latest"])
+        self.assertEqual(self.pool.stats["superseded"], 1)
+
+    def test_failure_is_counted(self):
+        def fail():
+            raise RuntimeError("boom")
+
+        self.pool.submit("bot", fail, lambda result: None).result(1)
+        self.assertEqual(self.pool.stats["failed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
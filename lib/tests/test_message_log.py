@@ -0,0 +1,156 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from lib.connection import Connection
+from lib.message_log import INDEX_ENTRY, MessageLog
+from lib.protocol import MSG_CHAT, Frame
+
+
+def chat_frame(seq, timestamp=None):
+    return Frame(MSG_CHAT, "deddy", f"message {seq}", seq, timestamp or seq * 1000)
+
+
+class TestMessageLog(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def open_log(self, **kwargs):
+        log = MessageLog(self.directory, **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def append(self, log, seqs):
+        for seq in seqs:
+            log.append(chat_frame(seq))
+        log.flush()
+
+    def replayed_seqs(self, log, ranges):
+        return [frame.seq for frame in log.read_frames(ranges)]
+
+    def test_replay_last_messages(self):
+        log = self.open_log(index_interval=100)
+        self.append(log, range(1, 101))
+        ranges = log.ranges(last_messages=10)
+        self.assertEqual(self.replayed_seqs(log, ranges), list(range(91, 101)))
+
+    def test_replay_last_seconds(self):
+        log = self.open_log(index_interval=100)
+        self.append(log, range(1, 101))
+        with mock.patch("lib.message_log.now_ms", return_value=100_000):
+            ranges = log.ranges(seconds=5)
+        self.assertEqual(self.replayed_seqs(log, ranges), list(range(95, 101)))
+
+    def test_replay_applies_both_limits(self):
+        log = self.open_log()
+        self.append(log, range(1, 101))
+        with mock.patch("lib.message_log.now_ms", return_value=100_000):
+            ranges = log.ranges(last_messages=3, seconds=50)
+        self.assertEqual(self.replayed_seqs(log, ranges), [98, 99, 100])
+
+    def test_replay_last_messages_with_sequence_gaps(self):
+        # A room's log only holds that room's frames
+        log = MessageLog(self.directory, index_interval=100, replay_messages=5)
+        self.append(log, range(1, 301, 3))
+        ranges = log.ranges(last_messages=5)
+        self.assertEqual(self.replayed_seqs(log, ranges), [286, 289, 292, 295, 298])
+        log.close()
+        reopened = self.open_log(index_interval=100, replay_messages=5)
+        self.assertEqual(list(reopened.recent_seqs), [286, 289, 292, 295, 298])
+
+    def test_index_is_sparse(self):
+        log = self.open_log(index_interval=200)
+        self.append(log, range(1, 101))
+        segment = log.segments[-1]
+        self.assertLess(len(segment.positions), 50)
+        self.assertEqual(
+            os.path.getsize(segment.index_path),
+            len(segment.positions) * INDEX_ENTRY.size,
+        )
+
+    def test_replay_spans_segments(self):
+        log = self.open_log(segment_bytes=500, index_interval=100)
+        self.append(log, range(1, 51))
+        self.assertGreater(len(log.segments), 3)
+        ranges = log.ranges(last_messages=20)
+        self.assertGreater(len(ranges), 1)
+        self.assertEqual(self.replayed_seqs(log, ranges), list(range(31, 51)))
+
+    def test_empty_log(self):
+        log = self.open_log()
+        self.assertEqual(log.last_seq, 0)
+        self.assertEqual(log.ranges(last_messages=10), [])
+
+    def test_reopen_continues_sequence(self):
+        log = MessageLog(self.directory, segment_bytes=500)
+        self.append(log, range(1, 31))
+        log.close()
+        log = self.open_log(segment_bytes=500)
+        self.assertEqual(log.last_seq, 30)
+        self.append(log, [31])
+        ranges = log.ranges(last_messages=2)
+        self.assertEqual(self.replayed_seqs(log, ranges), [30, 31])
+
+    def test_reopen_truncates_torn_frame(self):
+        log = MessageLog(self.directory)
+        self.append(log, range(1, 11))
+        segment = log.segments[-1]
+        size = segment.size
+        os.write(segment.fd, chat_frame(11).encode()[:-3])
+        log.close()
+        log = self.open_log()
+        self.assertEqual(log.last_seq, 10)
+        self.assertEqual(log.segments[-1].size, size)
+
+    def test_unflushed_frames_are_replayed(self):
+        log = self.open_log()
+        log.append(chat_frame(1))
+        self.assertEqual(self.replayed_seqs(log, log.ranges(last_messages=5)), [1])
+
+    def test_ranges_are_sent_with_the_queue(self):
+        log = self.open_log()
+        self.append(log, range(1, 6))
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        connection = Connection(left, None)
+        connection.append(b"before")
+        for file_range in log.ranges(last_messages=2):
+            connection.append_file(file_range)
+        connection.append(b"after")
+        self.assertTrue(connection.flush())
+        self.assertEqual(connection.pending_bytes, 0)
+        self.assertEqual(connection.file_ranges, 0)
+        expected = b"".join(
+            [b"before", chat_frame(4).encode(), chat_frame(5).encode(), b"after"]
+        )
+        self.assertEqual(right.recv(len(expected) + 1), expected)
+
+    def test_queued_ranges_outlive_the_log(self):
+        log = MessageLog(self.directory)
+        self.append(log, range(1, 6))
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        connection = Connection(left, None)
+        for file_range in log.ranges(last_messages=2):
+            connection.append_file(file_range)
+        # The log of a room is closed when the room is, with replays queued
+        log.close()
+        self.assertTrue(connection.flush())
+        expected = chat_frame(4).encode() + chat_frame(5).encode()
+        self.assertEqual(right.recv(len(expected) + 1), expected)
+
+    def test_close_twice(self):
+        log = MessageLog(self.directory)
+        self.append(log, range(1, 3))
+        log.close()
+        # Likely to reuse a number the log had open
+        fd = os.open(os.devnull, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        log.close()
+        os.fstat(fd)
@@ -0,0 +1,73 @@
+import socket
+import unittest
+
+from lib.poller import (
+    EVENT_READ,
+    EVENT_WRITE,
+    SelectPoller,
+    SelectorsPoller,
+    get_poller,
+)
+
+
+class PollerTestMixin:
+    poller_class = None
+
+    def setUp(self):
+        self.poller = self.poller_class()
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.poller.close()
+        self.left.close()
+        self.right.close()
+
+    def test_poll_reports_readable(self):
+        self.poller.register(self.left, EVENT_READ)
+        self.right.sendall(b"x")
+        self.assertEqual(self.poller.poll(1), [(self.left, EVENT_READ)])
+
+    def test_poll_nothing_ready(self):
+        self.poller.register(self.left, EVENT_READ)
+        self.assertEqual(self.poller.poll(0), [])
+
+    def test_modify_adds_write_interest(self):
+        self.poller.register(self.left, EVENT_READ)
+        self.poller.modify(self.left, EVENT_READ | EVENT_WRITE)
+        self.assertEqual(self.poller.poll(1), [(self.left, EVENT_WRITE)])
+
+    def test_modify_to_no_events_pauses_the_socket(self):
+        self.poller.register(self.left, EVENT_READ)
+        self.poller.modify(self.left, 0)
+        self.right.sendall(b"x")
+        self.assertEqual(self.poller.poll(0), [])
+        self.poller.modify(self.left, EVENT_READ)
+        self.assertEqual(self.poller.poll(1), [(self.left, EVENT_READ)])
+
+    def test_unregister(self):
+        self.poller.register(self.left, EVENT_READ)
+        self.poller.unregister(self.left)
+        self.right.sendall(b"x")
+        self.assertEqual(self.poller.poll(0), [])
+
+
+class TestSelectPoller(PollerTestMixin, unittest.TestCase):
+    poller_class = SelectPoller
+
+
+class TestSelectorsPoller(PollerTestMixin, unittest.TestCase):
+    poller_class = SelectorsPoller
+
+
+class TestGetPoller(unittest.TestCase):
+    def test_get_poller(self):
+        poller = get_poller("select")
+        self.assertIsInstance(poller, SelectPoller)
+
+    def test_get_poller_unknown(self):
+        with self.assertRaises(ValueError):
+            get_poller("kqueue-please")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from lib.presence import Presence, apply_presence, presence_snapshot
+from lib.protocol import (
+    MSG_DIRECT,
+    MSG_PRESENCE,
+    MSG_SESSION,
+    MSG_SYSTEM,
+    encode_frame,
+)
+from lib.tests.server_harness import ServerTestCase
+
+
+class Member:
+    def __init__(self):
+        self.name = None
+
+
+class TestPresence(unittest.TestCase):
+    def test_taken_names_are_numbered(self):
+        presence = Presence()
+        first, second, third = Member(), Member(), Member()
+        self.assertEqual(presence.add(first, "deddy"), "deddy")
+        self.assertEqual(presence.add(second, "deddy"), "deddy-2")
+        self.assertEqual(presence.add(third, "deddy"), "deddy-3")
+        self.assertIs(presence.get("deddy-2"), second)
+
+    def test_remove_only_the_registered_connection(self):
+        presence = Presence()
+        member, other = Member(), Member()
+        member.name = presence.add(member, "deddy")
+        other.name = "deddy"
+        presence.remove(other)
+        self.assertIs(presence.get("deddy"), member)
+        presence.remove(member)
+        self.assertEqual(len(presence), 0)
+
+    def test_apply_presence(self):
+        names = {"stale"}
+        apply_presence(names, presence_snapshot(["alice", "bob"]))
+        self.assertEqual(names, {"alice", "bob"})
+        apply_presence(names, "-alice\n+carol")
+        self.assertEqual(names, {"bob", "carol"})
+
+
+class TestServerPresence(ServerTestCase):
+    def test_direct_message_reaches_only_the_recipient(self):
+        alice, bob, carol = (self.connect(name) for name in ("alice", "bob", "carol"))
+        for client in (alice, bob, carol):
+            self.received(client)
+        self.send(alice, encode_frame(MSG_DIRECT, "bob", "psst"))
+        (direct,) = self.received(bob)
+        self.assertEqual(direct.type, MSG_DIRECT)
+        self.assertEqual((direct.sender_name, direct.text), ("alice", "psst"))
+        self.assertEqual(self.received(carol), [])
+
+    def test_direct_message_to_unknown_name(self):
+        alice = self.connect("alice")
+        self.received(alice)
+        self.send(alice, encode_frame(MSG_DIRECT, "nobody", "psst"))
+        (notice,) = self.received(alice)
+        self.assertEqual(notice.type, MSG_SYSTEM)
+        self.assertIn("nobody", notice.text)
+
+    def test_direct_message_to_a_name_that_is_not_utf8(self):
+        alice = self.connect("alice")
+        self.received(alice)
+        self.send(alice, encode_frame(MSG_DIRECT, b"\xff", "psst"))
+        (notice,) = self.received(alice)
+        self.assertEqual(notice.type, MSG_SYSTEM)
+
+    def test_duplicate_name_is_renamed(self):
+        self.connect("deddy")
+        second = self.connect("deddy")
+        notices = self.of_type(self.received(second), MSG_SYSTEM)
+        self.assertIn("you are deddy-2", notices[0].text)
+        self.assertEqual(self.server.connections[second[0]].sender, b"deddy-2")
+
+    def test_name_that_is_not_utf8(self):
+        client = self.connect(b"\xff")
+        self.assertEqual(self.server.connections[client[0]].sender, "\ufffd".encode())
+        self.assertIsNotNone(self.server.presence.get("\ufffd"))
+
+    def test_resumed_session_replaces_the_stale_connection(self):
+        first = self.connect("deddy")
+        (session,) = self.of_type(self.received(first), MSG_SESSION)
+        second = self.connect("deddy", token=session.body)
+        self.assertNotIn(first[0], self.server.connections)
+        self.assertIs(self.server.presence.get("deddy").sock, second[0])
+
+    def test_presence_changes_are_batched(self):
+        alice = self.connect("alice")
+        snapshot, *_ = self.of_type(self.received(alice), MSG_PRESENCE)
+        self.assertEqual(snapshot.text, "*\n+alice")
+        bob, carol = self.connect("bob"), self.connect("carol")
+        self.received(alice)
+        # Both leave within one tick
+        for client in (bob, carol):
+            self.server.remove_client(client[0])
+        self.server.flush_dirty()
+        (delta,) = self.received(alice)
+        self.assertEqual(delta.type, MSG_PRESENCE)
+        self.assertEqual(delta.text, "-bob\n-carol")
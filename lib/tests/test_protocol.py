@@ -0,0 +1,93 @@
+import unittest
+
+from lib.protocol import (
+    HEADER,
+    MSG_CHAT,
+    MSG_HELLO,
+    PROTOCOL_VERSION,
+    Frame,
+    FrameDecoderV2,
+    NegotiatingDecoder,
+    encode_frame,
+    handshake_name,
+    valid_utf8,
+)
+from lib.utils import HEADER_LENGTH, encode_message
+
+
+class TestProtocol(unittest.TestCase):
+    def test_encode_frame_header(self):
+        data = encode_frame(MSG_CHAT, "deddy", "שלום", seq=7, timestamp=42)
+        version, msg_type, sender_length, body_length, seq, timestamp = (
+            HEADER.unpack_from(data)
+        )
+        self.assertEqual(version, PROTOCOL_VERSION)
+        self.assertEqual(msg_type, MSG_CHAT)
+        self.assertEqual(sender_length, 5)
+        self.assertEqual(body_length, len("שלום".encode("utf-8")))
+        self.assertEqual((seq, timestamp), (7, 42))
+        self.assertEqual(data[HEADER.size :], "deddyשלום".encode("utf-8"))
+
+    def test_frame_encode_is_cached(self):
+        frame = Frame(MSG_CHAT, "deddy", "Hello")
+        self.assertIs(frame.encode(), frame.encode())
+
+    def test_frame_encode_v1(self):
+        frame = Frame(MSG_CHAT, "deddy", "héllo")
+        self.assertEqual(frame.encode(1), encode_message("deddy: héllo"))
+
+    def test_handshake_name(self):
+        self.assertEqual(handshake_name(Frame(MSG_HELLO, "deddy", b"")), "deddy")
+        self.assertEqual(handshake_name(Frame(MSG_CHAT, b"", "deddy")), "deddy")
+        self.assertEqual(handshake_name(Frame(MSG_HELLO, b"\xff", b"")), "\ufffd")
+
+    def test_valid_utf8(self):
+        text = "שלום".encode("utf-8")
+        self.assertIs(valid_utf8(text), text)
+        self.assertEqual(valid_utf8(b"hi \xff"), "hi \ufffd".encode("utf-8"))
+
+    def test_undecodable_text_is_replaced(self):
+        frame = Frame(MSG_CHAT, b"\xff", b"\xfe")
+        self.assertEqual((frame.sender_name, frame.text), ("\ufffd", "\ufffd"))
+
+
+class TestFrameDecoderV2(unittest.TestCase):
+    def test_feed_split_and_pipelined_frames(self):
+        data = encode_frame(MSG_CHAT, "a", "one", seq=1) + encode_frame(
+            MSG_CHAT, "b", "two", seq=2
+        )
+        decoder = FrameDecoderV2()
+        self.assertEqual(decoder.feed(data[:5]), [])
+        frames = decoder.feed(data[5:])
+        self.assertEqual(
+            [(f.sender, f.body, f.seq) for f in frames],
+            [
+                (b"a", b"one", 1),
+                (b"b", b"two", 2),
+            ],
+        )
+
+    def test_feed_rejects_unknown_version(self):
+        with self.assertRaises(ValueError):
+            FrameDecoderV2().feed(b"\x09" + b"\x00" * (HEADER.size - 1))
+
+
+class TestNegotiatingDecoder(unittest.TestCase):
+    def test_detects_v2(self):
+        decoder = NegotiatingDecoder()
+        frames = decoder.feed(encode_frame(MSG_HELLO, "deddy", b""))
+        self.assertEqual(decoder.version, PROTOCOL_VERSION)
+        self.assertEqual(frames[0].type, MSG_HELLO)
+
+    def test_detects_v1(self):
+        decoder = NegotiatingDecoder()
+        data = encode_message("deddy") + encode_message("Hello")
+        frames = decoder.feed(data[: HEADER_LENGTH + 2])
+        self.assertEqual(decoder.version, 1)
+        frames += decoder.feed(data[HEADER_LENGTH + 2 :])
+        self.assertEqual([f.body for f in frames], [b"deddy", b"Hello"])
+        self.assertTrue(all(f.type == MSG_CHAT for f in frames))
+
+
+if __name__ == "__main__":
+    unittest.main()
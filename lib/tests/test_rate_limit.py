@@ -0,0 +1,176 @@
+import time
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+from lib.protocol import MSG_CHAT, MSG_SYSTEM, encode_frame
+
+from lib.rate_limit import (
+    FloodGuard,
+    FloodLimits,
+    GenerationStats,
+    GenerationThrottle,
+    TokenBucket,
+)
+from lib.tests.server_harness import ServerTestCase
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback):
+        timer = mock.Mock()
+        self.timers.append((delay, callback, timer))
+        return timer
+
+    def run_last(self):
+        delay, callback, timer = self.timers[-1]
+        callback()
+        return delay
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_consume_until_empty(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0)
+        self.assertTrue(bucket.consume(now=0))
+        self.assertTrue(bucket.consume(now=0))
+        self.assertFalse(bucket.consume(now=0))
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=1, burst=2, now=0)
+        bucket.consume(2, now=0)
+        self.assertTrue(bucket.consume(now=1))
+        self.assertEqual(bucket.tokens, 0)
+        bucket.refill(100)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_wait_time(self):
+        bucket = TokenBucket(rate=0.5, burst=1, now=0)
+        self.assertEqual(bucket.wait_time(now=0), 0)
+        bucket.consume(now=0)
+        self.assertAlmostEqual(bucket.wait_time(now=0), 2)
+        self.assertAlmostEqual(bucket.wait_time(now=1.5), 0.5)
+
+
+class TestGenerationThrottle(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = FakeScheduler()
+        self.submit = mock.Mock(return_value=None)
+        self.throttle = GenerationThrottle(
+            self.submit, self.scheduler, min_quiet=1, max_quiet=4, max_wait=10
+        )
+
+    def test_triggers_coalesce_into_one_generation(self):
+        for _ in range(5):
+            self.throttle.trigger()
+        self.assertEqual(len(self.scheduler.timers), 5)
+        for _, _, timer in self.scheduler.timers[:-1]:
+            timer.cancel.assert_called_once_with()
+        self.scheduler.run_last()
+        self.submit.assert_called_once_with()
+        self.assertEqual(self.throttle.stats.counts["coalesced"], 4)
+
+    def test_debounce_never_exceeds_max_wait(self):
+        with mock.patch("lib.rate_limit.time.monotonic", return_value=0):
+            self.throttle.trigger()
+        with mock.patch("lib.rate_limit.time.monotonic", return_value=9):
+            self.throttle.trigger()
+        self.assertEqual(self.scheduler.timers[-1][0], 1)
+
+    def test_request_skips_debounce(self):
+        self.throttle.request()
+        self.submit.assert_called_once_with()
+        self.assertEqual(self.scheduler.timers, [])
+
+    def test_rate_limited_generation_is_retried(self):
+        bucket = TokenBucket(rate=0.1, burst=1)
+        self.throttle.buckets = [bucket]
+        self.throttle.request()
+        self.throttle.request()
+        self.assertEqual(self.submit.call_count, 1)
+        self.assertEqual(self.throttle.stats.counts["rate_limited"], 1)
+        delay, _, _ = self.scheduler.timers[-1]
+        self.assertGreater(delay, 9)
+
+        # Requests while the retry is pending are coalesced
+        self.throttle.request()
+        self.assertEqual(self.throttle.stats.counts["coalesced"], 1)
+
+        bucket.tokens = 1
+        self.scheduler.run_last()
+        self.assertEqual(self.submit.call_count, 2)
+
+    def test_latency_recorded_when_generation_completes(self):
+        future = Future()
+        self.submit.return_value = future
+        self.throttle.request()
+        self.assertEqual(self.throttle.stats.completed, 0)
+        future.set_result(None)
+        self.assertEqual(self.throttle.stats.completed, 1)
+
+
+class TestFloodGuard(unittest.TestCase):
+    def test_message_limit(self):
+        guard = FloodGuard(FloodLimits(message_rate=2, message_burst=2), now=0)
+        self.assertEqual(guard.admit(10, 0), 0)
+        self.assertEqual(guard.admit(10, 0), 0)
+        self.assertEqual(guard.admit(10, 0), 0.5)
+        self.assertEqual(guard.admit(10, 0.5), 0)
+
+    def test_byte_limit(self):
+        limits = FloodLimits(message_rate=0, byte_rate=100, byte_burst=100)
+        guard = FloodGuard(limits, now=0)
+        self.assertEqual(guard.admit(80, 0), 0)
+        self.assertEqual(guard.admit(40, 0), 0.2)
+        # Bigger than the burst: admitted once the bucket is full
+        self.assertEqual(guard.admit(1000, 1), 0)
+
+    def test_notices_are_spaced_out(self):
+        guard = FloodGuard(FloodLimits(notice_interval=10), now=0)
+        self.assertTrue(guard.should_notify(0))
+        self.assertFalse(guard.should_notify(5))
+        self.assertTrue(guard.should_notify(11))
+        self.assertFalse(FloodGuard(FloodLimits(notify=False)).should_notify(0))
+
+
+class TestServerFlood(ServerTestCase):
+    def setUp(self):
+        self.server = self.make_server(
+            flood_limits=FloodLimits(message_rate=1, message_burst=2, byte_rate=0),
+        )
+
+    def test_flooding_client_is_paused_then_resumed(self):
+        bob = self.connect("bob")
+        self.received(bob)
+        chats = [encode_frame(MSG_CHAT, b"", f"spam {i}") for i in range(3)]
+        alice = self.connect("alice", *chats)
+        self.assertEqual(self.texts(self.received(bob), MSG_CHAT), ["spam 0", "spam 1"])
+        self.assertIn(alice[0], self.server.throttled)
+        self.assertIn("too fast", self.texts(self.received(alice), MSG_SYSTEM)[-1])
+        # Nothing more is read from the socket while it is paused
+        self.assertEqual(self.server.poller.poll(0), [])
+
+        later = time.monotonic() + 1
+        with mock.patch("server.time.monotonic", return_value=later):
+            self.server.resume_throttled()
+        self.server.flush_dirty()
+        self.assertEqual(self.texts(self.received(bob), MSG_CHAT), ["spam 2"])
+        self.assertNotIn(alice[0], self.server.throttled)
+        self.assertEqual(self.server.connections[alice[0]].flood.throttled, 1)
+
+
+class TestGenerationStats(unittest.TestCase):
+    def test_report(self):
+        stats = GenerationStats(provider_rpm=10)
+        with mock.patch("lib.rate_limit.time.monotonic", return_value=100):
+            stats.record_call(30)
+            stats.record_call(90)
+            stats.record_latency(2)
+            stats.record_latency(4)
+            report = stats.report()
+        self.assertEqual(report["calls"], 2)
+        self.assertEqual(report["calls_last_minute"], 1)
+        self.assertEqual(report["provider_utilization"], 0.1)
+        self.assertEqual(report["avg_latency"], 3)
+        self.assertEqual(report["max_latency"], 4)
@@ -0,0 +1,104 @@
+import socket
+import unittest
+
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_NODE,
+    MSG_RELAY,
+    Frame,
+    decode_frame,
+    encode_frame,
+)
+from lib.relay import DedupWindow, parse_address
+from lib.tests.server_harness import ServerTestCase
+from server import Server
+
+
+class TestDedupWindow(unittest.TestCase):
+    def test_duplicates_are_dropped(self):
+        window = DedupWindow()
+        self.assertTrue(window.check(b"a", 1))
+        self.assertTrue(window.check(b"b", 1))
+        self.assertFalse(window.check(b"a", 1))
+
+    def test_pairs_older_than_the_window_count_as_seen(self):
+        window = DedupWindow(size=2)
+        for seq in (1, 2, 3):
+            window.check(b"a", seq)
+        self.assertFalse(window.check(b"a", 1))
+        self.assertTrue(window.check(b"a", 4))
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address("example.com:8001"), ("example.com", 8001))
+        self.assertEqual(parse_address(":8001"), ("localhost", 8001))
+
+
+class TestServerRelay(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.connect("deddy")
+        self.received(self.client)
+        # Two links to other nodes; each test talks through the remote ends
+        self.links = [self.add_link() for _ in range(2)]
+
+    def add_link(self):
+        local, remote = self.socket_pair()
+        self.server.add_node(local, "link")
+        return local, remote
+
+    def envelope(self, origin, seq, text):
+        return Frame(
+            MSG_RELAY, origin, encode_frame(MSG_CHAT, "remote-user", text), seq
+        ).encode()
+
+    def test_relayed_frame_reaches_local_clients_once(self):
+        self.send(self.links[0], self.envelope(b"remote", 1, "hello"))
+        self.send(self.links[1], self.envelope(b"remote", 1, "hello"))
+        frames = self.received(self.client)
+        self.assertEqual([frame.text for frame in frames], ["hello"])
+        self.assertEqual(frames[0].sender_name, "remote-user")
+        self.assertEqual(frames[0].seq, 1)
+
+    def test_relayed_frame_is_forwarded_to_other_links_only(self):
+        self.send(self.links[0], self.envelope(b"remote", 1, "hello"))
+        self.assertEqual(self.received(self.links[0]), [])
+        (forwarded,) = self.received(self.links[1])
+        self.assertEqual(forwarded.type, MSG_RELAY)
+        self.assertEqual(forwarded.sender, b"remote")
+        self.assertEqual(decode_frame(forwarded.body).text, "hello")
+
+    def test_own_envelopes_are_dropped(self):
+        self.send(self.links[0], self.envelope(b"local", 1, "loop"))
+        self.assertEqual(self.received(self.client), [])
+        self.assertEqual(self.received(self.links[1]), [])
+
+    def test_inbound_link_with_the_secret(self):
+        self.server.relay_secret = b"secret"
+        node = self.accept("node")
+        self.send(node, Frame(MSG_NODE, b"other", b"secret").encode())
+        self.assertEqual(len(self.server.nodes), 3)
+
+    def test_inbound_link_needs_the_secret(self):
+        self.server.relay_secret = b"secret"
+        node = self.accept("node")
+        self.send(node, Frame(MSG_NODE, b"other", b"wrong").encode())
+        self.assertNotIn(node[0], self.server.connections)
+
+    def test_links_are_refused_without_a_secret(self):
+        node = self.accept("node")
+        self.send(node, Frame(MSG_NODE, b"other", b"").encode())
+        self.assertNotIn(node[0], self.server.connections)
+        self.assertEqual(len(self.server.nodes), 2)
+
+    def test_peers_need_a_secret(self):
+        with self.assertRaises(ValueError):
+            Server(message_log=None, relay_peers=[("localhost", 1)], relay_secret="")
+
+    def test_links_are_only_accepted_on_the_relay_port(self):
+        self.server.relay_secret = b"secret"
+        self.server.relay_socket = socket.socket()
+        self.addCleanup(self.server.relay_socket.close)
+        self.server.relay_socket.bind(("localhost", 0))
+        node = self.accept("node")
+        self.send(node, Frame(MSG_NODE, b"other", b"secret").encode())
+        self.assertNotIn(node[0], self.server.connections)
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lib.ai_utils import ai_call, set_ai_backend, set_response_cache
+from lib.fake_openai import FakeOpenAI
+from lib.response_cache import ResponseCache, cache_key
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_cache_key(self):
+        messages = [{"role": "system", "content": "prompt"}]
+        self.assertEqual(cache_key("m", messages, 0.7), cache_key("m", messages, 0.7))
+        self.assertNotEqual(
+            cache_key("m", messages, 0.7), cache_key("m", messages, 0.2)
+        )
+
+    def test_get_and_put(self):
+        cache = ResponseCache()
+        self.assertIsNone(cache.get("key"))
+        cache.put("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+        self.assertEqual(cache.hit_rate(), 0.5)
+        self.assertEqual(
+            cache.report(),
+            {"hits": 1, "disk_hits": 0, "misses": 1, "evictions": 0, "hit_rate": 0.5},
+        )
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        cache.get("a")
+        cache.put("c", "3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.stats["evictions"], 1)
+
+    @mock.patch("lib.response_cache.time.time")
+    def test_ttl_expiry(self, mock_time):
+        cache = ResponseCache(ttl=10)
+        mock_time.return_value = 100
+        cache.put("key", "value")
+        mock_time.return_value = 109
+        self.assertEqual(cache.get("key"), "value")
+        mock_time.return_value = 111
+        self.assertIsNone(cache.get("key"))
+
+    def test_disk_cache_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "responses.db")
+            writer = ResponseCache(path=path)
+            reader = ResponseCache(path=path)
+            writer.put("key", "value")
+            self.assertEqual(reader.get("key"), "value")
+            self.assertEqual(reader.stats["disk_hits"], 1)
+            writer.close()
+            reader.close()
+
+
+class TestAICallCache(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOpenAI(latency=0, tokens_per_sec=0)
+        set_ai_backend(self.fake)
+        set_response_cache(ResponseCache())
+        self.addCleanup(set_ai_backend, None)
+        self.addCleanup(set_response_cache, None)
+
+    @mock.patch("lib.ai_utils.build_prompt")
+    def test_identical_calls_hit_the_cache(self, mock_build_prompt):
+        mock_build_prompt.return_value = [{"role": "system", "content": "prompt"}]
+        first = ai_call([], "prompt")
+        second = ai_call([], "prompt")
+        self.assertEqual(first, second)
+        self.assertEqual(self.fake.stats["calls"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+import errno
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lib.message_log import MessageLog
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_JOIN,
+    MSG_LEAVE,
+    MSG_ROOM_FRAME,
+    MSG_ROOMS,
+    MSG_SYSTEM,
+    Frame,
+    encode_frame,
+)
+from lib.rooms import DEFAULT_ROOM, Rooms, parse_room_list, unwrap, wrap
+from lib.tests.server_harness import ServerTestCase
+
+
+class Member:
+    """Stands in for a Connection."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.room = None
+
+
+class TestRooms(unittest.TestCase):
+    def test_join_moves_between_rooms(self):
+        rooms = Rooms()
+        member = Member(1)
+        rooms.join(member, DEFAULT_ROOM)
+        games = rooms.join(member, "games")
+        self.assertIs(member.room, games)
+        self.assertEqual(rooms.default.members, {})
+        self.assertEqual(list(games.members), [1])
+        rooms.leave(member)
+        self.assertIsNone(member.room)
+        self.assertEqual(games.members, {})
+
+    def test_rooms_are_capped(self):
+        rooms = Rooms(max_rooms=2, max_members=1)
+        first, second = Member(1), Member(2)
+        rooms.join(first, "games")
+        self.assertIsNone(rooms.join(second, "games"))
+        self.assertIsNone(rooms.join(second, "music"))
+        # The default room has no member limit
+        self.assertIsNotNone(rooms.join(second, DEFAULT_ROOM))
+        rooms.leave(first)
+        # An empty room is closed to make space
+        self.assertIsNotNone(rooms.join(second, "music"))
+        self.assertIsNone(rooms.get("games"))
+
+    def test_list(self):
+        rooms = Rooms()
+        rooms.join(Member(1), "games")
+        rooms.join(Member(2), "games")
+        self.assertEqual(
+            parse_room_list(rooms.list()), [("games", 2), (DEFAULT_ROOM, 0)]
+        )
+
+    def test_wrap(self):
+        frame = Frame(MSG_CHAT, "deddy", "hi", 7)
+        self.assertIs(wrap(frame, DEFAULT_ROOM), frame)
+        wrapped = wrap(frame, "games")
+        self.assertEqual(wrapped.type, MSG_ROOM_FRAME)
+        room_name, unwrapped = unwrap(wrapped)
+        self.assertEqual(room_name, "games")
+        self.assertEqual((unwrapped.text, unwrapped.seq), ("hi", 7))
+
+    def test_sequence_carries_on_from_room_logs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            rooms = Rooms(MessageLog(directory))
+            member = Member(1)
+            rooms.log(rooms.join(member, "games"), Frame(MSG_CHAT, "deddy", "hi", 9))
+            rooms.close()
+            rooms.message_log.close()
+            reopened = Rooms(MessageLog(directory))
+            self.assertEqual(reopened.last_seq, 9)
+            reopened.close()
+            reopened.message_log.close()
+
+    def test_room_log_is_created_on_first_append(self):
+        with tempfile.TemporaryDirectory() as directory:
+            rooms = Rooms(MessageLog(directory))
+            games = rooms.join(Member(1), "games")
+            self.assertFalse(os.path.exists(rooms.log_directory("games")))
+            rooms.log(games, Frame(MSG_CHAT, "deddy", "hi", 1))
+            self.assertTrue(os.path.isdir(rooms.log_directory("games")))
+            rooms.close()
+            rooms.message_log.close()
+
+    def test_logs_of_empty_rooms_are_closed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            rooms = Rooms(MessageLog(directory))
+            member = Member(1)
+            games = rooms.join(member, "games")
+            rooms.log(games, Frame(MSG_CHAT, "deddy", "hi", 1))
+            rooms.flush()
+            self.assertIsNotNone(games.message_log)
+            rooms.leave(member)
+            rooms.flush()
+            self.assertIsNone(games.message_log)
+            # A frame relayed to the empty room keeps its log open until a
+            # flush finds it idle
+            rooms.log(games, Frame(MSG_CHAT, "remote", "hi", 2))
+            rooms.flush()
+            self.assertIsNotNone(games.message_log)
+            rooms.flush()
+            self.assertIsNone(games.message_log)
+            # Joining again opens it for the history
+            rooms.join(member, "games")
+            self.assertEqual(games.message_log.last_seq, 2)
+            rooms.close()
+            rooms.message_log.close()
+
+
+class TestServerRooms(ServerTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.server = self.make_server(message_log=MessageLog(tmp.name))
+
+    def test_messages_only_reach_the_room(self):
+        alice = self.connect("alice", room="games")
+        bob = self.connect("bob", room="games")
+        carol = self.connect("carol")
+        for client in (alice, bob, carol):
+            self.received(client)
+        self.send(alice, encode_frame(MSG_CHAT, b"", "gg"))
+        self.assertEqual(self.texts(self.received(bob)), ["gg"])
+        self.assertEqual(self.received(carol), [])
+
+    def test_text_that_is_not_utf8_is_replaced(self):
+        alice = self.connect("alice", room="games")
+        bob = self.connect("bob", room="games")
+        for client in (alice, bob):
+            self.received(client)
+        self.send(alice, encode_frame(MSG_CHAT, b"", b"gg \xff"))
+        (chat,) = self.received(bob)
+        self.assertEqual(chat.body, "gg \ufffd".encode("utf-8"))
+        # Scrollback holds the replaced text too
+        carol = self.connect("carol", room="games")
+        self.assertIn("gg \ufffd", self.texts(self.received(carol)))
+
+    def test_welcome_names_the_room(self):
+        alice = self.connect("alice", room="games")
+        self.assertIn(
+            "Welcome to #games, alice!", self.texts(self.received(alice), MSG_SYSTEM)
+        )
+
+    def test_join_replays_room_history(self):
+        alice = self.connect("alice", room="games")
+        self.send(alice, encode_frame(MSG_CHAT, b"", "gg"))
+        bob = self.connect("bob")
+        self.received(bob)
+        self.send(bob, encode_frame(MSG_JOIN, b"", "games"))
+        frames = self.received(bob)
+        self.assertEqual(self.texts(frames), ["gg"])
+        self.assertEqual(self.texts(frames, MSG_JOIN), ["games"])
+
+    def test_invalid_room_name(self):
+        alice = self.connect("alice")
+        self.received(alice)
+        self.send(alice, encode_frame(MSG_JOIN, b"", "no spaces"))
+        (notice,) = self.received(alice)
+        self.assertEqual(notice.type, MSG_SYSTEM)
+        self.assertIs(self.server.connections[alice[0]].room, self.server.rooms.default)
+
+    def test_room_name_that_is_not_utf8(self):
+        alice = self.connect("alice")
+        self.received(alice)
+        self.send(alice, encode_frame(MSG_JOIN, b"", b"\xff\xfe"))
+        (notice,) = self.received(alice)
+        self.assertEqual(notice.type, MSG_SYSTEM)
+        self.assertIs(self.server.connections[alice[0]].room, self.server.rooms.default)
+
+    def test_room_log_that_cannot_be_opened(self):
+        alice = self.connect("alice", room="games")
+        self.send(alice, encode_frame(MSG_CHAT, b"", "gg"))
+        self.send(alice, encode_frame(MSG_LEAVE, b"", b""))
+        bob = self.connect("bob")
+        self.received(bob)
+        error = OSError(errno.EMFILE, "Too many open files")
+        with mock.patch.object(self.server.rooms, "open_log", side_effect=error):
+            self.send(bob, encode_frame(MSG_JOIN, b"", "games"))
+        notices = self.texts(self.received(bob), MSG_SYSTEM)
+        self.assertIn("Could not join #games", notices[0])
+        self.assertIs(self.server.connections[bob[0]].room, self.server.rooms.default)
+
+    def test_stop_twice(self):
+        alice = self.connect("alice", room="games")
+        self.send(alice, encode_frame(MSG_CHAT, b"", "gg"))
+        self.server.stop()
+        self.server.stop()
+
+    def test_room_list(self):
+        alice = self.connect("alice", room="games")
+        self.received(alice)
+        self.send(alice, encode_frame(MSG_ROOMS, b"", b""))
+        (reply,) = self.received(alice)
+        self.assertEqual(reply.type, MSG_ROOMS)
+        self.assertEqual(parse_room_list(reply.text), [("games", 1), (DEFAULT_ROOM, 0)])
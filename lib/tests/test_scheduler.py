@@ -0,0 +1,82 @@
+import random
+import threading
+import unittest
+from unittest import mock
+
+from lib.scheduler import Scheduler, Timer, TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1, slots=8)
+
+    def advance(self, ticks):
+        due = []
+        for _ in range(ticks):
+            due += self.wheel.advance()
+        return due
+
+    def test_timer_fires_after_delay(self):
+        timer = self.wheel.schedule(3, Timer(None, ()))
+        self.assertEqual(self.advance(2), [])
+        self.assertEqual(self.advance(1), [timer])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_timer_beyond_one_revolution(self):
+        timer = self.wheel.schedule(20, Timer(None, ()))
+        self.assertEqual(self.advance(19), [])
+        self.assertEqual(self.advance(1), [timer])
+
+    def test_cancelled_timer_does_not_fire(self):
+        timer = self.wheel.schedule(2, Timer(None, ()))
+        timer.cancel()
+        self.assertEqual(self.advance(2), [])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_jitter(self):
+        wheel = TimerWheel(tick=1, slots=8, rng=mock.Mock(spec=random.Random))
+        wheel.random.uniform.return_value = 2
+        wheel.schedule(3, Timer(None, (), jitter=2))
+        wheel.random.uniform.assert_called_once_with(-2, 2)
+        self.assertEqual(sum(len(slot) for slot in wheel.slots[:5]), 0)
+        self.assertEqual(len(wheel.slots[5]), 1)
+
+    def test_many_timers(self):
+        for delay in range(1, 1001):
+            self.wheel.schedule(delay, Timer(None, ()))
+        self.assertEqual(len(self.advance(1000)), 1000)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(tick=0.01, slots=16)
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def test_call_later(self):
+        fired = threading.Event()
+        self.scheduler.call_later(0.02, fired.set)
+        self.assertTrue(fired.wait(1))
+
+    def test_call_every_until_cancelled(self):
+        calls = []
+        done = threading.Event()
+
+        def tick():
+            calls.append(1)
+            if len(calls) == 3:
+                timer.cancel()
+                done.set()
+
+        timer = self.scheduler.call_every(0.01, tick)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(len(calls), 3)
+
+    def test_idle_scheduler_waits_without_ticking(self):
+        with mock.patch.object(self.scheduler.wheel, "advance") as advance:
+            threading.Event().wait(0.05)
+            advance.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from unittest import mock
+
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_HELLO,
+    MSG_SYSTEM,
+    Frame,
+    FrameDecoderV2,
+    encode_hello,
+    parse_hello,
+)
+from lib.sessions import ReplayBuffer, SessionStore, missed_frames
+
+
+def chat_frame(seq, sender="deddy"):
+    return Frame(MSG_CHAT, sender, f"message {seq}", seq)
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = ReplayBuffer(capacity=5)
+        for seq in range(1, 9):
+            self.buffer.append(chat_frame(seq))
+
+    def seqs(self, frames):
+        return [frame.seq for frame in frames]
+
+    def test_since_returns_missed_frames(self):
+        frames, missed = self.buffer.since(6)
+        self.assertEqual(self.seqs(frames), [7, 8])
+        self.assertEqual(missed, 0)
+
+    def test_since_reports_gap(self):
+        frames, missed = self.buffer.since(1)
+        self.assertEqual(self.seqs(frames), [4, 5, 6, 7, 8])
+        self.assertEqual(missed, 2)
+
+    def test_since_up_to_date(self):
+        self.assertEqual(self.buffer.since(8), ([], 0))
+        self.assertEqual(ReplayBuffer().since(0), ([], 0))
+
+    def test_missed_frames_skips_own_messages(self):
+        self.buffer.append(chat_frame(9, sender="me"))
+        frames = missed_frames(self.buffer, 7, b"me")
+        self.assertEqual(self.seqs(frames), [8])
+
+    def test_since_only_returns_the_rooms_frames(self):
+        self.buffer.append(chat_frame(9), "games")
+        frames, missed = self.buffer.since(7, "games")
+        self.assertEqual(self.seqs(frames), [9])
+        self.assertEqual(missed, 0)
+        self.assertEqual(self.seqs(self.buffer.since(7)[0]), [8])
+
+    def test_missed_frames_notices_gap(self):
+        notice, *frames = missed_frames(self.buffer, 0, b"me")
+        self.assertEqual(notice.type, MSG_SYSTEM)
+        self.assertIn("3 messages", notice.text)
+        self.assertEqual(self.seqs(frames), [4, 5, 6, 7, 8])
+
+
+class TestSessionStore(unittest.TestCase):
+    def test_resume_known_token(self):
+        sessions = SessionStore()
+        token = sessions.create()
+        self.assertTrue(sessions.resume(token))
+        self.assertFalse(sessions.resume(b"unknown"))
+
+    @mock.patch("lib.sessions.time.monotonic")
+    def test_sessions_expire(self, monotonic):
+        sessions = SessionStore(ttl=10)
+        monotonic.return_value = 100
+        token = sessions.create()
+        monotonic.return_value = 105
+        sessions.touch(token)
+        monotonic.return_value = 114
+        self.assertTrue(sessions.resume(token))
+        monotonic.return_value = 125
+        self.assertFalse(sessions.resume(token))
+
+    def test_oldest_sessions_are_evicted(self):
+        sessions = SessionStore(max_sessions=2)
+        first, second, third = (sessions.create() for _ in range(3))
+        self.assertFalse(sessions.resume(first))
+        self.assertTrue(sessions.resume(second))
+        self.assertTrue(sessions.resume(third))
+
+    def test_hello_carries_session(self):
+        (frame,) = FrameDecoderV2().feed(encode_hello("deddy", b"token", 42))
+        self.assertEqual(frame.type, MSG_HELLO)
+        self.assertEqual(frame.sender_name, "deddy")
+        self.assertEqual(frame.body, b"token")
+        self.assertEqual(frame.seq, 42)
+        self.assertEqual(parse_hello(frame), (b"token", ""))
+
+    def test_hello_carries_room(self):
+        (frame,) = FrameDecoderV2().feed(encode_hello("deddy", b"token", 42, "games"))
+        self.assertEqual(parse_hello(frame), (b"token", "games"))
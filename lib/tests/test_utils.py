@@ -4,6 +4,7 @@ import string
 from lib.utils import (
     HEADER_LENGTH,
     SYSTEM_SENDER_NAME,
+    FrameDecoder,
     color_message,
     decode_message,
     deserialize_message,
@@ -128,5 +129,59 @@ class TestUtils(unittest.TestCase):
             self.assertEqual(result, False)
 
 
+class TestFrameDecoder(unittest.TestCase):
+    def test_feed_single_frame(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(encode_message("Hello")), ["Hello"])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_feed_split_frame(self):
+        decoder = FrameDecoder()
+        data = encode_message("Hello, World!")
+        self.assertEqual(decoder.feed(data[:4]), [])
+        self.assertEqual(decoder.feed(data[4:12]), [])
+        self.assertEqual(decoder.feed(data[12:]), ["Hello, World!"])
+
+    def test_feed_pipelined_frames(self):
+        decoder = FrameDecoder()
+        data = encode_message("one") + encode_message("two") + encode_message("thr")
+        self.assertEqual(decoder.feed(data[:-1]), ["one", "two"])
+        self.assertEqual(decoder.feed(data[-1:]), ["thr"])
+
+    def test_feed_invalid_header(self):
+        decoder = FrameDecoder()
+        with self.assertRaises(ValueError):
+            decoder.feed(b"not a header")
+
+    def test_feed_negative_length(self):
+        with self.assertRaises(ValueError):
+            FrameDecoder().feed(b"-10       ")
+
+    def test_feed_oversized_length(self):
+        with self.assertRaises(ValueError):
+            FrameDecoder().feed(b"9999999999")
+
+    def test_receive_uses_recv_into(self):
+        data = encode_message("Hello")
+
+        def recv_into(buffer):
+            buffer[: len(data)] = data
+            return len(data)
+
+        with patch("socket.socket") as mock_socket:
+            mock_socket.recv_into.side_effect = recv_into
+            self.assertEqual(FrameDecoder().receive(mock_socket), ["Hello"])
+
+    def test_receive_would_block(self):
+        with patch("socket.socket") as mock_socket:
+            mock_socket.recv_into.side_effect = BlockingIOError
+            self.assertEqual(FrameDecoder().receive(mock_socket), [])
+
+    def test_receive_closed(self):
+        with patch("socket.socket") as mock_socket:
+            mock_socket.recv_into.return_value = 0
+            self.assertEqual(FrameDecoder().receive(mock_socket), False)
+
+
 if __name__ == "__main__":
     unittest.main()
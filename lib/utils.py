@@ -7,6 +7,8 @@ from colorama import Fore, Style
 import time
 
 HEADER_LENGTH = 10
+MAX_FRAME_SIZE = 1 << 20
+RECV_BUFFER_SIZE = 65536
 SYSTEM_SENDER_NAME = "System"
 
 
@@ -54,7 +56,7 @@ def get_message_length_from_header(header):
     """
     Extracts the message length from the header.
     """
-    return int(header.decode("utf-8").strip())
+    return int(bytes(header).decode("utf-8").strip())
 
 
 def serialize_message(sender, message):
@@ -67,23 +69,34 @@ def deserialize_message(serialized_message):
 
 def decode_message(message):
     """
-    Decodes a message received from the server.
+    Decodes a message received from the server. Bytes that are not valid
+    UTF-8 are replaced.
     """
-    return message.decode("utf-8")
+    return bytes(message).decode("utf-8", "replace")
+
+
+def encode_payload(payload):
+    """
+    Prefixes an already encoded payload with its length header.
+    """
+    header = f"{len(payload):<{HEADER_LENGTH}}".encode("utf-8")
+    return header + payload
 
 
 def encode_message(message):
     """
     Encodes a message to be sent to the server.
+    The header holds the length in bytes, not characters, so multibyte text
+    keeps the framing intact.
     """
-    message_length = len(message)
-    header = f"{message_length:<{HEADER_LENGTH}}".encode("utf-8")
-    return header + message.encode("utf-8")
+    return encode_payload(message.encode("utf-8"))
 
 
 def receive_message(sckt):
     """
     Receives a message from the server.
+    Assumes the header and message each arrive in a single recv, prefer
+    `FrameDecoder` for non-blocking sockets.
     """
     max_retries = 3
     retry_delay = 1
@@ -109,3 +122,52 @@ def receive_message(sckt):
                 return False
 
     return False
+
+
+class FrameDecoder:
+    """
+    Incrementally reassembles frames from a byte stream. Bytes are fed in
+    whatever chunks the socket returns; every complete frame is yielded, and a
+    partial frame stays buffered until the rest of it arrives.
+    """
+
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE):
+        self.buffer = bytearray()
+        self.read_buffer = memoryview(bytearray(buffer_size))
+
+    def feed(self, data):
+        """
+        Appends data to the buffer and returns a list of the complete messages.
+        Raises ValueError if the stream contains an invalid header.
+        """
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        offset = 0
+        while len(buffer) - offset >= HEADER_LENGTH:
+            header_end = offset + HEADER_LENGTH
+            length = get_message_length_from_header(buffer[offset:header_end])
+            if not 0 <= length <= MAX_FRAME_SIZE:
+                raise ValueError(f"Invalid message length: {length}")
+            message_end = header_end + length
+            if len(buffer) < message_end:
+                break
+            messages.append(decode_message(buffer[header_end:message_end]))
+            offset = message_end
+        if offset:
+            del buffer[:offset]
+        return messages
+
+    def receive(self, sckt):
+        """
+        Reads whatever is available from the socket, without waiting for more.
+        Returns a list of complete messages (possibly empty), or False if the
+        peer closed the connection.
+        """
+        try:
+            received = sckt.recv_into(self.read_buffer)
+        except (BlockingIOError, InterruptedError):
+            return []
+        if received == 0:
+            return False
+        return self.feed(self.read_buffer[:received])
@@ -1,43 +1,196 @@
+import asyncio
+import hmac
 import socket
-import select
+import time
 import traceback
+from collections import deque
 
-from lib.utils import (
-    encode_message,
-    receive_message,
-    SYSTEM_SENDER_NAME,
-    serialize_message,
+from lib.config import FROM_ENV, get_env_var
+from lib.cluster import Cluster, get_cluster_workers
+from lib.connection import (
+    AWAITING_NAME,
+    DISCONNECT,
+    NODE,
+    PEER,
+    REGISTERED,
+    Connection,
+    get_queue_limits,
 )
+from lib.message_log import get_message_log_from_env
+from lib.poller import EVENT_READ, EVENT_WRITE, get_poller
+from lib.protocol import (
+    MSG_CHAT,
+    MSG_DIRECT,
+    MSG_JOIN,
+    MSG_LEAVE,
+    MSG_NODE,
+    MSG_PARTIAL,
+    MSG_PRESENCE,
+    MSG_RELAY,
+    MSG_ROOMS,
+    MSG_SESSION,
+    MSG_SYSTEM,
+    PROTOCOL_VERSION,
+    Frame,
+    NegotiatingDecoder,
+    decode_frame,
+    handshake_name,
+    now_ms,
+    parse_hello,
+    to_bytes,
+    valid_utf8,
+)
+from lib.relay import (
+    RELAY_RETRY,
+    RELAY_RETRY_MIN,
+    DedupWindow,
+    connect_link,
+    get_node_id,
+    get_relay_peers,
+    get_relay_port,
+    get_relay_secret,
+)
+from lib.presence import JOINED, LEFT, Presence, presence_snapshot
+from lib.rate_limit import FloodGuard, flood_limits_from_env
+from lib.rooms import DEFAULT_ROOM, get_rooms, unwrap, valid_room_name, wrap
+from lib.sessions import get_replay_buffer, get_session_store, missed_frames
+from lib.utils import RECV_BUFFER_SIZE, SYSTEM_SENDER_NAME
+
+HANDSHAKE_TIMEOUT = 10
 
 
 class Server:
-    def __init__(self, host="localhost", port=8000):
+    def __init__(
+        self,
+        host="localhost",
+        port=8000,
+        poller=None,
+        handshake_timeout=HANDSHAKE_TIMEOUT,
+        queue_limits=None,
+        message_log=FROM_ENV,
+        replay_buffer=None,
+        sessions=None,
+        reuse_port=False,
+        relay_peers=None,
+        node_id=None,
+        rooms=None,
+        flood_limits=None,
+        relay_secret=None,
+        relay_port=None,
+    ):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sockets_list = [self.server_socket]
+        if reuse_port:
+            # Cluster workers each listen on the same port
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.poller = get_poller(poller or get_env_var("SERVER_POLLER", "selectors"))
+        self.stopped = False
+        self.handshake_timeout = handshake_timeout
+        self.queue_limits = queue_limits or get_queue_limits()
+        # All open connections, and the subset that completed the handshake
+        self.connections = {}
         self.clients = {}
+        # Connections awaiting their name, in accept order (and so by deadline)
+        self.handshakes = deque()
+        # Sockets that got new frames this tick, and sockets waiting for
+        # EVENT_WRITE because the kernel buffer was full
+        self.dirty = set()
+        self.write_pending = set()
+        # Connections over their send queue limit under the disconnect policy
+        self.slow_consumers = set()
+        # Per-client rate limits, and the clients whose reads are paused for
+        # exceeding them, with the time to resume
+        self.flood_limits = flood_limits or flood_limits_from_env()
+        self.throttled = {}
+        # Scrollback on disk, of the default room (the other rooms' logs are
+        # kept next to it); sequence numbers carry on from them after a restart
+        self.message_log = (
+            get_message_log_from_env() if message_log is FROM_ENV else message_log
+        )
+        self.rooms = rooms or get_rooms(self.message_log)
+        # Registered clients by name, and the room membership changes of this
+        # tick
+        self.presence = Presence()
+        self.presence_changes = {}
+        self.sequence = self.rooms.last_seq
+        # Recent frames and session tokens, for clients resuming a session
+        self.replay_buffer = replay_buffer or get_replay_buffer()
+        self.sessions = sessions or get_session_store()
+        # In cluster mode: bus connections to the other workers, and the
+        # sequence counter shared with them
+        self.peers = []
+        self.shared_sequence = None
+        # Federation: relay links to other nodes, the ones this node dials by
+        # address, and the envelopes already seen. Links are only accepted
+        # from nodes that know the relay secret, and on the relay port if
+        # there is one.
+        self.node_id = to_bytes(node_id) if node_id else get_node_id()
+        self.relay_secret = (
+            get_relay_secret() if relay_secret is None else to_bytes(relay_secret)
+        )
+        self.relay_peers = get_relay_peers() if relay_peers is None else relay_peers
+        if self.relay_peers and not self.relay_secret:
+            raise ValueError("RELAY_PEERS needs a RELAY_SECRET")
+        self.relay_port = get_relay_port() if relay_port is None else relay_port
+        self.relay_socket = None
+        self.nodes = []
+        self.node_links = {}
+        self.next_link_attempt = 0
+        self.link_retry_delay = RELAY_RETRY_MIN
+        # Starts from the clock, so a restarted node's envelopes aren't taken
+        # for ones its peers have already seen
+        self.relay_sequence = now_ms() * 1000
+        self.relay_dedup = DedupWindow()
+
+    def join_cluster(self, peer_sockets, shared_sequence):
+        """
+        Relays broadcasts to and from the other workers over their bus
+        sockets, and stamps frames from the shared sequence counter.
+        """
+        self.shared_sequence = shared_sequence
+        shared_sequence.advance(self.sequence)
+        for peer_socket in peer_sockets:
+            peer_socket.setblocking(False)
+            connection = Connection(peer_socket, "bus", "worker")
+            connection.state = PEER
+            self.connections[peer_socket] = connection
+            self.peers.append(connection)
+            self.poller.register(peer_socket, EVENT_READ)
+
+    def next_sequence(self):
+        if self.shared_sequence is None:
+            self.sequence += 1
+        else:
+            self.sequence = self.shared_sequence.next()
+        return self.sequence
 
     def listen(self):
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
         print(f"[SERVER] listening on {self.host}:{self.port}")
         self.server_socket.setblocking(False)
+        self.poller.register(self.server_socket, EVENT_READ)
+        if self.relay_port:
+            self.relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.relay_socket.bind((self.host, self.relay_port))
+            self.relay_socket.listen()
+            print(f"[SERVER] accepting relay links on {self.host}:{self.relay_port}")
+            self.relay_socket.setblocking(False)
+            self.poller.register(self.relay_socket, EVENT_READ)
 
     def start(self):
         self.listen()
         try:
             while True:
-                # Filter out closed sockets
-                self.sockets_list = [s for s in self.sockets_list if s.fileno() != -1]
-
-                read_sockets, _, exception_sockets = select.select(
-                    self.sockets_list, [], self.sockets_list
-                )
-                self.handle_sockets(read_sockets, exception_sockets)
-                # Remove closed sockets
-                self.sockets_list = [s for s in self.sockets_list if s.fileno() != -1]
+                self.handle_events(self.poller.poll(self.poll_timeout()))
+                self.resume_throttled()
+                self.connect_nodes()
+                self.expire_handshakes()
+                self.flush_dirty()
+                self.disconnect_slow_consumers()
         except Exception as e:
             print(f"[SERVER] Error!!!: {e}")
             traceback.print_exc()
@@ -46,79 +199,928 @@ class Server:
             self.stop()
 
     def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
         print("[SERVER] Shutting down")
+        self.flush_dirty()
+        for client_socket in list(self.connections):
+            self.remove_client(client_socket)
+        self.poller.close()
         self.server_socket.close()
+        if self.relay_socket is not None:
+            self.relay_socket.close()
+        self.rooms.close()
+        if self.message_log is not None:
+            self.message_log.close()
 
-    def handle_sockets(self, read_sockets, exception_sockets):
-        for notified_socket in read_sockets:
-            if notified_socket == self.server_socket:
+    def handle_events(self, events):
+        for notified_socket, mask in events:
+            if (
+                notified_socket is self.server_socket
+                or notified_socket is self.relay_socket
+            ):
                 self.accept_new_connection(notified_socket)
-            else:
+                continue
+            # A socket may have been removed earlier in this batch
+            if mask & EVENT_READ and notified_socket in self.connections:
                 self.receive_and_broadcast_message(notified_socket)
-
-        for notified_socket in exception_sockets:
-            self.remove_client(notified_socket)
+            if mask & EVENT_WRITE and notified_socket in self.connections:
+                self.flush_client(notified_socket)
 
     def accept_new_connection(self, notified_socket):
-        client_socket, client_address = notified_socket.accept()
-        client_socket.setblocking(False)
-        self.sockets_list.append(client_socket)
+        # Drain the whole accept backlog, so a reconnect storm is absorbed in
+        # as few wakeups as possible.
+        while True:
+            try:
+                client_socket, client_address = notified_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"[SERVER] Failed to accept a connection: {e}")
+                return
 
-        try:
-            client_name = receive_message(client_socket)
-            self.clients[client_socket] = (client_address, client_name)
-            print(
-                f"[SERVER] Accepted new connection from {client_address} (Client: {client_name})"
+            client_socket.setblocking(False)
+            connection = Connection(
+                client_socket,
+                client_address,
+                None,
+                time.monotonic(),
+                self.queue_limits,
             )
+            if self.flood_limits.enabled:
+                connection.flood = FloodGuard(self.flood_limits)
+            self.connections[client_socket] = connection
+            self.poller.register(client_socket, EVENT_READ)
+            connection.state = AWAITING_NAME
+            self.handshakes.append(connection)
 
-            welcome_message = serialize_message(
-                SYSTEM_SENDER_NAME, f"Welcome to the chatroom, {client_name}!"
+    def register_client(self, connection, hello_frame):
+        requested_name = handshake_name(hello_frame)
+        token, room_name = b"", ""
+        if connection.version == PROTOCOL_VERSION:
+            token, room_name = parse_hello(hello_frame)
+        existing = self.presence.get(requested_name)
+        if existing is not None and token and existing.session == token:
+            # The client is back before its old connection was seen to drop
+            self.remove_client(existing.sock)
+        client_name = self.presence.add(connection, requested_name)
+        connection.name = client_name
+        # Encoded from the decoded name, so other clients never see bytes
+        # that are not valid UTF-8
+        connection.sender = client_name.encode("utf-8")
+        if client_name != requested_name:
+            self.send_notice(
+                connection,
+                f"The name {requested_name} is taken, you are {client_name}",
             )
-            client_socket.sendall(encode_message(welcome_message))
+        connection.state = REGISTERED
+        self.clients[connection.sock] = connection
+        print(
+            f"[SERVER] Accepted new connection from {connection.address} "
+            f"(Client: {client_name}, protocol v{connection.version})"
+        )
+
+        room = None
+        if room_name and room_name != DEFAULT_ROOM:
+            room = self.join_room(connection, room_name, announce=False)
+        if room is None:
+            room = self.join_room(connection, DEFAULT_ROOM, announce=False)
+
+        resumed = False
+        if connection.version == PROTOCOL_VERSION:
+            resumed = self.resume_session(connection, hello_frame)
+        if not resumed and room.message_log is not None:
+            self.replay_history(connection)
+        if resumed:
+            welcome = f"Welcome back, {client_name}!"
+        elif room.name == DEFAULT_ROOM:
+            welcome = f"Welcome to the chatroom, {client_name}!"
+        else:
+            welcome = f"Welcome to #{room.name}, {client_name}!"
+        self.send_notice(connection, welcome)
+        if connection.session is not None:
+            session_frame = Frame(MSG_SESSION, b"", connection.session, self.sequence)
+            self.send_to_client(connection, session_frame.encode())
+        if connection.version == PROTOCOL_VERSION:
+            self.send_presence_snapshot(connection)
+
+    def resume_session(self, connection, hello_frame):
+        """
+        Resumes the session named in the handshake, if it is still live, and
+        queues the frames the client missed. Otherwise starts a new session.
+        """
+        token, _ = parse_hello(hello_frame)
+        if token and self.sessions.resume(token):
+            connection.session = token
+            for frame in missed_frames(
+                self.replay_buffer,
+                hello_frame.seq,
+                connection.sender,
+                connection.room.name,
+            ):
+                connection.append(frame.encode())
+            return True
+        connection.session = self.sessions.create()
+        return False
+
+    def replay_history(self, connection):
+        """
+        Queues the recent frames of the client's room ahead of the welcome
+        message. v2 clients get them straight from the segment files with
+        sendfile.
+        """
+        message_log = connection.room.message_log
+        ranges = message_log.replay_ranges()
+        if connection.version == PROTOCOL_VERSION:
+            for file_range in ranges:
+                connection.append_file(file_range)
+        else:
+            for frame in message_log.read_frames(ranges):
+                connection.append(frame.encode(connection.version))
+
+    def join_room(self, connection, room_name, announce=True):
+        """
+        Moves a client to another room. When announced, the client is sent
+        the room's history, a MSG_JOIN naming the room and its members.
+        Returns the room, or None if the client could not join it.
+        """
+        if not valid_room_name(room_name):
+            self.send_notice(connection, f"Invalid room name: {room_name}")
+            return None
+        previous = connection.room
+        try:
+            room = self.rooms.join(connection, room_name)
+        except OSError as e:
+            print(f"[SERVER] Could not open the log of #{room_name}: {e}")
+            self.send_notice(
+                connection, f"Could not join #{room_name}: its history is unavailable"
+            )
+            return None
+        if room is None:
+            reason = (
+                "the room is full"
+                if self.rooms.get(room_name)
+                else "too many rooms are open"
+            )
+            self.send_notice(connection, f"Could not join #{room_name}: {reason}")
+            return None
+        if room is not previous:
+            if previous is not None:
+                self.note_presence(previous, LEFT, connection.name)
+            self.note_presence(room, JOINED, connection.name)
+        if announce:
+            if room is not previous and room.message_log is not None:
+                self.replay_history(connection)
+            join_frame = Frame(
+                MSG_JOIN, SYSTEM_SENDER_NAME, room.name, self.sequence, now_ms()
+            )
+            self.send_to_client(connection, join_frame.encode())
+            self.send_presence_snapshot(connection)
+        return room
+
+    def note_presence(self, room, change, name):
+        # Sent to the room's members in one MSG_PRESENCE at the end of the tick
+        self.presence_changes.setdefault(room, []).append(change + name)
+
+    def send_presence_snapshot(self, connection):
+        snapshot = Frame(
+            MSG_PRESENCE,
+            b"",
+            presence_snapshot(
+                member.name for member in connection.room.members.values()
+            ),
+            timestamp=now_ms(),
+        )
+        self.send_to_client(connection, snapshot.encode())
 
-        except BlockingIOError:
-            self.sockets_list.remove(client_socket)
-            client_socket.close()
+    def flush_presence(self):
+        changes, self.presence_changes = self.presence_changes, {}
+        for room, lines in changes.items():
+            if room.members:
+                delta = Frame(MSG_PRESENCE, b"", "\n".join(lines), timestamp=now_ms())
+                self.broadcast_to_clients(room, delta, None, PROTOCOL_VERSION)
+
+    def send_direct(self, connection, recipient_name, body):
+        """
+        Delivers a direct message to one client. A recipient that is not
+        connected here may be on another worker or node, so the message is
+        passed on to them, and only the one that has the recipient delivers it.
+        """
+        direct_frame = Frame(MSG_DIRECT, connection.sender, body, timestamp=now_ms())
+        recipient = self.presence.get(recipient_name)
+        if recipient is not None:
+            self.send_to_client(recipient, direct_frame.encode(recipient.version))
+        elif self.peers or self.nodes:
+            addressed = Frame(MSG_DIRECT, recipient_name, direct_frame.encode())
+            self.broadcast_to_peers(addressed)
+            self.relay_to_nodes(addressed)
+        else:
+            self.send_notice(connection, f"{recipient_name} is not online")
+
+    def send_notice(self, connection, text):
+        notice = Frame(MSG_SYSTEM, SYSTEM_SENDER_NAME, text, timestamp=now_ms())
+        self.send_to_client(connection, notice.encode(connection.version))
+
+    def poll_timeout(self):
+        deadlines = []
+        if self.handshakes:
+            deadlines.append(self.handshakes[0].accepted_at + self.handshake_timeout)
+        if len(self.node_links) < len(self.relay_peers):
+            deadlines.append(self.next_link_attempt)
+        if self.throttled:
+            deadlines.append(min(self.throttled.values()))
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def expire_handshakes(self):
+        now = time.monotonic()
+        handshakes = self.handshakes
+        while handshakes:
+            connection = handshakes[0]
+            if self.connections.get(connection.sock) is not connection or (
+                connection.state != AWAITING_NAME
+            ):
+                handshakes.popleft()
+                continue
+            if connection.accepted_at + self.handshake_timeout > now:
+                break
+            handshakes.popleft()
             print(
-                f"[SERVER] Connection from {client_address} failed due to a blocking error"
+                f"[SERVER] Connection from {connection.address} timed out during handshake"
             )
+            self.remove_client(connection.sock)
 
     def receive_and_broadcast_message(self, notified_socket):
+        connection = self.connections[notified_socket]
         try:
-            message = receive_message(notified_socket)
-            if message is False:
+            frames = connection.decoder.receive(notified_socket)
+        except (OSError, ValueError):
+            frames = False
+        if frames is False:
+            if connection.state == PEER:
+                print("[SERVER] Lost the bus connection to another worker")
+            self.remove_client(notified_socket)
+            return
+
+        if connection.state == PEER:
+            self.relay_from_peer(frames)
+            return
+        if connection.state == NODE:
+            self.relay_from_node(connection, frames)
+            return
+        if connection.state != REGISTERED:
+            if not frames:
+                return
+            if frames[0].type == MSG_NODE:
+                if self.register_node(connection, frames[0]):
+                    self.relay_from_node(connection, frames[1:])
+                return
+            if self.on_relay_port(connection):
+                print(
+                    f"[SERVER] Rejected a client on the relay port from {connection.address}"
+                )
                 self.remove_client(notified_socket)
                 return
+            self.register_client(connection, frames[0])
+            frames = frames[1:]
+        self.handle_client_frames(connection, frames)
 
-            client_address, client_name = self.clients[notified_socket]
-            broadcast_message = serialize_message(client_name, message)
-            encoded_message = encode_message(broadcast_message)
-            self.broadcast_to_clients(encoded_message, notified_socket)
+    def handle_client_frames(self, connection, frames):
+        notified_socket = connection.sock
+        flood = connection.flood
+        now = time.monotonic()
+        for index, frame in enumerate(frames):
+            if flood is not None:
+                wait = flood.admit(len(frame.body), now)
+                if wait:
+                    self.throttle(connection, frames[index:], now + wait)
+                    return
+            room = connection.room
+            if frame.type == MSG_CHAT:
+                # Relay the body bytes as they are, stamped with the sender's
+                # name, a sequence number and the server time.
+                broadcast_frame = Frame(
+                    MSG_CHAT,
+                    connection.sender,
+                    valid_utf8(frame.body),
+                    self.next_sequence(),
+                    now_ms(),
+                )
+                self.publish(room, broadcast_frame, notified_socket)
+                relayed = wrap(broadcast_frame, room.name)
+                self.broadcast_to_peers(relayed)
+                self.relay_to_nodes(relayed)
+            elif frame.type == MSG_PARTIAL:
+                # Partial output is unsequenced and only understood by v2
+                # clients; everyone gets the complete MSG_CHAT that follows.
+                partial_frame = Frame(
+                    MSG_PARTIAL,
+                    connection.sender,
+                    valid_utf8(frame.body),
+                    timestamp=now_ms(),
+                )
+                self.broadcast_to_clients(
+                    room, partial_frame, notified_socket, PROTOCOL_VERSION
+                )
+                relayed = wrap(partial_frame, room.name)
+                self.broadcast_to_peers(relayed)
+                self.relay_to_nodes(relayed)
+            elif frame.type == MSG_JOIN:
+                # A name that is not valid UTF-8 fails the room name check
+                self.join_room(connection, frame.body.decode("utf-8", "replace"))
+            elif frame.type == MSG_LEAVE:
+                self.join_room(connection, DEFAULT_ROOM)
+            elif frame.type == MSG_ROOMS:
+                rooms_frame = Frame(MSG_ROOMS, SYSTEM_SENDER_NAME, self.rooms.list())
+                self.send_to_client(connection, rooms_frame.encode())
+            elif frame.type == MSG_DIRECT:
+                recipient_name = frame.sender.decode("utf-8", "replace")
+                self.send_direct(connection, recipient_name, valid_utf8(frame.body))
 
-        except BlockingIOError:
-            self.remove_client(notified_socket)
+    def throttle(self, connection, held, resume_at):
+        """
+        Stops reading from a client that is over its rate limits until
+        resume_at. The frames already read are handled then; anything else
+        waits in the kernel buffers, so the sender is slowed down by TCP.
+        """
+        flood = connection.flood
+        flood.held = held
+        if connection.sock not in self.throttled:
+            flood.throttled += 1
+            if flood.should_notify(time.monotonic()):
+                self.send_notice(
+                    connection, "You are sending too fast, your messages are delayed"
+                )
+        self.throttled[connection.sock] = resume_at
+        self.poller.modify(connection.sock, self.watched_events(connection.sock))
 
-    def broadcast_to_clients(self, encoded_message, sender_socket):
-        for client_socket in self.clients:
-            if client_socket != sender_socket:
-                try:
-                    client_socket.sendall(encoded_message)
-                except BlockingIOError:
-                    self.remove_client(client_socket)
+    def resume_throttled(self):
+        if not self.throttled:
+            return
+        now = time.monotonic()
+        for client_socket, resume_at in list(self.throttled.items()):
+            if resume_at > now:
+                continue
+            del self.throttled[client_socket]
+            connection = self.connections.get(client_socket)
+            if connection is None:
+                continue
+            held, connection.flood.held = connection.flood.held, []
+            self.handle_client_frames(connection, held)
+            if client_socket not in self.throttled:
+                self.poller.modify(client_socket, self.watched_events(client_socket))
+
+    def watched_events(self, client_socket):
+        events = 0 if client_socket in self.throttled else EVENT_READ
+        if client_socket in self.write_pending:
+            events |= EVENT_WRITE
+        return events
+
+    def publish(self, room, frame, sender_socket):
+        """
+        Records a sequenced chat frame of a room and sends it to the room's
+        members.
+        """
+        self.replay_buffer.append(frame, room.name)
+        self.rooms.log(room, frame)
+        self.broadcast_to_clients(room, frame, sender_socket)
+
+    def deliver_relayed(self, relayed, sequence=None):
+        """
+        Publishes a frame that came from another worker or node. Frames of a
+        room that is not open here open it, so its log stays complete, unless
+        no more rooms can be opened.
+        """
+        try:
+            if relayed.type == MSG_DIRECT:
+                recipient = self.presence.get(relayed.sender_name)
+                if recipient is not None:
+                    direct_frame = decode_frame(relayed.body)
+                    self.send_to_client(
+                        recipient, direct_frame.encode(recipient.version)
+                    )
+                return
+            room_name, frame = unwrap(relayed)
+        except ValueError:
+            return
+        room = self.rooms.open(room_name) if valid_room_name(room_name) else None
+        if room is None:
+            return
+        if frame.type == MSG_CHAT:
+            if sequence is None:
+                # Stamped from the shared counter by another worker
+                self.sequence = max(self.sequence, frame.seq)
+            else:
+                frame = Frame(
+                    MSG_CHAT, frame.sender, frame.body, sequence(), frame.timestamp
+                )
+            self.publish(room, frame, None)
+        elif frame.type == MSG_PARTIAL:
+            self.broadcast_to_clients(room, frame, None, PROTOCOL_VERSION)
+
+    def relay_from_peer(self, frames):
+        # Frames from another worker were already stamped, logged there and
+        # sent to its own clients
+        for frame in frames:
+            self.deliver_relayed(frame)
+
+    def connect_nodes(self):
+        """
+        Dials the relay peers this node has no link to, backing off up to
+        RELAY_RETRY seconds between attempts.
+        """
+        if len(self.node_links) == len(self.relay_peers):
+            self.link_retry_delay = RELAY_RETRY_MIN
+            return
+        now = time.monotonic()
+        if now < self.next_link_attempt:
+            return
+        self.next_link_attempt = now + self.link_retry_delay
+        self.link_retry_delay = min(RELAY_RETRY, self.link_retry_delay * 2)
+        for address in self.relay_peers:
+            if address in self.node_links:
+                continue
+            try:
+                link_socket, hello = connect_link(
+                    address, self.node_id, self.relay_secret
+                )
+            except OSError as e:
+                print(f"[SERVER] Failed to connect to node {address}: {e}")
+                continue
+            # The handshake waits in the queue until the connection is up
+            connection = self.add_node(link_socket, address)
+            self.node_links[address] = connection
+            self.send_to_client(connection, hello)
+
+    def add_node(self, link_socket, address):
+        connection = Connection(link_socket, address, "node")
+        connection.state = NODE
+        self.connections[link_socket] = connection
+        self.nodes.append(connection)
+        self.poller.register(link_socket, EVENT_READ)
+        return connection
+
+    def on_relay_port(self, connection):
+        if self.relay_socket is None:
+            return False
+        try:
+            address = connection.sock.getsockname()
+        except OSError:
+            return False
+        # Only TCP connections can have come in on the relay port
+        return (
+            isinstance(address, tuple)
+            and address[1] == self.relay_socket.getsockname()[1]
+        )
+
+    def register_node(self, connection, hello_frame):
+        """
+        Turns an accepted connection into a relay link, if a relay secret is
+        configured and the node knows it. With a relay port, links are only
+        accepted there.
+        """
+        if (
+            not self.relay_secret
+            or (self.relay_socket is not None and not self.on_relay_port(connection))
+            or not hmac.compare_digest(hello_frame.body, self.relay_secret)
+        ):
+            print(f"[SERVER] Rejected relay link from {connection.address}")
+            self.remove_client(connection.sock)
+            return False
+        connection.name = f"node {hello_frame.sender_name}"
+        connection.state = NODE
+        connection.flood = None
+        self.nodes.append(connection)
+        print(f"[SERVER] Relay link from {connection.name} at {connection.address}")
+        return True
+
+    def relay_to_nodes(self, frame):
+        """
+        Wraps a local frame in a relay envelope for every linked node.
+        """
+        if not self.nodes:
+            return
+        self.relay_sequence += 1
+        envelope = Frame(
+            MSG_RELAY, self.node_id, frame.encode(), self.relay_sequence
+        ).encode()
+        for node in self.nodes:
+            self.send_to_client(node, envelope)
+
+    def relay_from_node(self, source, envelopes):
+        # Envelopes are passed on to every other link; the dedup window drops
+        # the copies that come back around a loop in the mesh.
+        for envelope in envelopes:
+            if (
+                envelope.type != MSG_RELAY
+                or envelope.sender == self.node_id
+                or not self.relay_dedup.check(envelope.sender, envelope.seq)
+            ):
+                continue
+            encoded = envelope.encode()
+            for node in self.nodes:
+                if node is not source:
+                    self.send_to_client(node, encoded)
+            try:
+                frame = decode_frame(envelope.body)
+            except ValueError:
+                continue
+            # Chat frames are sequenced by this node, for its own clients and
+            # logs
+            self.deliver_relayed(frame, self.next_sequence)
+
+    def broadcast_to_peers(self, frame):
+        # Queued like client frames, so each peer gets the whole tick's
+        # frames in one write
+        for peer in self.peers:
+            self.send_to_client(peer, frame.encode())
+
+    def broadcast_to_clients(self, room, frame, sender_socket, min_version=1):
+        # Only queue the (shared) encoded frame for the room's members; every
+        # recipient is flushed once at the end of the tick.
+        for client_socket, connection in room.members.items():
+            if client_socket != sender_socket and connection.version >= min_version:
+                self.send_to_client(connection, frame.encode(connection.version))
+
+    def send_to_client(self, connection, encoded_message):
+        if not connection.enqueue(encoded_message):
+            if connection.over_limit_since is not None:
+                self.slow_consumers.add(connection.sock)
+            return
+        if connection.sock not in self.write_pending:
+            self.dirty.add(connection.sock)
+
+    def disconnect_slow_consumers(self):
+        if not self.slow_consumers:
+            return
+        now = time.monotonic()
+        for client_socket in list(self.slow_consumers):
+            connection = self.connections.get(client_socket)
+            if connection is None or connection.over_limit_since is None:
+                self.slow_consumers.discard(client_socket)
+            elif now - connection.over_limit_since >= self.queue_limits.grace:
+                print(
+                    f"[SERVER] Disconnecting slow consumer {connection.address} "
+                    f"(Client: {connection.name})"
+                )
+                self.remove_client(client_socket)
+
+    def flush_dirty(self):
+        """
+        Writes out everything queued during this tick with one sendmsg per
+        recipient. Sockets that could not be drained wait for EVENT_WRITE.
+        """
+        self.rooms.flush()
+        if self.presence_changes:
+            self.flush_presence()
+        dirty, self.dirty = self.dirty, set()
+        for client_socket in dirty:
+            connection = self.connections.get(client_socket)
+            if connection is None:
+                continue
+            try:
+                drained = connection.flush()
+            except OSError:
+                self.remove_client(client_socket)
+                continue
+            if not drained:
+                self.write_pending.add(client_socket)
+                self.poller.modify(client_socket, self.watched_events(client_socket))
+
+    def flush_client(self, client_socket):
+        try:
+            if self.connections[client_socket].flush():
+                self.write_pending.discard(client_socket)
+                self.poller.modify(client_socket, self.watched_events(client_socket))
+        except OSError:
+            self.remove_client(client_socket)
 
     def remove_client(self, notified_socket):
-        self.sockets_list.remove(notified_socket)
-        client_address, client_name = self.clients[notified_socket]
-        del self.clients[notified_socket]
+        self.poller.unregister(notified_socket)
+        self.dirty.discard(notified_socket)
+        self.write_pending.discard(notified_socket)
+        self.throttled.pop(notified_socket, None)
+        self.slow_consumers.discard(notified_socket)
+        connection = self.connections.pop(notified_socket)
+        connection.close_files()
+        self.clients.pop(notified_socket, None)
+        self.presence.remove(connection)
+        if connection.room is not None:
+            self.note_presence(connection.room, LEFT, connection.name)
+            self.rooms.leave(connection)
         notified_socket.close()
+        if connection.state == PEER:
+            self.peers.remove(connection)
+            return
+        if connection.state == NODE:
+            self.nodes.remove(connection)
+            if self.node_links.get(connection.address) is connection:
+                # Redialed by connect_nodes
+                del self.node_links[connection.address]
+        if connection.session is not None:
+            # Resumable for SESSION_TTL seconds from now
+            self.sessions.touch(connection.session)
+        dropped = (
+            f", {connection.dropped_messages} messages dropped"
+            if connection.dropped_messages
+            else ""
+        )
+        if connection.flood is not None and connection.flood.throttled:
+            dropped += f", throttled {connection.flood.throttled} times"
         print(
-            f"[SERVER] Connection to {client_address} (Client: {client_name}) failed due to a blocking error"
+            f"[SERVER] Connection to {connection.address} (Client: {connection.name}) closed{dropped}"
         )
 
 
-if __name__ == "__main__":
-    server = Server()
+class AsyncServer:
+    """
+    asyncio-based server engine. Speaks the same wire format as `Server`, but
+    every connection is its own coroutine and broadcasts are queued on the
+    clients' transports instead of being sent inline. It has a single room,
+    which everyone is in, and no presence or direct messages.
+    """
+
+    def __init__(
+        self,
+        host="localhost",
+        port=8000,
+        queue_limits=None,
+        message_log=FROM_ENV,
+        replay_buffer=None,
+        sessions=None,
+    ):
+        self.host = host
+        self.port = port
+        self.queue_limits = queue_limits or get_queue_limits()
+        self.dropped_messages = {}
+        # When each writer's transport buffer went over the limit, under the
+        # disconnect policy
+        self.over_limit_since = {}
+        self.server = None
+        self.stopped = False
+        self.clients = {}
+        self.message_log = (
+            get_message_log_from_env() if message_log is FROM_ENV else message_log
+        )
+        self.sequence = self.message_log.last_seq if self.message_log else 0
+        self.replay_buffer = replay_buffer or get_replay_buffer()
+        self.sessions = sessions or get_session_store()
+        # Frames queued per writer until the end of the current loop iteration
+        self.outbound = {}
+        # Frames held back from writers that are being sent their scrollback
+        self.replaying = {}
+        self.rooms_unsupported = Frame(
+            MSG_SYSTEM,
+            SYSTEM_SENDER_NAME,
+            "Rooms are not supported by this server; you are in the chatroom",
+        )
+        self.direct_unsupported = Frame(
+            MSG_SYSTEM,
+            SYSTEM_SENDER_NAME,
+            "Direct messages are not supported by this server",
+        )
+
+    async def listen(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, reuse_address=True
+        )
+        print(f"[SERVER] listening on {self.host}:{self.port}")
+
+    async def start(self):
+        await self.listen()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        print("[SERVER] Shutting down")
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        self.clients.clear()
+        if self.message_log is not None:
+            self.message_log.close()
+
+    async def read_frames(self, reader, decoder):
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed by peer")
+            frames = decoder.feed(data)
+            if frames:
+                return frames
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        decoder = NegotiatingDecoder()
+        try:
+            hello_frame, *frames = await asyncio.wait_for(
+                self.read_frames(reader, decoder), HANDSHAKE_TIMEOUT
+            )
+        except (ConnectionError, ValueError, asyncio.TimeoutError):
+            writer.close()
+            print(f"[SERVER] Connection from {client_address} closed before handshake")
+            return
+
+        client_name = handshake_name(hello_frame)
+        sender = client_name.encode("utf-8")
+        self.clients[writer] = (client_address, client_name, decoder.version)
+        print(
+            f"[SERVER] Accepted new connection from {client_address} "
+            f"(Client: {client_name}, protocol v{decoder.version})"
+        )
+        session = None
+        resumed = False
+        room_name = ""
+        if decoder.version == PROTOCOL_VERSION:
+            token, room_name = parse_hello(hello_frame)
+            if token and self.sessions.resume(token):
+                session = token
+                resumed = True
+            else:
+                session = self.sessions.create()
+        welcome_frame = Frame(
+            MSG_SYSTEM,
+            SYSTEM_SENDER_NAME,
+            (
+                f"Welcome back, {client_name}!"
+                if resumed
+                else f"Welcome to the chatroom, {client_name}!"
+            ),
+            timestamp=now_ms(),
+        )
+
+        try:
+            held = []
+            if resumed:
+                frames_missed = missed_frames(
+                    self.replay_buffer, hello_frame.seq, sender
+                )
+                writer.writelines([frame.encode() for frame in frames_missed])
+            elif self.message_log is not None:
+                self.replaying[writer] = []
+                try:
+                    await self.replay_history(writer, decoder.version)
+                finally:
+                    held = self.replaying.pop(writer)
+            if room_name and room_name != DEFAULT_ROOM:
+                writer.write(self.rooms_unsupported.encode())
+            writer.write(welcome_frame.encode(decoder.version))
+            writer.writelines(held)
+            if session is not None:
+                session_frame = Frame(MSG_SESSION, b"", session, self.sequence)
+                writer.write(session_frame.encode())
+            while True:
+                for frame in frames:
+                    if frame.type == MSG_CHAT:
+                        self.sequence += 1
+                        broadcast_frame = Frame(
+                            MSG_CHAT,
+                            sender,
+                            valid_utf8(frame.body),
+                            self.sequence,
+                            now_ms(),
+                        )
+                        self.replay_buffer.append(broadcast_frame)
+                        if self.message_log is not None:
+                            self.message_log.append(broadcast_frame)
+                        self.broadcast_to_clients(broadcast_frame, writer)
+                    elif frame.type == MSG_PARTIAL:
+                        partial_frame = Frame(
+                            MSG_PARTIAL,
+                            sender,
+                            valid_utf8(frame.body),
+                            timestamp=now_ms(),
+                        )
+                        self.broadcast_to_clients(
+                            partial_frame, writer, PROTOCOL_VERSION
+                        )
+                    elif frame.type in (MSG_JOIN, MSG_LEAVE, MSG_ROOMS):
+                        writer.write(self.rooms_unsupported.encode())
+                    elif frame.type == MSG_DIRECT:
+                        writer.write(self.direct_unsupported.encode())
+                frames = await self.read_frames(reader, decoder)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.remove_client(writer)
+            if session is not None:
+                self.sessions.touch(session)
+
+    async def replay_history(self, writer, version):
+        ranges = self.message_log.replay_ranges()
+        if version != PROTOCOL_VERSION:
+            frames = self.message_log.read_frames(ranges)
+            writer.writelines([frame.encode(version) for frame in frames])
+            return
+        loop = asyncio.get_running_loop()
+        for file_range in ranges:
+            with open(file_range.fd, "rb", closefd=False) as file:
+                await loop.sendfile(
+                    writer.transport, file, file_range.offset, file_range.count
+                )
+
+    def broadcast_to_clients(self, frame, sender_writer, min_version=1):
+        # Frames are batched per writer and handed to the transports in one
+        # writelines call per loop iteration; transports never block.
+        if not self.outbound:
+            asyncio.get_running_loop().call_soon(self.flush_outbound)
+        for writer, (_, _, version) in self.clients.items():
+            if writer is not sender_writer and version >= min_version:
+                self.outbound.setdefault(writer, []).append(frame.encode(version))
+
+    def flush_outbound(self):
+        if self.message_log is not None:
+            self.message_log.flush()
+        outbound, self.outbound = self.outbound, {}
+        max_bytes = self.queue_limits.max_bytes
+        for writer, buffers in outbound.items():
+            if writer.is_closing():
+                continue
+            if writer in self.replaying:
+                # Writing to a transport fails while it runs a sendfile
+                self.replaying[writer] += buffers
+                continue
+            # Transport buffers are opaque, so a full one drops the new frames
+            # (and, under the disconnect policy, the client once it has been
+            # over the limit for the grace period).
+            if writer.transport.get_write_buffer_size() > max_bytes:
+                if self.queue_limits.policy == DISCONNECT:
+                    now = time.monotonic()
+                    since = self.over_limit_since.setdefault(writer, now)
+                    if now - since >= self.queue_limits.grace:
+                        client_address, client_name, _ = self.clients[writer]
+                        print(
+                            f"[SERVER] Disconnecting slow consumer {client_address} "
+                            f"(Client: {client_name})"
+                        )
+                        self.remove_client(writer)
+                        continue
+                self.dropped_messages[writer] = self.dropped_messages.get(
+                    writer, 0
+                ) + len(buffers)
+                continue
+            self.over_limit_since.pop(writer, None)
+            writer.writelines(buffers)
+
+    def remove_client(self, writer):
+        if writer not in self.clients:
+            return
+        client_address, client_name, _ = self.clients.pop(writer)
+        self.outbound.pop(writer, None)
+        self.over_limit_since.pop(writer, None)
+        dropped_messages = self.dropped_messages.pop(writer, 0)
+        writer.close()
+        dropped = f", {dropped_messages} messages dropped" if dropped_messages else ""
+        print(
+            f"[SERVER] Connection to {client_address} (Client: {client_name}) closed{dropped}"
+        )
+
+
+def run_cluster_worker(
+    index, peer_sockets, shared_sequence, host="localhost", port=8000, poller=None
+):
+    # Each worker sees every frame, so each keeps its own copy of the log
+    server = Server(
+        host,
+        port,
+        poller,
+        message_log=get_message_log_from_env(f"worker-{index}"),
+        reuse_port=True,
+        relay_peers=[],
+    )
+    server.join_cluster(peer_sockets, shared_sequence)
     try:
         server.start()
-    finally:
-        server.stop()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    workers = get_cluster_workers()
+    if workers > 1:
+        try:
+            Cluster(workers, run_cluster_worker).run()
+        except KeyboardInterrupt:
+            pass
+    elif get_env_var("SERVER_ENGINE", "select") == "asyncio":
+        try:
+            asyncio.run(AsyncServer().start())
+        except KeyboardInterrupt:
+            pass
+    else:
+        try:
+            # start() shuts the server down when its loop ends
+            Server().start()
+        except KeyboardInterrupt:
+            pass